@@ -0,0 +1,238 @@
+"""移动客户端使用的 JSON 接口 (/api/v1/)
+
+* 返回紧凑的 JSON，不渲染模板，也不包含热门微博侧边栏
+* 通过 ?fields=id,content,author 选择需要的字段
+* 一页微博只做一次批量加载：微博、作者、点赞数、评论数各自一次批量读取
+* 粉丝等较长的列表分块加载、分块输出 (RequestHandler.flush)，不在内存中拼出整个列表
+"""
+
+import json
+from functools import wraps
+
+import tornado.web
+
+from views import BaseHandler
+from cache import user_cache, weibo_cache
+from counters import counter_buffer
+from comments import load_comment_tree
+from timeline import timeline
+from graph import graph
+
+WEIBO_FIELDS = ('id', 'user_id', 'content', 'created', 'like_count', 'comment_count', 'author')
+USER_FIELDS = ('id', 'nickname', 'gender', 'city', 'bio', 'n_followers', 'n_following')
+COMMENT_FIELDS = ('id', 'user_id', 'content', 'created', 'depth', 'reply_to', 'author')
+
+CHUNK_SIZE = 200  # 流式输出时每块的条目数
+
+
+def dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def auth_required(method):
+    '''接口需要登陆，未登陆时返回 401 而不是跳转到登陆页面'''
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.current_user is None:
+            raise tornado.web.HTTPError(401)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def pick(obj, fields):
+    return {field: getattr(obj, field) for field in fields}
+
+
+def brief_user(user):
+    '''嵌套在微博、评论中的作者信息'''
+    return None if user is None else {'id': user.id, 'nickname': user.nickname}
+
+
+def hydrate_weibos(session, wb_ids, fields):
+    '''批量加载一页微博，按 wb_ids 的顺序返回字典的列表'''
+    weibos = weibo_cache.get_many(session, wb_ids)
+    wb_list = [weibos[wb_id] for wb_id in wb_ids if wb_id in weibos]
+
+    authors = {}
+    if 'author' in fields:
+        authors = user_cache.get_many(session, {wb.user_id for wb in wb_list})
+
+    result = []
+    for wb in wb_list:
+        item = pick(wb, [f for f in fields if f not in ('author', 'like_count', 'comment_count')])
+        if 'like_count' in fields or 'comment_count' in fields:
+            # 数据库中的计数 + 尚未写回的增量
+            like, comment = counter_buffer.pending(wb.id)
+            if 'like_count' in fields:
+                item['like_count'] = wb.like_count + like
+            if 'comment_count' in fields:
+                item['comment_count'] = wb.comment_count + comment
+        if 'author' in fields:
+            item['author'] = brief_user(authors.get(wb.user_id))
+        result.append(item)
+    return result
+
+
+def hydrate_users(session, user_ids, fields):
+    '''批量加载用户，按 user_ids 的顺序返回字典的列表'''
+    users = user_cache.get_many(session, user_ids)
+
+    # 粉丝数、关注数各自一次分组计数
+    n_followers = graph.follower_counts(session, users) if 'n_followers' in fields else {}
+    n_following = graph.following_counts(session, users) if 'n_following' in fields else {}
+
+    result = []
+    for user_id in user_ids:
+        user = users.get(user_id)
+        if user is None:
+            continue
+        item = pick(user, [f for f in fields if f not in ('n_followers', 'n_following')])
+        if 'n_followers' in fields:
+            item['n_followers'] = n_followers[user_id]
+        if 'n_following' in fields:
+            item['n_following'] = n_following[user_id]
+        result.append(item)
+    return result
+
+
+class ApiHandler(BaseHandler):
+    '''JSON 接口的基类'''
+
+    def set_default_headers(self):
+        super().set_default_headers()
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+
+    def write_error(self, status_code, **kwargs):
+        self.finish(dumps({'error': self._reason}))
+
+    def get_fields(self, allowed, default=None):
+        '''解析 ?fields= 参数，未指定时返回全部字段'''
+        value = self.get_argument('fields', None)
+        if not value:
+            return default or allowed
+        fields = tuple(f for f in value.split(',') if f)
+        unknown = set(fields) - set(allowed)
+        if unknown:
+            raise tornado.web.HTTPError(400, reason='unknown fields: %s' % ','.join(sorted(unknown)))
+        return fields
+
+    def get_page(self):
+        try:
+            page = int(self.get_argument('page', 1))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid page')
+        return max(1, page)
+
+    def send(self, obj):
+        return self.finish(dumps(obj))
+
+    async def stream(self, head, key, ids, load):
+        '''分块输出较长的列表
+
+        head 为列表以外的字段，ids 为所有条目的 ID，load(ids) 在线程池中批量加载一块条目
+        '''
+        prefix = dumps(head)[:-1]
+        self.write('%s%s"%s":[' % (prefix, ',' if head else '', key))
+        for i in range(0, len(ids), CHUNK_SIZE):
+            items = await self.run_in_db(load, ids[i:i + CHUNK_SIZE])
+            chunk = ','.join(dumps(item) for item in items)
+            self.write((',' if i and chunk else '') + chunk)
+            await self.flush()  # 已加载的部分先发送给客户端
+        self.finish(']}')
+
+
+class TimelineApiHandler(ApiHandler):
+    '''关注的人的微博'''
+
+    @auth_required
+    async def get(self):
+        fields = self.get_fields(WEIBO_FIELDS)
+        page = self.get_page()
+        per_page_size = 20
+
+        items = await self.run_in_db(self.load, self.current_user.id, page, per_page_size, fields)
+        return self.send({'page': page, 'has_next': len(items) == per_page_size,
+                          'weibos': items})
+
+    def load(self, user_id, page, per_page_size, fields):
+        wb_ids = timeline.page(self.session, user_id, page, per_page_size)
+        return hydrate_weibos(self.session, wb_ids, fields)
+
+
+class WeiboApiHandler(ApiHandler):
+    '''单条微博'''
+
+    async def get(self, wb_id):
+        fields = self.get_fields(WEIBO_FIELDS)
+        items = await self.run_in_db(hydrate_weibos, self.session, [int(wb_id)], fields)
+        if not items:
+            raise tornado.web.HTTPError(404)
+        return self.send(items[0])
+
+
+class CommentsApiHandler(ApiHandler):
+    '''微博的评论，按楼层分页，每个楼层展开为按层级排列的评论'''
+
+    async def get(self, wb_id):
+        fields = self.get_fields(COMMENT_FIELDS)
+        page = self.get_page()
+        per_page_size = 20
+
+        data = await self.run_in_db(self.load, int(wb_id), page, per_page_size, fields)
+        return self.send(data)
+
+    def load(self, wb_id, page, per_page_size, fields):
+        weibo = weibo_cache.get(self.session, wb_id)
+        if weibo is None:
+            raise tornado.web.HTTPError(404)
+        tree = load_comment_tree(self.session, wb_id, weibo.archived)
+        plain = [f for f in fields if f not in ('depth', 'reply_to', 'author')]
+        comments = []
+        for node in tree.page(page, per_page_size):
+            item = pick(node.comment, plain)
+            if 'depth' in fields:
+                item['depth'] = node.depth
+            if 'reply_to' in fields:
+                item['reply_to'] = brief_user(node.reply_to)
+            if 'author' in fields:
+                item['author'] = brief_user(node.author)
+            comments.append(item)
+        return {'page': page, 'n_pages': tree.n_pages(per_page_size), 'comments': comments}
+
+
+class UserApiHandler(ApiHandler):
+    '''用户信息'''
+
+    async def get(self, user_id):
+        fields = self.get_fields(USER_FIELDS)
+        items = await self.run_in_db(hydrate_users, self.session, [int(user_id)], fields)
+        if not items:
+            raise tornado.web.HTTPError(404)
+        return self.send(items[0])
+
+
+class FansApiHandler(ApiHandler):
+    '''粉丝列表，指定 page 时分页，否则分块输出全部粉丝
+
+    与 /user/fans 页面相同，只能查看自己的粉丝
+    '''
+
+    @auth_required
+    async def get(self, user_id):
+        if int(user_id) != self.current_user.id:
+            raise tornado.web.HTTPError(403)
+        fields = self.get_fields(USER_FIELDS, default=('id', 'nickname'))
+        page = self.get_argument('page', None)
+        per_page_size = 50
+
+        fans_ids = await self.run_in_db(graph.followers, self.session, int(user_id))
+        fans_ids = fans_ids[:]  # 复制一份，输出期间关注关系可能变化
+        head = {'total': len(fans_ids)}
+        if page is not None:
+            page = self.get_page()
+            fans_ids = fans_ids[(page - 1) * per_page_size:page * per_page_size]
+            head['page'] = page
+
+        load = lambda ids: hydrate_users(self.session, list(ids), fields)
+        await self.stream(head, 'fans', fans_ids, load)
@@ -0,0 +1,111 @@
+"""冷热数据分离
+
+把不再活跃的数据从热表移到结构相同的归档表中，热表只保留经常读取的数据：
+    * 发布时间早于 --archive_horizon_days 的微博，连同其评论
+    * 已取消的点赞 (Like.status=False) 和已取消的关注 (Follow.status=False)
+
+每一批数据用 INSERT ... SELECT 复制到归档表，再从热表中删除，在同一个事务中完成。
+按 ID 读取微博时，热表中找不到会再查找归档表 (见 cache.EntityCache)，
+首页、关注的人的时间线等列表只读取热表。
+有效的点赞留在热表中 (点赞状态只读取热表)，归档微博的计数由 counters.CounterBuffer 写回归档表。
+
+    python archive.py --db sqlite:///weibo.db --horizon-days 365
+"""
+
+import time
+import argparse
+import datetime
+
+from sqlalchemy import select, func, and_
+from tornado.options import define, options
+
+import models
+from models import (Session, Weibo, Comment, Like, Follow,
+                    ArchivedWeibo, ArchivedComment, ArchivedLike, ArchivedFollow)
+from cache import weibo_cache
+from pagecache import page_cache
+
+define('archive_horizon_days', default=365, type=int, help='发布超过多少天的微博移入归档表')
+define('archive_interval', default=0, type=int, help='自动归档的间隔 (秒)，0 代表不自动归档')
+
+
+def move(session, model, archive_model, condition):
+    '''把满足条件的行复制到归档表，再从热表中删除，返回移动的行数'''
+    table, archive_table = model.__table__, archive_model.__table__
+    columns = [col.name for col in archive_table.columns]
+    stmt = archive_table.insert() \
+                        .from_select(columns, select([table.c[name] for name in columns])
+                                              .where(condition)) \
+                        .prefix_with('IGNORE', dialect='mysql') \
+                        .prefix_with('OR IGNORE', dialect='sqlite')
+    session.execute(stmt)
+    return session.execute(table.delete().where(condition)).rowcount
+
+
+def archive_weibos(horizon_days, batch_size=1000):
+    '''归档旧微博及其评论，返回归档的微博数量'''
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=horizon_days)
+    session = Session()
+    n_weibos = 0
+    try:
+        while True:
+            wb_ids = [wb_id for (wb_id, ) in session.query(Weibo.id)
+                                                    .filter(Weibo.created < cutoff)
+                                                    .order_by(Weibo.created, Weibo.id)
+                                                    .limit(batch_size)]
+            if not wb_ids:
+                break
+            n_weibos += move(session, Weibo, ArchivedWeibo, Weibo.id.in_(wb_ids))
+            move(session, Comment, ArchivedComment, Comment.wb_id.in_(wb_ids))
+            session.commit()
+            weibo_cache.invalidate(*wb_ids)  # 之后从归档表中读取
+    finally:
+        session.close()
+    return n_weibos
+
+
+def archive_inactive(model, archive_model, range_column, batch_size=10000):
+    '''归档状态为 False 的点赞或关注，按 range_column 的范围分批，返回归档的行数'''
+    session = Session()
+    n_rows = 0
+    try:
+        max_id = session.query(func.max(range_column)).scalar() or 0
+        for start in range(0, max_id + 1, batch_size):
+            condition = and_(range_column >= start, range_column < start + batch_size,
+                             model.status.is_(False))
+            n_rows += move(session, model, archive_model, condition)
+            session.commit()
+    finally:
+        session.close()
+    return n_rows
+
+
+def run(horizon_days=None):
+    '''执行一次归档'''
+    horizon_days = horizon_days or options.archive_horizon_days
+    result = {
+        'weibos': archive_weibos(horizon_days),
+        'likes': archive_inactive(Like, ArchivedLike, Like.wb_id),
+        'follows': archive_inactive(Follow, ArchivedFollow, Follow.follow_id),
+    }
+    if result['weibos']:
+        page_cache.invalidate('home')
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='把旧微博和已取消的点赞、关注移入归档表')
+    parser.add_argument('--db', default=models.DB_URL, help='数据库地址')
+    parser.add_argument('--horizon-days', type=int, default=365, help='发布超过多少天的微博移入归档表')
+    args = parser.parse_args(argv)
+
+    models.init_engine(args.db)
+    models.Base.metadata.create_all(checkfirst=True)  # 归档表
+    started = time.time()
+    result = run(args.horizon_days)
+    print('archived %(weibos)d weibos, %(likes)d likes, %(follows)d follows' % result,
+          'in %.1fs' % (time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""压力测试
+
+用 loader.py 生成指定规模的 SQLite 数据库，在当前进程中启动服务器，
+用并发的 HTTP 客户端逐个压测各个路由，统计延迟分位数、吞吐量和每个请求的 SQL 数量。
+结果保存为 JSON，可以与之前的结果对比。
+
+    python benchmark.py --weibos 10000
+    python benchmark.py --sweep 10000,100000,1000000,5000000 --output bench.json
+    python benchmark.py --weibos 10000 --baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import subprocess
+
+from sqlalchemy import event
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.testing import bind_unused_port
+from tornado.web import create_signed_value
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def routes(n_users, n_weibos):
+    '''压测的路由: (名称, 方法, URL 生成函数, 请求体生成函数)'''
+    rand_user = lambda: random.randint(1, n_users)
+    rand_weibo = lambda: random.randint(1, n_weibos)
+    return [
+        ('GET /', 'GET', lambda: '/', None),
+        ('GET /?page=N', 'GET', lambda: '/?page=%d' % random.randint(1, 100), None),
+        ('GET /weibo/show', 'GET', lambda: '/weibo/show?weibo_id=%d' % rand_weibo(), None),
+        ('GET /weibo/follow', 'GET', lambda: '/weibo/follow', None),
+        ('GET /user/fans', 'GET', lambda: '/user/fans', None),
+        ('GET /user/info', 'GET', lambda: '/user/info?user_id=%d' % rand_user(), None),
+        ('GET /weibo/like', 'GET', lambda: '/weibo/like?wb_id=%d' % rand_weibo(), None),
+        ('GET /user/follow', 'GET', lambda: '/user/follow?follow_id=%d' % rand_user(), None),
+        ('POST /comment/commit', 'POST', lambda: '/comment/commit',
+         lambda: 'content=benchmark&wb_id=%d' % rand_weibo()),
+    ]
+
+
+def prepare_database(args):
+    '''生成测试数据，已经生成过的数据库直接复用'''
+    import loader
+
+    db_path = os.path.join(args.data_dir, 'bench_%d.db' % args.weibos)
+    n_users = max(args.weibos // 5, 100)
+    loader.main([
+        '--db', 'sqlite:///' + db_path,
+        '--users', str(n_users),
+        '--weibos', str(args.weibos),
+        '--procs', str(args.procs),
+        '--checkpoint', db_path + '.checkpoint.json',
+    ])
+    return db_path, n_users
+
+
+async def run_route(client, base_url, method, make_url, make_body, n_requests, concurrency,
+                    auth_headers):
+    '''并发压测一个路由，返回每个请求的耗时'''
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            body = make_body() if make_body else None
+            headers = dict(auth_headers(), **({'Content-Type': 'application/x-www-form-urlencoded'}
+                                              if body else {}))
+            started = time.perf_counter()
+            response = await client.fetch(base_url + make_url(), method=method, body=body,
+                                          headers=headers, follow_redirects=False,
+                                          raise_error=False)
+            latencies.append(time.perf_counter() - started)
+            if response.code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(n_requests)])
+    return latencies, errors, time.perf_counter() - started
+
+
+def login_cookies(n_users, n_sessions=1000):
+    '''为随机的用户创建会话，返回签名后的 Cookie 请求头'''
+    import models
+    from sessions import session_store
+
+    db = models.Session()
+    try:
+        user_ids = random.sample(range(1, n_users + 1), min(n_users, n_sessions))
+        sids = [session_store.create(db, user_id) for user_id in user_ids]
+    finally:
+        db.close()
+    return ['sid=' + create_signed_value(options.cookie_secret, 'sid', sid).decode()
+            for sid in sids]
+
+
+async def run_benchmark(args, n_users):
+    import main
+    import models
+    import leaderboard
+    from events import event_bus
+
+    # 统计执行的 SQL 数量
+    n_queries = 0
+
+    def count_query(*_):
+        nonlocal n_queries
+        n_queries += 1
+    event.listen(models.engine, 'after_cursor_execute', count_query)
+
+    await models.run_in_db(leaderboard.reconcile)
+    event_bus.start()
+    options.rate_limit = False  # 所有请求来自同一个 IP，不限流
+
+    sock, port = bind_unused_port()
+    server = HTTPServer(main.make_app())
+    server.add_sockets([sock])
+    base_url = 'http://127.0.0.1:%d' % port
+
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    client = AsyncHTTPClient()
+    cookies = await models.run_in_db(login_cookies, n_users)
+    auth_headers = lambda: {'Cookie': random.choice(cookies)}
+
+    results = {}
+    for name, method, make_url, make_body in routes(n_users, args.weibos):
+        if args.routes and name not in args.routes:
+            continue
+        # 预热
+        await run_route(client, base_url, method, make_url, make_body,
+                        min(args.requests, 20), args.concurrency, auth_headers)
+
+        n_queries = 0
+        latencies, errors, elapsed = await run_route(client, base_url, method, make_url,
+                                                     make_body, args.requests,
+                                                     args.concurrency, auth_headers)
+        latencies.sort()
+        results[name] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+            'queries_per_request': n_queries / len(latencies) if latencies else 0.0,
+        }
+        print('%-22s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %8.1f req/s  %5.1f queries/req'
+              % (name, results[name]['p50_ms'], results[name]['p95_ms'],
+                 results[name]['p99_ms'], results[name]['throughput_rps'],
+                 results[name]['queries_per_request']))
+
+    server.stop()
+    client.close()
+    await event_bus.stop()
+    return results
+
+
+def run_single(args):
+    '''压测一种数据规模'''
+    import models
+
+    db_path, n_users = prepare_database(args)
+    models.init_engine('sqlite:///' + db_path, workers=args.db_workers)
+    return IOLoop.current().run_sync(lambda: run_benchmark(args, n_users))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    '''与之前保存的结果对比 p95 延迟和吞吐量'''
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    for size, routes_result in results.items():
+        old_routes = baseline.get(size, {})
+        for name, new in routes_result.items():
+            old = old_routes.get(name)
+            if old is None:
+                continue
+            print('%-8s %-22s p95 %8.2fms -> %8.2fms (%+.0f%%)   %8.1f -> %8.1f req/s'
+                  % (size, name, old['p95_ms'], new['p95_ms'],
+                     (new['p95_ms'] / old['p95_ms'] - 1) * 100 if old['p95_ms'] else 0,
+                     old['throughput_rps'], new['throughput_rps']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='压测各个路由')
+    parser.add_argument('--weibos', type=int, default=10000, help='数据库中的微博数量')
+    parser.add_argument('--sweep', default='', help='依次压测多种数据规模，如 10000,100000')
+    parser.add_argument('--requests', type=int, default=500, help='每个路由的请求数')
+    parser.add_argument('--concurrency', type=int, default=20, help='并发请求数')
+    parser.add_argument('--routes', nargs='*', help='只压测指定的路由，如 "GET /"')
+    parser.add_argument('--db-workers', type=int, default=10, help='执行数据库操作的线程数')
+    parser.add_argument('--procs', type=int, default=os.cpu_count(), help='生成数据的进程数')
+    parser.add_argument('--data-dir', default=os.path.join(BASE_DIR, 'bench_data'))
+    parser.add_argument('--output', default=None, help='结果保存的 JSON 文件')
+    parser.add_argument('--baseline', default=None, help='与之前保存的 JSON 结果对比')
+    args = parser.parse_args(argv)
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    if args.sweep:
+        # 每种规模在独立的进程中运行，避免缓存、连接池等全局状态互相影响
+        results = {}
+        for size in [int(n) for n in args.sweep.split(',')]:
+            print('==== %d weibos ====' % size)
+            part = os.path.join(args.data_dir, 'result_%d.json' % size)
+            cmd = [sys.executable, os.path.abspath(__file__), '--weibos', str(size),
+                   '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                   '--db-workers', str(args.db_workers), '--procs', str(args.procs),
+                   '--data-dir', args.data_dir, '--output', part]
+            if args.routes:
+                cmd += ['--routes'] + args.routes
+            subprocess.check_call(cmd)
+            with open(part) as f:
+                results.update(json.load(f)['results'])
+    else:
+        results = {str(args.weibos): run_single(args)}
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'time': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""实体缓存
+
+User、Weibo 的读穿透缓存 (read-through)：先查缓存，缺失的 ID 用一次 IN 查询补齐。
+缓存按 LRU + TTL 淘汰，条目数量有上限，写操作时需要显式失效。
+缓存中保存的是行对象 (见 rows.py)，不是 ORM 对象。
+微博在热表中不存在时，再从归档表中查找 (见 archive.py)。
+缺失的实体总是从主库加载：从库的数据可能落后于刚写回的计数，缓存之后要到过期才会更正。
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from models import User, Weibo, ArchivedWeibo
+from rows import user_row, weibo_row
+
+
+class LRUCache:
+    '''带过期时间的 LRU 缓存，线程安全'''
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size  # 最多保存的条目数
+        self.ttl = ttl            # 条目的有效期 (秒)
+        self._data = OrderedDict()  # {key: (expire_at, value)}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # 因容量不足被淘汰的条目数
+        self.expired = 0    # 因过期被丢弃的条目数
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._evict()
+
+    def get_many(self, keys):
+        '''批量读取，返回 {key: value}，只包含命中的条目'''
+        now = time.time()
+        result = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    self.misses += 1
+                elif item[0] < now:
+                    del self._data[key]
+                    self.expired += 1
+                    self.misses += 1
+                else:
+                    self._data.move_to_end(key)
+                    result[key] = item[1]
+                    self.hits += 1
+        return result
+
+    def set_many(self, items):
+        '''批量写入 {key: value}'''
+        expire_at = time.time() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (expire_at, value)
+                self._data.move_to_end(key)
+            self._evict()
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expired': self.expired,
+        }
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class EntityCache:
+    '''按主键缓存数据库中的实体'''
+
+    def __init__(self, model, make_row, fallback=None, max_size=10000, ttl=300):
+        self.model = model
+        self.make_row = make_row  # 将 ORM 对象转换为行对象
+        self.fallback = fallback  # 在 model 中找不到时，再查找的模型 (归档表)
+        self.lru = LRUCache(max_size, ttl)
+
+    def configure(self, max_size, ttl):
+        self.lru.configure(max_size, ttl)
+
+    def get(self, session, obj_id):
+        '''取出单个实体，不存在时返回 None'''
+        return self.get_many(session, [obj_id]).get(int(obj_id))
+
+    def peek(self, obj_id):
+        '''只从缓存中取出实体，未缓存时返回 None，不查询数据库'''
+        return self.lru.get_many([int(obj_id)]).get(int(obj_id))
+
+    def get_many(self, session, ids):
+        '''批量取出实体，返回 {id: obj}，数据库中不存在的 ID 不包含在结果中'''
+        ids = {int(i) for i in ids}
+        result = self.lru.get_many(ids)
+
+        missing = ids - result.keys()
+        for model in (self.model, self.fallback):
+            if not missing or model is None:
+                continue
+            with session.primary():
+                loaded = {obj.id: self.make_row(obj)
+                          for obj in session.query(model).filter(model.id.in_(missing))}
+            self.lru.set_many(loaded)
+            result.update(loaded)
+            missing -= loaded.keys()
+
+        return result
+
+    def invalidate(self, *ids):
+        self.lru.delete(*(int(i) for i in ids))
+
+    def stats(self):
+        return self.lru.stats()
+
+
+user_cache = EntityCache(User, user_row)
+weibo_cache = EntityCache(Weibo, weibo_row, fallback=ArchivedWeibo)
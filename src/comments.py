@@ -0,0 +1,82 @@
+"""评论树
+
+一次查询取出微博下的所有评论，在内存中根据 cmt_id 组装成树，再按楼层 (顶层评论) 分页。
+整个页面只需要固定数量的查询：评论一次，评论作者一次。
+"""
+
+from models import Comment, ArchivedComment
+from cache import user_cache
+from rows import comment_row
+
+
+class CommentNode:
+    '''评论树中的一个节点'''
+    __slots__ = ('comment', 'author', 'reply_to', 'depth', 'children')
+
+    def __init__(self, comment, author):
+        self.comment = comment    # 评论 (CommentRow)
+        self.author = author      # 评论的作者
+        self.reply_to = None      # 被回复的评论的作者，顶层评论为 None
+        self.depth = 0            # 在树中的层级，顶层评论为 0
+        self.children = []        # 回复当前评论的节点
+
+    def walk(self):
+        '''深度优先遍历当前节点及其所有回复 (不使用递归，回复链很长时也不会栈溢出)'''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+
+class CommentTree:
+    '''一条微博的评论树'''
+
+    def __init__(self, threads):
+        self.threads = threads  # 顶层评论，按时间降序
+
+    def page(self, page, per_page):
+        '''取出指定页的楼层，展开为 [node, ...] 列表，按层级排列'''
+        threads = self.threads[(page - 1) * per_page: page * per_page]
+        return [node for thread in threads for node in thread.walk()]
+
+    def n_pages(self, per_page):
+        return max(1, -(-len(self.threads) // per_page))
+
+
+def load_comment_tree(session, wb_id, archived=False):
+    '''取出微博的所有评论，组装成评论树
+
+    archived 为 True 时是已归档的微博，评论在归档表中 (归档之后发表的评论仍在热表中)
+    '''
+    comments = [comment_row(cmt) for cmt in session.query(Comment)
+                                                   .filter_by(wb_id=wb_id)
+                                                   .order_by(Comment.created.desc())]
+    if archived:
+        comments += [comment_row(cmt) for cmt in session.query(ArchivedComment).filter_by(wb_id=wb_id)]
+        comments.sort(key=lambda cmt: cmt.created, reverse=True)
+
+    # 一次取出所有评论的作者
+    authors = user_cache.get_many(session, {cmt.user_id for cmt in comments})
+
+    nodes = {cmt.id: CommentNode(cmt, authors.get(cmt.user_id)) for cmt in comments}
+
+    threads = []
+    for cmt in comments:
+        node = nodes[cmt.id]
+        parent = nodes.get(cmt.cmt_id)
+        if parent is None:
+            threads.append(node)  # 顶层评论，或者原评论已不存在
+        else:
+            node.reply_to = parent.author
+            parent.children.append(node)
+
+    # 楼层内的回复按时间升序显示
+    for node in nodes.values():
+        node.children.reverse()
+    for thread in threads:
+        for node in thread.walk():
+            for child in node.children:
+                child.depth = node.depth + 1  # 父节点总是先于子节点被遍历到
+
+    return CommentTree(threads)
@@ -0,0 +1,148 @@
+"""微博计数器
+
+点赞数、评论数冗余存储在 weibo 表的 like_count / comment_count 字段中。
+写操作只把增量记录在内存里，由后台任务定期批量写回数据库。
+已归档的微博 (见 archive.py) 不在 weibo 表中，计数写回 weibo_archive 表。
+增量来自事件总线的事件，写回时在同一个事务中标记这些事件，重放时不会重复计数；
+提交之后才确认这些事件，之前进程崩溃时事件留在发件箱中，重启后重放。
+"""
+
+import threading
+
+from sqlalchemy import bindparam, select
+
+from models import Session, Weibo, ArchivedWeibo
+from events import event_bus
+from cache import weibo_cache
+
+
+class CounterBuffer:
+    '''计数增量缓冲区'''
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size  # 每批 UPDATE 的行数
+        self._deltas = {}    # 等待写回的增量 {wb_id: [n_like, n_comment]}
+        self._flushing = {}  # 正在写回的增量
+        self._applied = []   # 增量来自的事件 [(订阅者的标记位, [outbox ID, ...]), ...]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时间只有一次写回
+
+    def add(self, wb_id, like=0, comment=0):
+        '''记录一条微博的计数变化'''
+        with self._lock:
+            delta = self._deltas.setdefault(wb_id, [0, 0])
+            delta[0] += like
+            delta[1] += comment
+
+    def applied(self, bit, outbox_ids):
+        '''记录已经计入缓冲区的事件，写回时在发件箱中标记，提交后确认'''
+        with self._lock:
+            self._applied.append((bit, outbox_ids))
+
+    def pending(self, wb_id):
+        '''尚未写回数据库的增量，返回 (n_like, n_comment)'''
+        with self._lock:
+            like, comment = self._deltas.get(wb_id, (0, 0))
+            f_like, f_comment = self._flushing.get(wb_id, (0, 0))
+        return like + f_like, comment + f_comment
+
+    def flush(self, wait=False):
+        '''将缓冲区中的增量批量写回数据库
+
+        上一次写回还没有结束时，定时任务直接跳过 (增量留到下次)；wait 为 True 时等待上一次结束
+        '''
+        if not self._flush_lock.acquire(blocking=wait):
+            return
+        try:
+            self._flush()
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self):
+        with self._lock:
+            if not self._deltas and not self._applied:
+                return
+            self._flushing, self._deltas = self._deltas, {}
+            applied, self._applied = self._applied, []
+
+        params = [{'_id': wb_id, '_like': like, '_comment': comment}
+                  for wb_id, (like, comment) in self._flushing.items()
+                  if like or comment]
+        stmt, archive_stmt = update_counts(Weibo.__table__), update_counts(ArchivedWeibo.__table__)
+        archive_ids = ArchivedWeibo.__table__.c.id
+
+        session = Session()
+        try:
+            for i in range(0, len(params), self.batch_size):
+                batch = params[i:i + self.batch_size]
+                session.execute(stmt, batch)  # executemany
+                # 已归档的微博，在热表中没有匹配的行
+                archived = {wb_id for (wb_id, ) in session.execute(
+                    select([archive_ids]).where(archive_ids.in_([p['_id'] for p in batch])))}
+                if archived:
+                    session.execute(archive_stmt, [p for p in batch if p['_id'] in archived])
+            for bit, outbox_ids in applied:
+                event_bus.mark_applied(session, bit, outbox_ids)
+            session.commit()
+        except Exception:
+            session.rollback()
+            # 写回失败时，把增量放回缓冲区，等待下次重试
+            with self._lock:
+                for wb_id, (like, comment) in self._flushing.items():
+                    delta = self._deltas.setdefault(wb_id, [0, 0])
+                    delta[0] += like
+                    delta[1] += comment
+                self._applied[:0] = applied
+            raise
+        finally:
+            session.close()
+            with self._lock:
+                flushed, self._flushing = self._flushing, {}
+            weibo_cache.invalidate(*flushed)  # 缓存中的计数已过期
+        for _, outbox_ids in applied:
+            event_bus.ack(outbox_ids)  # 已经提交，事件可以从发件箱中删除
+
+
+def update_counts(table):
+    '''按增量修改计数的 UPDATE 语句，用于 executemany'''
+    return table.update() \
+                .where(table.c.id == bindparam('_id')) \
+                .values(like_count=table.c.like_count + bindparam('_like'),
+                        comment_count=table.c.comment_count + bindparam('_comment'))
+
+
+def repair(batch_size=10000):
+    '''根据 like 表和评论表重建所有微博 (包括已归档的微博) 的计数
+
+    每张表只做一次 GROUP BY 扫描，先在内存中算出所有计数，
+    再只更新计数不一致的微博，分批用 executemany 写回，在同一个事务中提交，
+    重建期间页面上仍然显示原来的计数，不会短暂地变成 0
+    '''
+    session = Session()
+    try:
+        likes = {wb_id: n for wb_id, n in session.execute(
+            'SELECT wb_id, COUNT(1) FROM `like` WHERE status = 1 GROUP BY wb_id')}
+        comments = {}
+        # 归档微博的评论在 comment_archive 中，归档之后的新评论仍然写入 comment
+        for sql in ['SELECT wb_id, COUNT(1) FROM comment GROUP BY wb_id',
+                    'SELECT wb_id, COUNT(1) FROM comment_archive GROUP BY wb_id']:
+            for wb_id, n in session.execute(sql):
+                comments[wb_id] = comments.get(wb_id, 0) + n
+
+        for model in (Weibo, ArchivedWeibo):
+            table = model.__table__
+            stmt = table.update() \
+                        .where(table.c.id == bindparam('_id')) \
+                        .values(like_count=bindparam('_like'), comment_count=bindparam('_comment'))
+            query = select([table.c.id, table.c.like_count, table.c.comment_count])
+            rows = [{'_id': wb_id, '_like': likes.get(wb_id, 0), '_comment': comments.get(wb_id, 0)}
+                    for wb_id, n_like, n_comment in session.execute(query)
+                    if (n_like, n_comment) != (likes.get(wb_id, 0), comments.get(wb_id, 0))]
+            for i in range(0, len(rows), batch_size):
+                session.execute(stmt, rows[i:i + batch_size])
+        session.commit()
+    finally:
+        session.close()
+
+
+counter_buffer = CounterBuffer()
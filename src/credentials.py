@@ -0,0 +1,125 @@
+"""密码的存储与校验
+
+密码使用加盐的 scrypt 计算摘要，格式为 `scrypt$版本$n$r$p$盐$摘要`，参数变化时增加版本号。
+计算一次摘要大约需要 100ms 的 CPU 时间，放到进程池中执行，不阻塞 IOLoop，也能利用多核。
+
+早期版本的密码是不加盐的 sha256 (64 位十六进制)，登陆成功时自动换成新的格式。
+
+连续登陆失败的昵称会被暂时锁定，锁定期间直接拒绝，不查询数据库，也不计算摘要。
+"""
+
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+
+define('kdf_workers', default=None, type=int,
+       help='每个工作进程中计算密码摘要的进程数，默认为 CPU 核数除以工作进程数 (至少 1 个)')
+define('login_max_failures', default=5, type=int, help='锁定昵称前允许连续登陆失败的次数')
+define('login_lock_time', default=300, type=int, help='连续登陆失败后锁定的时间 (秒)')
+
+VERSION = 1
+SCRYPT_PARAMS = {1: dict(n=2 ** 14, r=8, p=1)}  # 各个版本的 scrypt 参数
+SALT_SIZE = 16
+
+_pool = None  # 进程池，第一次使用时创建 (必须在 fork 出工作进程之后)
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def make_hash(password):
+    '''计算新密码的摘要，在进程池中执行'''
+    params = SCRYPT_PARAMS[VERSION]
+    salt = os.urandom(SALT_SIZE)
+    digest = hashlib.scrypt(password.encode('utf8'), salt=salt, **params)
+    return 'scrypt$%d$%d$%d$%d$%s$%s' % (VERSION, params['n'], params['r'], params['p'],
+                                         _b64encode(salt), _b64encode(digest))
+
+
+def check_hash(password, stored):
+    '''校验密码，在进程池中执行
+
+    返回 (是否正确, 新的摘要)，密码正确但摘要格式过时时返回新的摘要，否则为 None
+    '''
+    if stored.startswith('scrypt$'):
+        _, version, n, r, p, salt, digest = stored.split('$')
+        computed = hashlib.scrypt(password.encode('utf8'), salt=base64.b64decode(salt),
+                                  n=int(n), r=int(r), p=int(p))
+        ok = hmac.compare_digest(computed, base64.b64decode(digest))
+        outdated = int(version) != VERSION
+    else:
+        # 早期版本: 不加盐的 sha256
+        computed = hashlib.sha256(password.encode('utf8')).hexdigest()
+        ok = hmac.compare_digest(computed, stored)
+        outdated = True
+    return ok, (make_hash(password) if ok and outdated else None)
+
+
+def kdf_workers():
+    '''每个工作进程的进程池大小，所有工作进程合计不超过 CPU 核数'''
+    if options.kdf_workers:
+        return options.kdf_workers
+    cpus = os.cpu_count() or 1
+    processes = (options.processes if 'processes' in options else 1) or cpus  # 0 代表与 CPU 核数相同
+    return max(1, cpus // processes)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # 服务器进程中有多个线程，使用 spawn 创建子进程更安全
+        _pool = ProcessPoolExecutor(kdf_workers(), mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def hash_password(password):
+    '''计算密码的摘要，返回可以 await 的 Future'''
+    return IOLoop.current().run_in_executor(get_pool(), make_hash, password)
+
+
+def check_password(password, stored):
+    '''校验密码，返回可以 await 的 Future，结果为 (是否正确, 新的摘要)'''
+    return IOLoop.current().run_in_executor(get_pool(), check_hash, password, stored)
+
+
+class LoginThrottle:
+    '''记录连续登陆失败的昵称，数量有上限，超出时淘汰最早的记录'''
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._failures = OrderedDict()  # {昵称: (连续失败次数, 最后一次失败的时间)}
+        self._lock = threading.Lock()
+
+    def is_locked(self, nickname):
+        with self._lock:
+            count, last = self._failures.get(nickname, (0, 0))
+            if time.time() - last >= options.login_lock_time:
+                self._failures.pop(nickname, None)  # 已过期
+                return False
+            return count >= options.login_max_failures
+
+    def fail(self, nickname):
+        with self._lock:
+            count, last = self._failures.pop(nickname, (0, 0))
+            if time.time() - last >= options.login_lock_time:
+                count = 0
+            self._failures[nickname] = (count + 1, time.time())
+            while len(self._failures) > self.max_size:
+                self._failures.popitem(last=False)
+
+    def reset(self, nickname):
+        with self._lock:
+            self._failures.pop(nickname, None)
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,286 @@
+"""进程内的事件总线
+
+写操作提交后产生的副作用 (计数、缓存失效、时间线推送、搜索索引等) 由订阅者异步处理，
+不增加用户等待的时间：
+
+    * 视图在数据库会话中调用 emit() 记录事件，事件写入 event_outbox 表，与业务数据在同一个事务中提交
+    * 会话提交后，事件被放入每个订阅者的队列 (有长度上限的 asyncio.Queue)
+    * 订阅者在 IOLoop 中批量取出事件，交给线程池处理
+    * 所有订阅者都处理完的事件，由后台任务从 event_outbox 中批量删除
+    * 处理失败的一批事件重试 --event_retries 次，仍然失败时不删除，留在 event_outbox 中
+    * 进程崩溃时 event_outbox 中未删除的事件 (以及处理失败的事件)，在同一编号的工作进程重启后重放
+
+重放是至少一次的，副作用不幂等的订阅者 (计数、通知) 用 once=True 订阅：处理结果与
+event_outbox 中该订阅者的标记位 (applied) 在同一个事务中提交，重放时跳过已标记的事件。
+处理结果先放在内存缓冲区中的订阅者 (计数) 再加上 buffered=True：处理函数返回时不确认，
+由缓冲区提交之后调用 ack()，在此之前事件不会从 event_outbox 中删除。
+
+订阅者的处理速度跟不上时，写操作的视图在 backpressure() 中等待队列回落。
+"""
+
+import json
+import time
+import asyncio
+import logging
+import datetime
+import threading
+import contextvars
+from collections import namedtuple
+
+from sqlalchemy import event, inspect
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+
+from models import Session, OutboxEvent, run_in_db
+
+define('event_queue_size', default=10000, type=int, help='每个订阅者的事件队列长度上限')
+define('event_batch_size', default=100, type=int, help='订阅者每次处理的最多事件数')
+define('event_ack_interval', default=1000, type=int, help='删除已处理事件的间隔 (毫秒)')
+define('event_retries', default=3, type=int, help='订阅者处理失败时的重试次数')
+
+logger = logging.getLogger('tornado.general')
+
+# ---- 事件类型 ----
+WeiboPosted = namedtuple('WeiboPosted', 'wb_id user_id')                  # 发布微博
+CommentPosted = namedtuple('CommentPosted', 'comment_id wb_id user_id cmt_id')  # 发表评论或回复
+LikeChanged = namedtuple('LikeChanged', 'user_id wb_id status')           # 点赞 / 取消点赞
+FollowChanged = namedtuple('FollowChanged', 'user_id follow_id status')   # 关注 / 取消关注
+
+EVENT_TYPES = {cls.__name__: cls for cls in (WeiboPosted, CommentPosted, LikeChanged, FollowChanged)}
+
+# 订阅者正在处理的一批事件 (订阅者的标记位, [outbox ID, ...])，由 EventBus.current_batch() 读取
+_batch = contextvars.ContextVar('event_batch', default=(0, []))
+
+
+def emit(session, evt):
+    '''在数据库会话中记录一个事件，会话提交后分发给订阅者'''
+    row = OutboxEvent(owner=event_bus.owner, kind=type(evt).__name__,
+                      payload=json.dumps(evt._asdict()), created=datetime.datetime.now())
+    session.add(row)
+    session.info.setdefault('events', []).append((row, evt))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    emitted = session.info.pop('events', None)
+    if emitted:
+        event_bus.dispatch_threadsafe([(inspect(row).identity[0], evt, 0) for row, evt in emitted])
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('events', None)
+
+
+class Subscriber:
+    '''一个订阅者及其事件队列'''
+
+    def __init__(self, name, types, handler, bit, once, buffered):
+        self.name = name
+        self.types = set(types)  # 订阅的事件类型
+        self.handler = handler   # handler(events)，在线程池中执行
+        self.bit = bit           # 在 OutboxEvent.applied 中的标记位
+        self.once = once         # 重放时跳过已标记的事件
+        self.buffered = buffered  # 处理成功后由订阅者自己调用 ack()
+        self.queue = None        # [(outbox ID, 事件, 入队时间), ...]
+        self.processed = 0
+        self.errors = 0          # 处理失败的次数 (包括重试)
+        self.failed = 0          # 重试之后仍然失败、留在发件箱中的事件数
+        self.lag = 0.0           # 最近一批事件从入队到开始处理的等待时间
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize() if self.queue else 0,
+            'processed': self.processed,
+            'errors': self.errors,
+            'failed': self.failed,
+            'lag_ms': self.lag * 1000,
+        }
+
+
+class EventBus:
+    '''事件总线'''
+
+    def __init__(self):
+        self.owner = 0            # 工作进程编号
+        self.subscribers = []
+        self.io_loop = None
+        self._remaining = {}      # {outbox ID: 尚未处理完的订阅者数量}
+        self._acked = []          # 所有订阅者都已处理完，等待删除的 outbox ID
+        self._failed = set()      # 有订阅者处理失败的 outbox ID，处理完之后不删除
+        self._drained = None      # 队列回落到一半以下时置位
+        self._tasks = []          # 订阅者的处理循环
+        self._lock = threading.Lock()
+
+    def subscribe(self, name, types, handler, once=False, buffered=False):
+        '''添加订阅者
+
+        once 为 True 时处理函数需要在提交结果的事务中调用 mark_applied()；
+        buffered 为 True 时处理函数只把结果放入缓冲区，提交之后调用 ack()
+        '''
+        bit = 1 << len(self.subscribers)
+        self.subscribers.append(Subscriber(name, types, handler, bit, once, buffered))
+
+    def current_batch(self):
+        '''在订阅者的处理函数中调用，返回正在处理的这批事件 (标记位, [outbox ID, ...])'''
+        return _batch.get()
+
+    def mark_applied(self, session, bit, outbox_ids):
+        '''在发件箱中标记订阅者已经处理过这些事件，随 session 的事务一起提交'''
+        for i in range(0, len(outbox_ids), 1000):
+            session.query(OutboxEvent) \
+                   .filter(OutboxEvent.id.in_(outbox_ids[i:i + 1000])) \
+                   .update({OutboxEvent.applied: OutboxEvent.applied.op('|')(bit)},
+                           synchronize_session=False)
+
+    def start(self, owner=0):
+        '''在 IOLoop 中启动所有订阅者'''
+        self.owner = owner
+        self.io_loop = IOLoop.current()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        for sub in self.subscribers:
+            sub.queue = asyncio.Queue(options.event_queue_size)
+            self._tasks.append(asyncio.ensure_future(self._consume(sub)))
+
+    async def stop(self):
+        '''停止所有订阅者，未处理的事件留在发件箱中'''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.io_loop = None
+
+    def depth(self):
+        return max((sub.queue.qsize() for sub in self.subscribers if sub.queue), default=0)
+
+    async def backpressure(self):
+        '''订阅者积压过多时，等待队列回落'''
+        while self.io_loop is not None and self.depth() >= options.event_queue_size // 2:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def dispatch_threadsafe(self, items):
+        '''在任意线程中分发事件 [(outbox ID, 事件, 已处理过的订阅者的标记位), ...]'''
+        if self.io_loop is None:
+            return  # 总线没有启动，事件留在发件箱中，由下次启动的进程重放
+        self.io_loop.add_callback(self.dispatch, items)
+
+    async def dispatch(self, items):
+        now = time.time()
+        for outbox_id, evt, applied in items:
+            targets = [sub for sub in self.subscribers
+                       if type(evt) in sub.types and not (sub.once and applied & sub.bit)]
+            if not targets:
+                self._ack(outbox_id)
+                continue
+            with self._lock:
+                self._remaining[outbox_id] = len(targets)
+            for sub in targets:
+                await sub.queue.put((outbox_id, evt, now))  # 队列满时等待
+
+    async def _consume(self, sub):
+        '''订阅者的处理循环：批量取出事件，在线程池中处理'''
+        while True:
+            batch = [await sub.queue.get()]
+            while len(batch) < options.event_batch_size and not sub.queue.empty():
+                batch.append(sub.queue.get_nowait())
+            sub.lag = time.time() - batch[0][2]
+            ok = await self._handle(sub, batch)
+            if not ok or not sub.buffered:
+                for outbox_id, _, _ in batch:
+                    self._ack(outbox_id, ok)
+            if self.depth() < options.event_queue_size // 4:
+                self._drained.set()
+
+    async def _handle(self, sub, batch):
+        '''处理一批事件，失败时重试，返回是否成功'''
+        _batch.set((sub.bit, [outbox_id for outbox_id, _, _ in batch]))
+        events = [evt for _, evt, _ in batch]
+        for attempt in range(options.event_retries + 1):
+            try:
+                await run_in_db(sub.handler, events)
+                sub.processed += len(batch)
+                return True
+            except Exception:
+                sub.errors += 1
+                logger.exception('event subscriber %s failed (attempt %d)', sub.name, attempt + 1)
+                if attempt < options.event_retries:
+                    await asyncio.sleep(0.1 * 2 ** attempt)
+        sub.failed += len(batch)
+        return False
+
+    def ack(self, outbox_ids):
+        '''buffered 订阅者的结果提交之后，确认这些事件已经处理完，可以在任意线程中调用'''
+        for outbox_id in outbox_ids:
+            self._ack(outbox_id)
+
+    def _ack(self, outbox_id, ok=True):
+        with self._lock:
+            if not ok:
+                self._failed.add(outbox_id)
+            n = self._remaining.pop(outbox_id, 1) - 1
+            if n > 0:
+                self._remaining[outbox_id] = n
+            elif outbox_id in self._failed:
+                self._failed.discard(outbox_id)  # 留在发件箱中，下次启动时重放
+            else:
+                self._acked.append(outbox_id)
+
+    def flush_acks(self):
+        '''删除已处理完的事件，在线程池中执行'''
+        with self._lock:
+            acked, self._acked = self._acked, []
+        if not acked:
+            return
+        session = Session()
+        try:
+            for i in range(0, len(acked), 1000):
+                session.query(OutboxEvent) \
+                       .filter(OutboxEvent.id.in_(acked[i:i + 1000])) \
+                       .delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            with self._lock:
+                self._acked.extend(acked)
+            raise
+        finally:
+            session.close()
+
+    def load_unfinished(self, before):
+        '''取出本编号的工作进程在 before 之前写入、尚未处理完的事件'''
+        session = Session()
+        try:
+            rows = session.query(OutboxEvent.id, OutboxEvent.kind, OutboxEvent.payload,
+                                 OutboxEvent.applied) \
+                          .filter(OutboxEvent.owner == self.owner,
+                                  OutboxEvent.created < before) \
+                          .order_by(OutboxEvent.id) \
+                          .all()
+        finally:
+            session.close()
+        return [(outbox_id, EVENT_TYPES[kind](**json.loads(payload)), applied)
+                for outbox_id, kind, payload, applied in rows if kind in EVENT_TYPES]
+
+    async def replay(self, before):
+        '''重放上一个进程遗留的事件'''
+        items = await run_in_db(self.load_unfinished, before)
+        if items:
+            logger.info('replaying %d events from the outbox', len(items))
+            await self.dispatch(items)
+
+    async def drain(self, timeout):
+        '''等待所有队列处理完，退出前调用'''
+        deadline = time.time() + timeout
+        while time.time() < deadline and (self.depth() or self._remaining):
+            await asyncio.sleep(0.05)
+
+    def stats(self):
+        return {
+            'subscribers': {sub.name: sub.stats() for sub in self.subscribers},
+            'unfinished': len(self._remaining),
+            'pending_acks': len(self._acked),
+        }
+
+
+event_bus = EventBus()
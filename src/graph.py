@@ -0,0 +1,179 @@
+"""关注关系图
+
+每个用户的粉丝、关注的人分别保存为有序的 int 数组 (array('i'))，
+第一次用到时从 Follow 表中加载，之后在关注 / 取消关注时同步修改，不再扫描 Follow 表。
+内存中的用户数量超过上限时，淘汰最久未使用的数组。
+只有写入关注关系的进程能同步修改，其他进程的数组在 --graph_ttl 秒后过期，重新加载。
+修改时复制出新的数组再替换 (copy-on-write)，读取者拿到的数组不会在遍历过程中变化。
+数组从主库加载，缓存期间不会停留在从库延迟时的旧数据上。
+
+有序数组比 set 节省大量内存，判断关注关系用二分查找 (O(log n))，
+求两个用户关系的交集用归并 (O(m + n))。
+"""
+
+import time
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from sqlalchemy import func
+from tornado.options import define, options
+
+from models import Follow
+
+define('graph_users', default=200000, type=int, help='内存中最多保留的关注关系数组数量')
+define('graph_ttl', default=60, type=int, help='关注关系数组的有效期 (秒)，多进程时其他进程的修改在过期后可见')
+
+FOLLOWERS = 'followers'  # 粉丝
+FOLLOWING = 'following'  # 关注的人
+
+
+def contains(ids, value):
+    '''有序数组中是否存在 value'''
+    idx = bisect_left(ids, value)
+    return idx < len(ids) and ids[idx] == value
+
+
+def intersect(a, b):
+    '''两个有序数组的交集'''
+    result = array('i')
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+class SocialGraph:
+    '''用户之间的关注关系'''
+
+    def __init__(self, max_users=None):
+        self.max_users = max_users  # 为 None 时使用 --graph_users 的配置
+        self._ids = OrderedDict()   # {(FOLLOWERS / FOLLOWING, user_id): (array('i'), 过期时间)}
+        self._loading = {}          # 正在加载的数组 {key: 加载期间是否有改动}
+        self._lock = threading.Lock()
+
+    def followers(self, session, user_id):
+        '''粉丝 ID 的有序数组'''
+        return self._get(session, FOLLOWERS, int(user_id))
+
+    def following(self, session, user_id):
+        '''关注的人 ID 的有序数组'''
+        return self._get(session, FOLLOWING, int(user_id))
+
+    def is_following(self, session, user_id, follow_id):
+        '''user_id 是否关注了 follow_id'''
+        return contains(self.following(session, user_id), int(follow_id))
+
+    def mutual(self, session, user_id):
+        '''互相关注的用户'''
+        return intersect(self.following(session, user_id), self.followers(session, user_id))
+
+    def followed_by_following(self, session, user_id, other_id):
+        '''user_id 关注的人中，同样关注了 other_id 的用户'''
+        return intersect(self.following(session, user_id), self.followers(session, other_id))
+
+    def follower_counts(self, session, user_ids):
+        '''批量取出粉丝数 {user_id: n}'''
+        return self._counts(session, FOLLOWERS, user_ids)
+
+    def following_counts(self, session, user_ids):
+        '''批量取出关注的人数 {user_id: n}'''
+        return self._counts(session, FOLLOWING, user_ids)
+
+    def follow(self, user_id, follow_id):
+        '''关注之后同步修改已加载的数组'''
+        with self._lock:
+            self._insert((FOLLOWING, user_id), follow_id)
+            self._insert((FOLLOWERS, follow_id), user_id)
+
+    def unfollow(self, user_id, follow_id):
+        '''取消关注之后同步修改已加载的数组'''
+        with self._lock:
+            self._remove((FOLLOWING, user_id), follow_id)
+            self._remove((FOLLOWERS, follow_id), user_id)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def _get(self, session, kind, user_id):
+        key = (kind, user_id)
+        with self._lock:
+            entry = self._ids.get(key)
+            if entry is not None and entry[1] > time.time():
+                self._ids.move_to_end(key)
+                return entry[0]
+            self._loading[key] = False
+
+        if kind == FOLLOWERS:
+            query = session.query(Follow.user_id).filter_by(follow_id=user_id, status=True)
+        else:
+            query = session.query(Follow.follow_id).filter_by(user_id=user_id, status=True)
+        with session.primary():
+            ids = array('i', sorted(uid for (uid, ) in query))
+
+        with self._lock:
+            # 加载期间关系有变化时不缓存，下次重新加载
+            if not self._loading.pop(key, True):
+                self._ids[key] = (ids, time.time() + options.graph_ttl)
+                self._ids.move_to_end(key)
+                max_users = self.max_users or options.graph_users
+                while len(self._ids) > max_users:
+                    self._ids.popitem(last=False)
+        return ids
+
+    def _counts(self, session, kind, user_ids):
+        '''已加载的数组直接取长度，其余的用一次 GROUP BY 查询，不加载数组'''
+        result, missing = {}, []
+        now = time.time()
+        with self._lock:
+            for user_id in map(int, user_ids):
+                entry = self._ids.get((kind, user_id))
+                if entry is not None and entry[1] > now:
+                    result[user_id] = len(entry[0])
+                else:
+                    missing.append(user_id)
+
+        if missing:
+            column = Follow.follow_id if kind == FOLLOWERS else Follow.user_id
+            query = session.query(column, func.count(1)) \
+                           .filter(column.in_(missing), Follow.status.is_(True)) \
+                           .group_by(column)
+            with session.primary():  # 与从主库加载的数组一致
+                counts = dict(query)
+            result.update((user_id, counts.get(user_id, 0)) for user_id in missing)
+        return result
+
+    def _insert(self, key, value):
+        if key in self._loading:
+            self._loading[key] = True  # 正在 (重新) 加载，加载的结果不再缓存
+        entry = self._ids.get(key)
+        if entry is None:
+            return
+        ids, expires = entry
+        idx = bisect_left(ids, value)
+        if idx == len(ids) or ids[idx] != value:
+            # 不修改原来的数组，其他线程可能正在读取
+            self._ids[key] = (ids[:idx] + array('i', [value]) + ids[idx:], expires)
+
+    def _remove(self, key, value):
+        if key in self._loading:
+            self._loading[key] = True  # 正在 (重新) 加载，加载的结果不再缓存
+        entry = self._ids.get(key)
+        if entry is None:
+            return
+        ids, expires = entry
+        idx = bisect_left(ids, value)
+        if idx < len(ids) and ids[idx] == value:
+            self._ids[key] = (ids[:idx] + ids[idx + 1:], expires)
+
+
+graph = SocialGraph()
@@ -1,5 +1,7 @@
 """创建初始化数据脚本"""
 
-from models import Base
+from models import Base, init_engine
+
+init_engine()
 
 Base.metadata.create_all(checkfirst=True)  # 创建表
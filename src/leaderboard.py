@@ -0,0 +1,146 @@
+"""热门微博排行榜
+
+在内存中维护每条微博的点赞数，以及一个有界的 Top-N 榜单。
+点赞 / 取消点赞时原地更新，页面渲染时直接读取快照，不再访问数据库。
+"""
+
+import threading
+
+from sqlalchemy import func
+
+from models import Session, Weibo, Like
+from counters import counter_buffer
+from cache import weibo_cache
+
+
+class Leaderboard:
+    '''热门微博排行榜
+
+    _board 中保存的候选数量多于展示数量 (size * buffer_ratio)，
+    这样榜单中的微博被取消点赞时，后面的候选可以直接补位。
+    不在候选中的微博如果因此超过了榜单中的微博，由定期对账修正。
+    访问数据库 (加载点赞数、微博内容) 时不持有锁，不会让其他线程等待数据库。
+    '''
+
+    def __init__(self, size=10, buffer_ratio=5):
+        self.size = size                       # 对外展示的数量
+        self.capacity = size * buffer_ratio    # 内存中保留的候选数量
+
+        self._counts = {}     # 已知的点赞数 {wb_id: n_like}
+        self._contents = {}   # 候选微博的内容 {wb_id: content}
+        self._board = []      # 候选榜单 [(n_like, wb_id), ...]，按点赞数降序
+        self._snapshot = ()   # 展示用的结果 ((wb_id, content, n_like), ...)
+        self._lock = threading.Lock()
+
+    def top(self):
+        '''获取当前榜单，O(1)'''
+        return self._snapshot
+
+    def incr(self, wb_id, delta=1):
+        '''点赞数变化时更新榜单，delta 为点赞数的增量'''
+        with self._lock:
+            known = wb_id in self._counts
+            if known:
+                self._counts[wb_id] += delta
+        if not known:
+            # 第一次见到这条微博，在锁外从数据库中加载点赞数 (此时已经包含了本次的变化)
+            n_like = count_likes(wb_id)
+            with self._lock:
+                self._counts.setdefault(wb_id, n_like)  # 加载期间可能已经由对账载入
+        with self._lock:
+            self._update(wb_id)
+            missing = self._missing()
+        self._fill(missing)
+
+    def load(self, rows, contents):
+        '''用对账结果整体替换榜单
+
+        rows: [(wb_id, n_like), ...]
+        contents: {wb_id: content}
+        '''
+        with self._lock:
+            self._counts = dict(rows)
+            self._contents = dict(contents)
+            self._board = sorted(((n, wb_id) for wb_id, n in rows), reverse=True)
+            del self._board[self.capacity:]
+            self._refresh()
+            missing = self._missing()
+        self._fill(missing)
+
+    def _update(self, wb_id):
+        '''单条微博的点赞数变化后，调整候选榜单'''
+        n_like = self._counts[wb_id]
+        board = [item for item in self._board if item[1] != wb_id]
+        in_board = len(board) != len(self._board)
+
+        if n_like > 0 and (in_board or len(board) < self.capacity or n_like > board[-1][0]):
+            board.append((n_like, wb_id))
+            board.sort(reverse=True)
+            for _, dropped_id in board[self.capacity:]:
+                self._contents.pop(dropped_id, None)
+            del board[self.capacity:]
+        else:
+            self._contents.pop(wb_id, None)
+
+        self._board = board
+        self._refresh()
+
+    def _refresh(self):
+        '''重新生成展示用的快照，内容尚未加载的微博暂时显示为空'''
+        self._snapshot = tuple((wb_id, self._contents.get(wb_id, ''), n_like)
+                               for n_like, wb_id in self._board[:self.size])
+
+    def _missing(self):
+        '''榜单中内容尚未加载的微博'''
+        return [wb_id for _, wb_id in self._board[:self.size] if wb_id not in self._contents]
+
+    def _fill(self, missing):
+        '''在锁外加载微博内容，再更新快照'''
+        if not missing:
+            return
+        contents = load_contents(missing)
+        with self._lock:
+            in_board = {wb_id for _, wb_id in self._board}
+            self._contents.update((wb_id, content) for wb_id, content in contents.items()
+                                  if wb_id in in_board)
+            self._refresh()
+
+
+def count_likes(wb_id):
+    '''取出单条微博的点赞数 (数据库中的计数 + 尚未写回的增量)'''
+    session = Session()  # 与写回的计数对应，读取主库
+    try:
+        n_like = session.query(Weibo.like_count).filter_by(id=wb_id).scalar() or 0
+    finally:
+        session.close()
+    return n_like + counter_buffer.pending(wb_id)[0]
+
+
+def load_contents(wb_id_list):
+    '''根据微博 ID 取出微博内容'''
+    session = Session(use_replica=True)
+    try:
+        weibos = weibo_cache.get_many(session, wb_id_list)
+    finally:
+        session.close()
+    return {wb_id: wb.content for wb_id, wb in weibos.items()}
+
+
+def reconcile():
+    '''与 Like 表对账，重建排行榜'''
+    session = Session(use_replica=True)
+    try:
+        rows = session.query(Like.wb_id, func.count(1)) \
+                      .filter(Like.status.is_(True)) \
+                      .group_by(Like.wb_id) \
+                      .order_by(func.count(1).desc()) \
+                      .limit(leaderboard.capacity) \
+                      .all()
+    finally:
+        session.close()
+
+    contents = load_contents([wb_id for wb_id, _ in rows[:leaderboard.size]])
+    leaderboard.load(rows, contents)
+
+
+leaderboard = Leaderboard()
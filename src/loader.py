@@ -0,0 +1,250 @@
+"""批量数据导入
+
+多个进程并行生成数据 (元组)，主进程按批次用 executemany 写入数据库，
+MySQL 下也可以写成 CSV 后用 LOAD DATA LOCAL INFILE 导入。
+点赞、关注、评论的数据按 Zipf 分布生成，少数热门微博 / 热门用户占据大部分流量。
+
+每写完一批都会记录进度，中断后使用相同的参数重新执行即可从断点继续。
+
+    python loader.py --db sqlite:///weibo.db --users 100000 --weibos 500000
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import random
+import string
+import argparse
+import datetime
+import tempfile
+from multiprocessing import Pool
+
+from sqlalchemy.engine.url import make_url
+
+import models
+import counters
+
+citys = ['北京', '上海', '广州', '深圳', '大连', '沈阳', '保定', '济南', '武汉',
+         '郑州', '长沙', '贵州', '成都', '重庆', '苏州', '合肥', '西安', '兰州']
+
+START_TIME = datetime.datetime(2010, 1, 1)
+TIME_SPAN = int((datetime.datetime(2020, 1, 1) - START_TIME).total_seconds())
+
+# 各表的导入顺序及字段
+TABLES = [
+    ('user', ('id', 'nickname', 'password', 'gender', 'city', 'bio')),
+    ('weibo', ('id', 'user_id', 'content', 'created')),
+    ('follow', ('user_id', 'follow_id', 'status', 'created')),
+    ('like', ('wb_id', 'user_id', 'status', 'created')),
+    ('comment', ('id', 'user_id', 'wb_id', 'cmt_id', 'content', 'created')),
+]
+
+
+class Zipf:
+    '''在 [1, n] 中按 Zipf 分布取值，热门程度与排名的 s 次方成反比
+
+    使用连续近似的逆变换采样，不需要预先计算累积分布表；
+    排名再经过一个乘法置换映射为 ID，避免热门数据都集中在最小的 ID 上。
+    '''
+
+    def __init__(self, n, s=1.1):
+        self.n = n
+        self.s = s
+        self._stride = self._coprime_stride(n)
+
+    def sample(self, rng):
+        u = rng.random()
+        if self.s == 1:
+            rank = math.exp(u * math.log(self.n))
+        else:
+            a = 1 - self.s
+            rank = ((self.n ** a - 1) * u + 1) ** (1 / a)
+        rank = min(int(rank), self.n) - 1
+        return rank * self._stride % self.n + 1
+
+    @staticmethod
+    def _coprime_stride(n):
+        stride = int(n * 0.618) | 1
+        while math.gcd(stride, n) != 1:
+            stride += 2
+        return stride
+
+
+def gen_name(rng, user_id):
+    if rng.choice([0, 1]):
+        m = rng.randint(5, 12)
+        n = rng.randrange(2, m - 1)
+        chars = rng.sample(string.ascii_lowercase * 2, m)
+        name = '%s %s' % (''.join(chars[:n]), ''.join(chars[n:]))
+        name = name.title()
+    else:
+        codes = rng.sample(range(20000, 40000), rng.randint(3, 5))
+        name = ''.join([chr(c) for c in codes])
+    return '%s%d' % (name, user_id)  # 加上 ID 保证昵称唯一
+
+
+def gen_time(rng):
+    return START_TIME + datetime.timedelta(seconds=rng.randrange(TIME_SPAN))
+
+
+def gen_chunk(task):
+    '''生成一批数据，在子进程中执行。相同的参数总是生成相同的数据'''
+    table, chunk, size, total, params = task
+    rng = random.Random('%s-%s-%s' % (params['seed'], table, chunk))
+    start = chunk * size
+    stop = min(start + size, total)
+    n_users, n_weibos = params['users'], params['weibos']
+    hot_users, hot_weibos = Zipf(n_users, params['skew']), Zipf(n_weibos, params['skew'])
+
+    rows = []
+    if table == 'user':
+        for i in range(start + 1, stop + 1):
+            rows.append((i, gen_name(rng, i), '123', rng.choice(['male', 'female']),
+                         rng.choice(citys), '... ...'))
+    elif table == 'weibo':
+        for i in range(start + 1, stop + 1):
+            content = ''.join(rng.sample(string.ascii_letters * 10, 140))
+            rows.append((i, hot_users.sample(rng), content, gen_time(rng)))
+    elif table == 'follow':
+        for _ in range(start, stop):
+            # 粉丝随机，被关注者集中在少数大 V 上
+            rows.append((rng.randint(1, n_users), hot_users.sample(rng), True, gen_time(rng)))
+    elif table == 'like':
+        for _ in range(start, stop):
+            rows.append((hot_weibos.sample(rng), rng.randint(1, n_users),
+                         rng.random() > 0.1, gen_time(rng)))
+    elif table == 'comment':
+        replies = {}  # 本批次中每条微博已有的评论 {wb_id: [cmt_id, ...]}
+        for i in range(start + 1, stop + 1):
+            wb_id = hot_weibos.sample(rng)
+            earlier = replies.setdefault(wb_id, [])
+            cmt_id = rng.choice(earlier) if earlier and rng.random() < 0.3 else 0
+            earlier.append(i)
+            content = ''.join(rng.sample(string.ascii_letters * 4, rng.randint(10, 60)))
+            rows.append((i, rng.randint(1, n_users), wb_id, cmt_id, content, gen_time(rng)))
+    return rows
+
+
+class Checkpoint:
+    '''导入进度，保存在 JSON 文件中'''
+
+    def __init__(self, path, params):
+        self.path = path
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['params'] != params:
+                raise SystemExit('checkpoint %s was created with different parameters' % path)
+            self.done = saved['done']
+        self.params = params
+
+    def save(self, table, n_chunks):
+        self.done[table] = n_chunks
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'params': self.params, 'done': self.done}, f)
+            os.replace(tmp, self.path)
+
+
+def insert_rows(conn, table, columns, rows):
+    '''用 executemany 写入一批数据，主键冲突的行直接忽略'''
+    stmt = table.insert() \
+                .prefix_with('IGNORE', dialect='mysql') \
+                .prefix_with('OR IGNORE', dialect='sqlite')
+    conn.execute(stmt, [dict(zip(columns, row)) for row in rows])
+
+
+def load_data_infile(conn, table, columns, rows):
+    '''写成 CSV 文件后用 LOAD DATA LOCAL INFILE 导入 (仅 MySQL)'''
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for row in rows:
+            writer.writerow([int(v) if isinstance(v, bool) else v for v in row])
+    try:
+        conn.execute(
+            "LOAD DATA LOCAL INFILE '%s' IGNORE INTO TABLE `%s` CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+            "LINES TERMINATED BY '\\n' (%s)"
+            % (f.name, table.name, ', '.join('`%s`' % col for col in columns))
+        )
+    finally:
+        os.remove(f.name)
+
+
+def load_table(pool, name, columns, total, args, checkpoint):
+    '''并行生成并导入一张表的数据'''
+    table = models.Base.metadata.tables[name]
+    n_chunks = math.ceil(total / args.batch)
+    start_chunk = checkpoint.done.get(name, 0)
+    if start_chunk >= n_chunks:
+        print('%-8s already loaded' % name)
+        return
+
+    use_infile = args.load_data and models.engine.dialect.name == 'mysql'
+    write = load_data_infile if use_infile else insert_rows
+    tasks = [(name, chunk, args.batch, total, checkpoint.params)
+             for chunk in range(start_chunk, n_chunks)]
+
+    started = time.time()
+    n_rows = 0
+    for chunk, rows in zip(range(start_chunk, n_chunks), pool.imap(gen_chunk, tasks)):
+        with models.engine.begin() as conn:
+            write(conn, table, columns, rows)
+        checkpoint.save(name, chunk + 1)
+
+        n_rows += len(rows)
+        elapsed = time.time() - started
+        print('%-8s %d/%d rows, %.0f rows/s' % (name, min((chunk + 1) * args.batch, total),
+                                                total, n_rows / elapsed if elapsed else 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量生成测试数据')
+    parser.add_argument('--db', default=models.DB_URL, help='数据库地址，如 sqlite:///weibo.db')
+    parser.add_argument('--users', type=int, default=3000000)
+    parser.add_argument('--weibos', type=int, default=5000000)
+    parser.add_argument('--follows', type=int, default=None, help='默认为用户数的 20 倍')
+    parser.add_argument('--likes', type=int, default=None, help='默认为微博数的 5 倍')
+    parser.add_argument('--comments', type=int, default=None, help='默认为微博数的 2 倍')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf 分布的参数')
+    parser.add_argument('--batch', type=int, default=10000, help='每批写入的行数')
+    parser.add_argument('--procs', type=int, default=os.cpu_count(), help='生成数据的进程数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--load-data', action='store_true',
+                        help='MySQL 下使用 LOAD DATA LOCAL INFILE 导入')
+    parser.add_argument('--checkpoint', default='loader.checkpoint.json',
+                        help='断点续传的进度文件，为空时不记录')
+    args = parser.parse_args(argv)
+
+    totals = {
+        'user': args.users,
+        'weibo': args.weibos,
+        'follow': args.follows if args.follows is not None else args.users * 20,
+        'like': args.likes if args.likes is not None else args.weibos * 5,
+        'comment': args.comments if args.comments is not None else args.weibos * 2,
+    }
+    params = dict(totals, users=args.users, weibos=args.weibos,
+                  skew=args.skew, seed=args.seed, batch=args.batch)
+    checkpoint = Checkpoint(args.checkpoint, params)
+
+    connect_args = {}
+    if args.load_data and make_url(args.db).get_backend_name() == 'mysql':
+        connect_args['local_infile'] = True
+    models.init_engine(args.db, connect_args=connect_args)
+    models.Base.metadata.create_all(checkfirst=True)
+
+    with Pool(args.procs) as pool:
+        for name, columns in TABLES:
+            load_table(pool, name, columns, totals[name], args, checkpoint)
+
+    print('rebuilding like / comment counters ...')
+    counters.repair()
+    print('done')
+
+
+if __name__ == '__main__':
+    main()
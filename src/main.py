@@ -1,44 +1,243 @@
 #!/usr/bin/env python
 
+import os
+import time
+import datetime
+import signal
+
 import tornado.web
 import tornado.ioloop
-from tornado.options import parse_command_line
+import tornado.template
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
+from tornado.options import define, options, parse_command_line
 
+import models
 import views
+import api
+import archive
+import subscribers  # noqa: 注册事件的订阅者
+import leaderboard
+from counters import counter_buffer
+from cache import user_cache, weibo_cache
+from pagecache import page_cache, top10_fragment
+from writequeue import write_queue
+from events import event_bus
+from search import search_index
+from sessions import session_store
+from notifications import notifications
+from serving import Supervisor
+from staticfiles import static_files, MemoryStaticFileHandler
+from ratelimit import RateLimit, rate_limiter
+
+define('port', default=8000, type=int, help='服务器监听的端口')
+define('address', default='0.0.0.0', help='服务器监听的地址')
+define('processes', default=1, type=int, help='工作进程的数量，0 代表与 CPU 核数相同')
+define('drain_timeout', default=10, type=int, help='退出前等待处理中的请求完成的最长时间 (秒)')
+
+define('db_url', default=models.DB_URL, help='主库的地址，也可以通过环境变量 WEIBO_DB_URL 设置')
+define('db_replicas', default=os.environ.get('WEIBO_DB_REPLICAS', ''),
+       help='从库的地址，多个地址用逗号分隔，也可以通过环境变量 WEIBO_DB_REPLICAS 设置')
+define('db_workers', default=10, type=int, help='执行数据库操作的线程数')
+define('db_pool_size', default=10, type=int, help='数据库连接池的大小')
+define('db_max_overflow', default=0, type=int, help='连接池满时允许额外创建的连接数')
+define('db_pool_recycle', default=3600, type=int, help='连接的最长使用时间 (秒)，应小于 MySQL 的 wait_timeout')
+define('db_pool_pre_ping', default=True, type=bool, help='从连接池取出连接时先检查连接是否可用')
+define('replica_max_lag', default=5, type=int, help='复制延迟超过该值 (秒) 的从库不再读取')
+define('replica_check_interval', default=1, type=int, help='检查从库复制延迟的间隔 (秒)')
+
+define('user_cache_size', default=100000, type=int, help='缓存的用户数量上限')
+define('weibo_cache_size', default=100000, type=int, help='缓存的微博数量上限')
+define('entity_cache_ttl', default=300, type=int, help='用户、微博缓存的有效期 (秒)')
+
+define('top10_reconcile_interval', default=60, type=int,
+       help='热门榜单与 Like 表对账的间隔 (秒)')
+define('counter_flush_interval', default=1, type=int,
+       help='点赞数、评论数写回数据库的间隔 (秒)')
+define('session_purge_interval', default=3600, type=int, help='清理过期会话的间隔 (秒)')
+define('weibo_count_interval', default=300, type=int,
+       help='刷新微博总数近似值的间隔 (秒)')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BASE_DIR, 'templates')
+STATIC_PATH = os.path.join(BASE_DIR, 'statics')
+
+# 写操作的限流规则，同名的规则共用令牌桶
+LIMIT_REGISTER = RateLimit('register', ip='10/h', methods=('POST', ))
+LIMIT_LOGIN = RateLimit('login', ip='60/m', methods=('POST', ))
+LIMIT_POST = RateLimit('post', user='10/m', ip='60/m', methods=('POST', ))
+LIMIT_COMMENT = RateLimit('comment', user='20/m', ip='120/m', methods=('POST', ))
+LIMIT_LIKE = RateLimit('like', user='60/m', ip='600/m')
+LIMIT_FOLLOW = RateLimit('follow', user='30/m', ip='300/m')
 
 # 绑定路由
 route = [
     (r'/', views.HomePageHandler),  # 主页
 
     # 用户相关的页面
-    (r'/user/register', views.RegisterHandler),
-    (r'/user/login', views.LoginHandler),
+    (r'/user/register', views.RegisterHandler, {'rate_limit': LIMIT_REGISTER}),
+    (r'/user/login', views.LoginHandler, {'rate_limit': LIMIT_LOGIN}),
+    (r'/user/logout', views.LogoutHandler),
     (r'/user/info', views.UserinfoHandler),
-    (r'/user/follow', views.FollowHandler),
-    (r'/user/unfollow', views.UnfollowHandler),
+    (r'/user/follow', views.FollowHandler, {'rate_limit': LIMIT_FOLLOW}),
+    (r'/user/unfollow', views.UnfollowHandler, {'rate_limit': LIMIT_FOLLOW}),
     (r'/user/fans', views.FansHandler),
 
+    # 通知
+    (r'/notice/list', views.NoticeListHandler),
+    (r'/notice/poll', views.NoticePollHandler),
+
     # 微博相关接口
-    (r'/weibo/post', views.PostWeiboHandler),
+    (r'/weibo/post', views.PostWeiboHandler, {'rate_limit': LIMIT_POST}),
     (r'/weibo/show', views.ShowWeiboHandler),
-    (r'/weibo/like', views.LikeHandler),
-    (r'/weibo/dislike', views.DislikeHandler),
+    (r'/weibo/like', views.LikeHandler, {'rate_limit': LIMIT_LIKE}),
+    (r'/weibo/dislike', views.DislikeHandler, {'rate_limit': LIMIT_LIKE}),
     (r'/weibo/follow', views.FollowWeiboHandler),
+    (r'/weibo/search', views.SearchHandler),
 
     # 评论相关接口
-    (r'/comment/commit', views.CommentCommitHandler),
-    (r'/comment/reply', views.ReplyCommentHandler),
+    (r'/comment/commit', views.CommentCommitHandler, {'rate_limit': LIMIT_COMMENT}),
+    (r'/comment/reply', views.ReplyCommentHandler, {'rate_limit': LIMIT_COMMENT}),
+
+    # 移动客户端使用的 JSON 接口
+    (r'/api/v1/timeline', api.TimelineApiHandler),
+    (r'/api/v1/weibo/(\d+)', api.WeiboApiHandler),
+    (r'/api/v1/weibo/(\d+)/comments', api.CommentsApiHandler),
+    (r'/api/v1/user/(\d+)', api.UserApiHandler),
+    (r'/api/v1/user/(\d+)/fans', api.FansApiHandler),
+
+    # 运行状态
+    (r'/_stats', views.StatsHandler),
 ]
 
-# 定义 App
-web_app = tornado.web.Application(
-    route,
-    template_path='./templates',
-    static_path='./statics',
-)
+
+def load_templates(path=TEMPLATE_PATH):
+    '''启动时编译所有模板，模板有错误时立即发现，请求中不再编译'''
+    loader = tornado.template.Loader(path)
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html'):
+            loader.load(name)
+    return loader
+
+
+def make_app(**settings):
+    '''定义 App'''
+    settings.setdefault('cookie_secret', options.cookie_secret)
+    if not static_files.files:
+        static_files.load(STATIC_PATH)  # 多进程时在 fork 之前已经加载
+    return tornado.web.Application(
+        route,
+        template_loader=load_templates(),
+        static_path=STATIC_PATH,
+        static_handler_class=MemoryStaticFileHandler,
+        **settings
+    )
+
+
+def start_background_jobs():
+    '''启动后台定时任务'''
+    # 定期检查从库的复制延迟
+    if models.replica_pool.engines:
+        models.replica_pool.check()
+        tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(models.replica_pool.check),
+                                        options.replica_check_interval * 1000).start()
+    # 定期删除所有订阅者都已处理完的事件
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(event_bus.flush_acks),
+                                    options.event_ack_interval).start()
+    # 启动时加载热门榜单，之后定期对账
+    leaderboard.reconcile()
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(leaderboard.reconcile),
+                                    options.top10_reconcile_interval * 1000).start()
+    # 定期将点赞、关注操作批量写入数据库
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(write_queue.flush),
+                                    options.write_flush_interval).start()
+    # 定期将计数增量写回数据库
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(counter_buffer.flush),
+                                    options.counter_flush_interval * 1000).start()
+    # 加载搜索索引，之后定期补充其他进程发布的微博，并保存到磁盘 (加载完成之前两者直接跳过)
+    models.run_in_background(search_index.open)
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(search_index.catch_up),
+                                    options.search_refresh_interval * 1000).start()
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(search_index.save),
+                                    options.search_save_interval * 1000).start()
+    # 定期清理过期的会话
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(session_store.purge),
+                                    options.session_purge_interval * 1000).start()
+    # 定期把旧微博和已取消的点赞、关注移入归档表
+    if options.archive_interval:
+        tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(archive.run),
+                                        options.archive_interval * 1000).start()
+    # 定期刷新首页分页使用的微博总数
+    tornado.ioloop.PeriodicCallback(lambda: models.run_in_background(views.weibo_count.refresh),
+                                    options.weibo_count_interval * 1000).start()
+
+
+async def shutdown(server):
+    '''优雅退出：停止接收新连接，等待处理中的请求完成'''
+    server.stop()
+    notifications.wake_all()  # 长轮询的请求立即返回
+    deadline = time.time() + options.drain_timeout
+    while views.BaseHandler.in_flight > 0 and time.time() < deadline:
+        await gen.sleep(0.1)
+
+    await models.run_in_db(write_queue.flush, True)  # 写入尚未保存的点赞、关注
+    await event_bus.drain(options.drain_timeout)  # 等待订阅者处理完已提交的事件
+    await models.run_in_db(counter_buffer.flush, True)  # 写回尚未保存的计数
+    await models.run_in_db(event_bus.flush_acks)  # 删除已处理完的事件
+    await event_bus.stop()
+    await models.run_in_db(search_index.save)     # 保存搜索索引
+    tornado.ioloop.IOLoop.current().stop()
+
+
+def run_worker(sockets, idx=0):
+    '''在当前进程中运行服务器，idx 为工作进程的编号'''
+    # 连接池必须在 fork 之后创建，各个进程不能共享连接
+    models.init_engine(options.db_url,
+                       pool_size=options.db_pool_size,
+                       max_overflow=options.db_max_overflow,
+                       pool_recycle=options.db_pool_recycle,
+                       pool_pre_ping=options.db_pool_pre_ping,
+                       replicas=[url for url in options.db_replicas.split(',') if url],
+                       max_lag=options.replica_max_lag,
+                       workers=options.db_workers)
+    user_cache.configure(options.user_cache_size, options.entity_cache_ttl)
+    weibo_cache.configure(options.weibo_cache_size, options.entity_cache_ttl)
+    page_cache.configure(options.page_cache_size, options.page_cache_ttl)
+    top10_fragment.configure(options.top10_fragment_ttl)
+    session_store.configure(options.session_cache_size, options.session_cache_ttl)
+    notifications.configure(options.notice_cache_size, options.notice_cache_ttl)
+    event_bus.start(idx)
+    start_background_jobs()
+    # 重放上一个同编号进程遗留的事件，等它退出后再读取，避免重复处理
+    started = datetime.datetime.now()
+    tornado.ioloop.IOLoop.current().call_later(options.drain_timeout + 1, event_bus.replay, started)
+
+    server = HTTPServer(make_app())
+    server.add_sockets(sockets)
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    on_signal = lambda signum, frame: io_loop.add_callback_from_signal(shutdown, server)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    io_loop.start()
+
+
+def main():
+    parse_command_line()
+
+    sockets = bind_sockets(options.port, options.address)  # 绑定服务器运行的地址和端口
+    n_workers = options.processes or cpu_count()
+    static_files.load(STATIC_PATH)  # 在 fork 之前读入静态文件，各个工作进程共享
+    rate_limiter.configure(options.rate_limit_backend, options.rate_limit_slots)  # 共享内存同样在 fork 之前创建
+    print('Server running on %s:%s with %d process(es)' % (options.address, options.port, n_workers))
+
+    if n_workers == 1:
+        run_worker(sockets)
+    else:
+        Supervisor(n_workers, lambda idx: run_worker(sockets, idx)).run()
 
 
-parse_command_line()
-web_app.listen(8000, '0.0.0.0')  # 绑定服务器运行的地址和端口
-print('Server running on 0.0.0.0:8000')
-tornado.ioloop.IOLoop.current().start()  # 启动服务器
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""数据库结构迁移
+
+为已有的数据库补上模型中新增的字段和索引 (create_all 只会创建不存在的表)。
+MySQL 下使用 ALGORITHM=INPLACE, LOCK=NONE 在线加索引，不阻塞读写。
+
+    python migrate.py           # 添加缺失的字段和索引
+    python migrate.py --check   # 检查各个视图的查询计划，存在全表扫描时返回非 0
+"""
+
+import sys
+import argparse
+import datetime
+
+from sqlalchemy import inspect, func
+from sqlalchemy.schema import CreateIndex
+
+import models
+from models import Base, Session, User, Weibo, Comment, Like, Follow, ArchivedComment
+
+
+def add_missing_columns(engine):
+    '''添加模型中有、数据库中没有的字段'''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=engine.dialect)
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, col_type)
+            if column.server_default is not None:
+                ddl += ' NOT NULL DEFAULT %s' % column.server_default.arg
+            print(ddl)
+            engine.execute(ddl)
+
+
+def add_missing_indexes(engine):
+    '''添加模型中声明、数据库中没有的索引'''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            continue
+        existing = {idx['name'] for idx in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if engine.dialect.name == 'mysql':
+                # 在线添加索引，建索引期间表仍然可以读写
+                ddl = 'ALTER TABLE `%s` ADD INDEX `%s` (%s), ALGORITHM=INPLACE, LOCK=NONE' % (
+                    table.name, index.name,
+                    ', '.join('`%s`' % col.name for col in index.columns))
+            else:
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            print(ddl)
+            engine.execute(ddl)
+
+
+def handler_queries(session):
+    '''各个视图中的主要查询，形式与 views.py 中保持一致'''
+    now = datetime.datetime.now()
+    ids = [1, 2, 3]
+    return {
+        'home: page':
+            session.query(Weibo.id).order_by(Weibo.created.desc(), Weibo.id.desc()).limit(10),
+        'home: cursor':
+            session.query(Weibo.id)
+                   .filter((Weibo.created < now) | ((Weibo.created == now) & (Weibo.id < 1)))
+                   .order_by(Weibo.created.desc(), Weibo.id.desc()).limit(10),
+        'show: comments':
+            session.query(Comment).filter_by(wb_id=1).order_by(Comment.created.desc()),
+        'show: like status':
+            session.query(Like).filter_by(wb_id=1, user_id=1),
+        'login: user by nickname':
+            session.query(User).filter_by(nickname='x'),
+        'graph: followers':
+            session.query(Follow.user_id).filter_by(follow_id=1, status=True),
+        'graph: following':
+            session.query(Follow.follow_id).filter_by(user_id=1, status=True),
+        'timeline: celebrities':
+            session.query(Follow.follow_id)
+                   .filter(Follow.follow_id.in_(ids), Follow.status.is_(True))
+                   .group_by(Follow.follow_id).having(func.count(1) >= 100),
+        'timeline: backfill':
+            session.query(Weibo.created, Weibo.id).filter(Weibo.user_id.in_(ids))
+                   .order_by(Weibo.created.desc(), Weibo.id.desc()).limit(800),
+        'show: archived comments':
+            session.query(ArchivedComment).filter_by(wb_id=1),
+        'archive: old weibos':
+            session.query(Weibo.id).filter(Weibo.created < now)
+                   .order_by(Weibo.created, Weibo.id).limit(1000),
+        'archive: inactive likes':
+            session.query(Like).filter(Like.wb_id >= 1, Like.wb_id < 10001,
+                                       Like.status.is_(False)),
+        'archive: inactive follows':
+            session.query(Follow).filter(Follow.follow_id >= 1, Follow.follow_id < 10001,
+                                         Follow.status.is_(False)),
+        'top10: reconcile':
+            session.query(Like.wb_id, func.count(1)).filter(Like.status.is_(True))
+                   .group_by(Like.wb_id).order_by(func.count(1).desc()).limit(50),
+    }
+
+
+def explain(engine, query):
+    '''返回查询计划中做了全表扫描的表'''
+    compiled = query.statement.compile(dialect=engine.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if engine.dialect.name == 'mysql':
+            cursor.execute('EXPLAIN ' + str(compiled), params)
+            columns = [d[0] for d in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return [row['table'] for row in rows if row['type'] == 'ALL']
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+            details = [row[-1] for row in cursor.fetchall()]
+            return [detail for detail in details
+                    if detail.startswith('SCAN') and 'INDEX' not in detail]
+    finally:
+        conn.close()
+
+
+def check_query_plans(engine):
+    '''检查所有查询的执行计划，返回是否全部使用了索引'''
+    session = Session()
+    ok = True
+    try:
+        for name, query in handler_queries(session).items():
+            full_scans = explain(engine, query)
+            if full_scans:
+                ok = False
+                print('FULL SCAN  %-26s %s' % (name, ', '.join(full_scans)))
+            else:
+                print('ok         %s' % name)
+    finally:
+        session.close()
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='数据库结构迁移')
+    parser.add_argument('--db', default=models.DB_URL, help='数据库地址')
+    parser.add_argument('--check', action='store_true', help='只检查查询计划')
+    args = parser.parse_args(argv)
+
+    engine = models.init_engine(args.db)
+    if args.check:
+        return 0 if check_query_plans(engine) else 1
+
+    Base.metadata.create_all(checkfirst=True)  # 新增的表
+    add_missing_columns(engine)
+    add_missing_indexes(engine)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""通知
+
+别人回复了我的评论、赞了我的微博、关注了我时，产生一条通知。
+同一用户、同一类型、同一目标的未读通知合并为一条 ("某某等 N 人赞了你的微博")，
+N 是不同用户的人数，合并过的用户记录在 notification_actor 中，反复操作时不重复计数。通知由事件总线的订阅者批量写入 (见 subscribers.py)。
+
+每个用户的未读通知数缓存在进程内，导航栏直接读取缓存。
+客户端通过长轮询 (/notice/poll) 等待新的通知，不需要反复刷新页面。
+其他进程产生的通知，最多在 --notice_cache_ttl 秒后可见。
+"""
+
+import datetime
+import threading
+from collections import Counter
+
+from sqlalchemy import func, and_, or_
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from tornado.options import define
+
+from models import Notification, NotificationActor
+from cache import LRUCache
+
+define('notice_cache_size', default=100000, type=int, help='每个进程缓存的未读通知数的用户数量上限')
+define('notice_cache_ttl', default=30, type=int, help='未读通知数在进程内缓存的有效期 (秒)')
+define('notice_poll_timeout', default=30, type=int, help='长轮询最长的等待时间 (秒)')
+
+# 通知的类型及显示的文字
+KINDS = {
+    'reply': '回复了你在这条微博下的评论',
+    'like': '赞了你的微博',
+    'follow': '关注了你',
+}
+
+
+class NotificationCenter:
+    '''通知的写入、读取，以及等待新通知的长轮询'''
+
+    def __init__(self):
+        self.unread = LRUCache()  # {user_id: 未读通知数}
+        self.io_loop = None
+        self._waiters = {}        # {user_id: (Condition, 等待的请求数)}
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        self.unread.configure(max_size, ttl)
+
+    def peek_unread(self, user_id):
+        '''只从缓存中取出未读通知数，未缓存时返回 None'''
+        return self.unread.get_many([user_id]).get(user_id)
+
+    def unread_count(self, session, user_id):
+        '''未读通知数，未缓存时查询数据库'''
+        n_unread = self.peek_unread(user_id)
+        if n_unread is None:
+            n_unread = session.query(func.count(Notification.id)) \
+                              .filter(Notification.user_id == user_id,
+                                      Notification.is_read.is_(False)) \
+                              .scalar()
+            self.unread.set_many({user_id: n_unread})
+        return n_unread
+
+    def notify(self, session, items):
+        '''写入一批通知 [(接收的用户, 类型, 目标, 操作的用户), ...]，合并到已有的未读通知中'''
+        groups = {}  # {(user_id, kind, target): [actor_id, ...]}
+        for user_id, kind, target, actor_id in items:
+            if user_id is not None and user_id != actor_id:  # 自己的操作不通知
+                groups.setdefault((user_id, kind, target), []).append(actor_id)
+        if not groups:
+            return
+
+        query = session.query(Notification) \
+                       .filter(Notification.is_read.is_(False),
+                               or_(*[and_(Notification.user_id == user_id,
+                                          Notification.kind == kind,
+                                          Notification.target == target)
+                                     for user_id, kind, target in groups]))
+        existing = {(n.user_id, n.kind, n.target): n for n in query}
+        if existing:  # 已经合并过的用户
+            counted = set(session.query(NotificationActor.notice_id, NotificationActor.actor_id)
+                                 .filter(NotificationActor.notice_id.in_([n.id for n in existing.values()])))
+        else:
+            counted = set()
+
+        now = datetime.datetime.now()
+        n_created = Counter()  # 每个用户新增的未读通知数
+        merged = []            # [(通知, 新合并的用户), ...]
+        for (user_id, kind, target), actors in groups.items():
+            actors = list(dict.fromkeys(actors))  # 去重，保持顺序
+            notice = existing.get((user_id, kind, target))
+            if notice is None:
+                notice = Notification(user_id=user_id, kind=kind, target=target,
+                                      actor_id=actors[-1], n_actors=len(actors), updated=now)
+                session.add(notice)
+                n_created[user_id] += 1
+            else:
+                actors = [actor_id for actor_id in actors if (notice.id, actor_id) not in counted]
+                notice.actor_id = groups[user_id, kind, target][-1]
+                notice.n_actors += len(actors)
+                notice.updated = now
+            merged.append((notice, actors))
+        session.flush()  # 分配新通知的 ID
+        session.add_all([NotificationActor(notice_id=notice.id, actor_id=actor_id)
+                         for notice, actors in merged for actor_id in actors])
+        session.commit()
+
+        # 只更新已缓存的未读数，未缓存的下次读取时查询
+        with self._lock:
+            cached = self.unread.get_many(n_created)
+            self.unread.set_many({user_id: n + n_created[user_id] for user_id, n in cached.items()})
+        self.wake({user_id for user_id, _, _ in groups})
+
+    def page(self, session, user_id, page, per_page):
+        '''按更新时间降序取出一页通知，只取出列的值，不受之后的提交影响'''
+        return session.query(Notification.kind, Notification.target, Notification.actor_id,
+                             Notification.n_actors, Notification.is_read, Notification.updated) \
+                      .filter(Notification.user_id == user_id) \
+                      .order_by(Notification.updated.desc()) \
+                      .offset((page - 1) * per_page) \
+                      .limit(per_page) \
+                      .all()
+
+    def count(self, session, user_id):
+        return session.query(func.count(Notification.id)) \
+                      .filter(Notification.user_id == user_id) \
+                      .scalar()
+
+    def mark_read(self, session, user_id):
+        '''将用户的通知全部标记为已读'''
+        session.query(Notification) \
+               .filter(Notification.user_id == user_id, Notification.is_read.is_(False)) \
+               .update({'is_read': True}, synchronize_session=False)
+        session.commit()
+        with self._lock:
+            self.unread.set_many({user_id: 0})
+        self.wake([user_id])
+
+    async def wait(self, user_id, timeout):
+        '''等待新的通知，有新通知时返回 True，超时返回 False'''
+        self.io_loop = IOLoop.current()
+        cond, n = self._waiters.get(user_id, (None, 0))
+        cond = cond or Condition()
+        self._waiters[user_id] = (cond, n + 1)
+        try:
+            return await cond.wait(timeout=datetime.timedelta(seconds=timeout))
+        finally:
+            cond, n = self._waiters.pop(user_id)
+            if n > 1:
+                self._waiters[user_id] = (cond, n - 1)
+
+    def wake(self, user_ids):
+        '''唤醒等待这些用户通知的请求，可以在任意线程中调用'''
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self._wake, list(user_ids))
+
+    def wake_all(self):
+        '''唤醒所有等待中的请求，退出前调用'''
+        self._wake(list(self._waiters))
+
+    def _wake(self, user_ids):
+        for user_id in user_ids:
+            cond, _ = self._waiters.get(user_id, (None, 0))
+            if cond is not None:
+                cond.notify_all()
+
+
+notifications = NotificationCenter()
@@ -0,0 +1,107 @@
+"""页面缓存
+
+* 热门微博侧边栏: 渲染好的 HTML 片段在所有页面间共享，短时间后过期
+* 匿名用户的整页缓存: 以 URL 为 key 缓存渲染结果和 ETag，浏览器带 If-None-Match 时直接返回 304
+
+整页缓存按标签失效：每个标签有一个版本号，版本号是缓存 key 的一部分，
+失效时只需要把版本号加一，旧版本的页面不会再被读到，之后由 LRU 自然淘汰。
+"""
+
+import time
+import hashlib
+import threading
+from functools import wraps
+
+from tornado.escape import utf8
+from tornado.options import define
+
+from cache import LRUCache
+
+define('page_cache_size', default=2000, type=int, help='缓存的匿名页面数量上限')
+define('page_cache_ttl', default=5, type=int, help='匿名页面缓存的有效期 (秒)')
+define('top10_fragment_ttl', default=5, type=int, help='热门微博侧边栏缓存的有效期 (秒)')
+
+
+class PageCache:
+    '''匿名用户的整页缓存'''
+
+    def __init__(self, max_size=2000, ttl=5):
+        self.lru = LRUCache(max_size, ttl)
+        self._versions = {}  # {标签: 版本号}
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        self.lru.configure(max_size, ttl)
+
+    def key(self, tag, uri):
+        return (uri, tag, self._versions.get(tag, 0))
+
+    def get(self, key):
+        '''返回 (etag, body)，未命中时返回 None'''
+        return self.lru.get_many([key]).get(key)
+
+    def set(self, key, body):
+        body = utf8(body)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.lru.set_many({key: (etag, body)})
+        return etag
+
+    def stats(self):
+        return self.lru.stats()
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+
+class FragmentCache:
+    '''渲染好的 HTML 片段，过期后重新渲染'''
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._html = None
+        self._expire_at = 0
+
+    def configure(self, ttl):
+        self.ttl = ttl
+        self._expire_at = 0
+
+    def get(self, render):
+        '''取出片段，过期时调用 render() 重新生成'''
+        now = time.time()
+        if self._html is None or now >= self._expire_at:
+            self._html = render()
+            self._expire_at = now + self.ttl
+        return self._html
+
+
+def cache_page(tag):
+    '''对未登录用户缓存整个页面
+
+    tag 为函数，参数是视图对象，返回页面所属的标签，例如 'home'、'weibo:1'
+    '''
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self.current_user is not None:
+                return await method(self, *args, **kwargs)  # 登录用户的页面各不相同
+
+            key = page_cache.key(tag(self), self.request.uri)
+            cached = page_cache.get(key)
+            if cached is None:
+                self.page_cache_key = key  # BaseHandler.finish 中保存渲染结果
+                return await method(self, *args, **kwargs)
+
+            etag, body = cached
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return self.finish()
+            return self.finish(body)
+        return wrapper
+    return decorator
+
+
+page_cache = PageCache()
+top10_fragment = FragmentCache()
@@ -0,0 +1,70 @@
+"""分页工具
+
+游标分页 (keyset pagination): 游标中记录上一页最后一条数据的 (created, id)，
+下一页直接从索引上的这个位置继续往后读，不再需要 OFFSET 扫过前面所有的行。
+"""
+
+import base64
+import datetime
+import threading
+
+from models import Session
+
+
+def encode_cursor(created, row_id):
+    '''将 (created, id) 编码为不透明的游标字符串'''
+    raw = '%s|%d' % (created.strftime('%Y-%m-%d %H:%M:%S.%f'), row_id)
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''解析游标，返回 (created, id)。游标不合法时抛出 ValueError'''
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(cursor + padding).decode('utf8')
+        created, row_id = raw.split('|')
+        return datetime.datetime.strptime(created, '%Y-%m-%d %H:%M:%S.%f'), int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('invalid cursor: %r' % cursor) from e
+
+
+def page_window(cur_page, all_pages, size=9):
+    '''当前页附近需要显示的页码'''
+    start = max(1, min(cur_page - size // 2, all_pages - size + 1))
+    end = min(all_pages, start + size - 1)
+    return range(start, end + 1)
+
+
+class ApproxRowCount:
+    '''缓存的近似行数，定期刷新
+
+    MySQL 中直接读取 information_schema 里的统计值，其他数据库退化为 COUNT(*)
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        if self._value is None:
+            self.refresh()
+        return self._value
+
+    def refresh(self):
+        session = Session(use_replica=True)
+        try:
+            if session.get_bind().dialect.name == 'mysql':
+                n_rows = session.execute(
+                    'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name',
+                    {'name': self.model.__tablename__}
+                ).scalar()
+            else:
+                n_rows = session.query(self.model).count()
+        finally:
+            session.close()
+
+        with self._lock:
+            self._value = n_rows or 0
@@ -0,0 +1,141 @@
+"""请求级别的性能统计
+
+通过 SQLAlchemy 的引擎事件记录每条 SQL 的耗时，通过 contextvars 归属到当前请求上；
+模板渲染的耗时由 BaseHandler.render_string 记录。
+
+每个请求结束后：
+    * 在响应头 Server-Timing 中返回数据库、模板和总耗时
+    * 超过 --slow_request_threshold 的请求记录到日志中，附带最慢的几条 SQL
+    * 按视图类汇总耗时分布，由 /_stats 接口查看
+"""
+
+import time
+import bisect
+import logging
+import threading
+import contextvars
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from tornado.options import define, options
+
+define('slow_request_threshold', default=500, type=int, help='慢请求的阈值 (毫秒)')
+
+logger = logging.getLogger('tornado.general')
+
+current_stats = contextvars.ContextVar('current_stats', default=None)
+
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # 耗时分布的区间上限 (毫秒)
+N_SLOWEST = 3  # 每个请求保留的最慢 SQL 数量
+
+
+class RequestStats:
+    '''单个请求的统计数据'''
+    __slots__ = ('handler', 'started', 'n_queries', 'db_time', 'render_time', 'slowest')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.n_queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.slowest = []  # [(耗时, SQL), ...]，按耗时降序
+
+    def add_query(self, statement, elapsed):
+        self.n_queries += 1
+        self.db_time += elapsed
+        if len(self.slowest) < N_SLOWEST or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, statement[:200]))
+            self.slowest.sort(reverse=True)
+            del self.slowest[N_SLOWEST:]
+
+    def server_timing(self):
+        '''Server-Timing 响应头的内容'''
+        total = time.perf_counter() - self.started
+        return 'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, total;dur=%.1f' % (
+            self.db_time * 1000, self.n_queries, self.render_time * 1000, total * 1000)
+
+
+class HandlerStats:
+    '''一个视图类的汇总统计'''
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.n_queries = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, stats, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.db_time += stats.db_time
+        self.render_time += stats.render_time
+        self.n_queries += stats.n_queries
+        self.histogram[bisect.bisect_left(BUCKETS, elapsed * 1000)] += 1
+
+    def to_dict(self):
+        n = self.count or 1
+        labels = ['<=%dms' % b for b in BUCKETS] + ['>%dms' % BUCKETS[-1]]
+        return {
+            'count': self.count,
+            'avg_ms': self.total_time / n * 1000,
+            'avg_db_ms': self.db_time / n * 1000,
+            'avg_render_ms': self.render_time / n * 1000,
+            'avg_queries': self.n_queries / n,
+            'histogram': dict(zip(labels, self.histogram)),
+        }
+
+
+class Profiler:
+    '''汇总所有请求的统计数据'''
+
+    def __init__(self):
+        self.handlers = {}  # {视图类名: HandlerStats}
+        self._lock = threading.Lock()
+
+    def begin(self, handler):
+        '''请求开始时调用'''
+        stats = RequestStats(handler)
+        current_stats.set(stats)
+        return stats
+
+    def end(self, stats, request, status):
+        '''请求结束时调用'''
+        elapsed = time.perf_counter() - stats.started
+        with self._lock:
+            self.handlers.setdefault(stats.handler, HandlerStats()).add(stats, elapsed)
+
+        if elapsed * 1000 >= options.slow_request_threshold:
+            logger.warning('slow request %s %s %d %.1fms (db %.1fms in %d queries, tpl %.1fms)%s',
+                           request.method, request.uri, status, elapsed * 1000,
+                           stats.db_time * 1000, stats.n_queries, stats.render_time * 1000,
+                           ''.join('\n    %.1fms  %s' % (t * 1000, sql)
+                                   for t, sql in stats.slowest))
+
+    def to_dict(self):
+        with self._lock:
+            return {name: s.to_dict() for name, s in sorted(self.handlers.items())}
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats = current_stats.get()
+    if stats is not None:
+        stats.add_query(statement, elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+profiler = Profiler()
@@ -0,0 +1,210 @@
+"""限流
+
+写操作的接口按令牌桶限流，每个路由的规则在 main.py 的路由表中配置：
+
+    (r'/weibo/like', views.LikeHandler, {'rate_limit': RateLimit('like', user='60/m', ip='600/m')})
+
+登陆的用户按用户 ID 计数，同时所有请求按 IP 计数，超出时返回 429 和 Retry-After。
+名称相同的规则共用同一组令牌桶 (例如点赞和取消点赞)。
+
+令牌桶保存在后端中：
+    * MemoryBackend    每个进程各自计数，令牌已经回满的桶由时间轮清理
+    * SharedBackend    fork 之前创建的共享内存 (匿名 mmap)，所有工作进程共同计数
+"""
+
+import mmap
+import time
+import struct
+import hashlib
+import threading
+import multiprocessing
+from collections import Counter
+
+from tornado.options import define, options
+
+define('rate_limit', default=True, type=bool, help='是否对写操作限流')
+define('rate_limit_backend', default='memory',
+       help='令牌桶的后端: memory (每个进程单独计数) / shared (所有工作进程共同计数)')
+define('rate_limit_slots', default=65536, type=int, help='shared 后端的令牌桶数量上限')
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(value):
+    '''解析 "60/m" 形式的限额，返回 (每秒补充的令牌数, 桶的容量)'''
+    if value is None:
+        return None
+    count, _, period = value.partition('/')
+    count = int(count)
+    return count / PERIODS[period or 's'], count
+
+
+class RateLimit:
+    '''一个路由的限流规则'''
+
+    def __init__(self, name, user=None, ip=None, methods=None):
+        self.name = name              # 规则的名称，同名的规则共用令牌桶
+        self.user = parse_rate(user)  # 每个用户的限额
+        self.ip = parse_rate(ip)      # 每个 IP 的限额
+        self.methods = methods        # 限流的请求方法，None 代表全部
+
+    def applies(self, method):
+        return self.methods is None or method in self.methods
+
+
+def take(tokens, last, rate, capacity, now):
+    '''从桶中取出一个令牌，返回 (剩余的令牌数, 需要等待的秒数)，令牌不足时等待时间大于 0'''
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class Backend:
+    '''令牌桶的存储接口'''
+
+    def take(self, key, rate, capacity, now):
+        '''取出一个令牌，返回需要等待的秒数，0 代表放行'''
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class Bucket:
+    __slots__ = ('tokens', 'last', 'full_at', 'slot')
+
+    def __init__(self, tokens, last):
+        self.tokens = tokens
+        self.last = last
+        self.full_at = last   # 令牌回满的时间，之后的桶与不存在等价
+        self.slot = None      # 所在的时间轮槽位
+
+
+class MemoryBackend(Backend):
+    '''进程内的令牌桶
+
+    令牌回满的桶由时间轮清理：按回满的时间 (秒) 放入对应的槽位，时间走到该槽位时删除。
+    桶被再次使用、回满时间推后时移到新的槽位，旧槽位中的记录在走到时忽略。
+    回满时间超过一圈的桶留在槽位中，等下一圈再检查。
+    '''
+
+    def __init__(self, wheel_size=3600):
+        self.buckets = {}
+        self.wheel = [set() for _ in range(wheel_size)]
+        self._tick = None              # 时间轮已经走到的秒数
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, now):
+        with self._lock:
+            self._advance(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket(capacity, now)
+            bucket.tokens, wait = take(bucket.tokens, bucket.last, rate, capacity, now)
+            bucket.last = now
+            bucket.full_at = now + (capacity - bucket.tokens) / rate
+            slot = int(bucket.full_at) % len(self.wheel)
+            if slot != bucket.slot:
+                bucket.slot = slot
+                self.wheel[slot].add(key)
+            return wait
+
+    def _advance(self, now):
+        '''时间轮走到 now，删除已经回满的桶'''
+        end = int(now)
+        if self._tick is None:
+            self._tick = end
+        start = max(self._tick + 1, end - len(self.wheel) + 1)
+        for second in range(start, end + 1):
+            slot = second % len(self.wheel)
+            keys, self.wheel[slot] = self.wheel[slot], set()
+            for key in keys:
+                bucket = self.buckets.get(key)
+                if bucket is None or bucket.slot != slot:
+                    continue  # 已经移到其他槽位
+                if bucket.full_at <= now:
+                    del self.buckets[key]
+                else:
+                    self.wheel[slot].add(key)  # 还没到时间，下一圈再检查
+        self._tick = max(self._tick, end)
+
+    def stats(self):
+        return {'buckets': len(self.buckets)}
+
+
+class SharedBackend(Backend):
+    '''共享内存中的令牌桶，必须在 fork 之前创建
+
+    固定大小的开放寻址哈希表，每个槽位为 (key 的哈希, 令牌数, 更新时间, 回满时间)，
+    令牌已经回满的槽位可以被其他 key 使用；探测范围内都被占用时，覆盖最早回满的桶。
+    所有进程通过一把跨进程的锁访问。
+    '''
+
+    SLOT = struct.Struct('<Qddd')
+    PROBES = 8
+
+    def __init__(self, n_slots):
+        self.n_slots = n_slots
+        self.buf = mmap.mmap(-1, n_slots * self.SLOT.size)
+        self.lock = multiprocessing.Lock()
+
+    def take(self, key, rate, capacity, now):
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        with self.lock:
+            victim, victim_full_at = None, None
+            tokens, last = capacity, now
+            for i in range(self.PROBES):
+                offset = (key_hash + i) % self.n_slots * self.SLOT.size
+                slot_hash, slot_tokens, slot_last, full_at = self.SLOT.unpack_from(self.buf, offset)
+                if slot_hash == key_hash:
+                    victim, tokens, last = offset, slot_tokens, slot_last
+                    break
+                if slot_hash == 0 or full_at <= now:
+                    full_at = 0  # 空闲的槽位
+                if victim is None or full_at < victim_full_at:
+                    victim, victim_full_at = offset, full_at
+            tokens, wait = take(tokens, last, rate, capacity, now)
+            self.SLOT.pack_into(self.buf, victim, key_hash, tokens, now,
+                                now + (capacity - tokens) / rate)
+            return wait
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            used = sum(1 for i in range(self.n_slots)
+                       if self.SLOT.unpack_from(self.buf, i * self.SLOT.size)[3] > now)
+        return {'buckets': used, 'slots': self.n_slots}
+
+
+class RateLimiter:
+    '''按规则检查请求'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.rejected = Counter()  # {规则名称: 拒绝的请求数}
+
+    def configure(self, backend, n_slots):
+        '''选择后端，多进程时必须在 fork 之前调用'''
+        self.backend = SharedBackend(n_slots) if backend == 'shared' else MemoryBackend()
+
+    def check(self, limit, user_id, ip):
+        '''检查一次请求，返回需要等待的秒数，0 代表放行'''
+        if not options.rate_limit:
+            return 0
+        now = time.time()
+        wait = 0
+        if limit.user is not None and user_id is not None:
+            wait = self.backend.take('%s:u:%s' % (limit.name, user_id), *limit.user, now)
+        # 被用户的规则拒绝时不再消耗 IP 的令牌，同一 IP 下的其他用户不受影响
+        if not wait and limit.ip is not None:
+            wait = self.backend.take('%s:ip:%s' % (limit.name, ip), *limit.ip, now)
+        if wait:
+            self.rejected[limit.name] += 1
+        return wait
+
+    def stats(self):
+        return dict(self.backend.stats(), rejected=dict(self.rejected))
+
+
+rate_limiter = RateLimiter(MemoryBackend())
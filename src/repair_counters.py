@@ -0,0 +1,11 @@
+"""重建微博的点赞数、评论数"""
+
+from models import init_engine, Base
+import counters
+import migrate
+
+engine = init_engine()
+
+Base.metadata.create_all(checkfirst=True)  # 旧数据库中没有归档表时，先建好
+migrate.add_missing_columns(engine)  # 旧数据库中没有计数字段时，先补上
+counters.repair()
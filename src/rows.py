@@ -0,0 +1,31 @@
+"""传给缓存和模板的行数据
+
+ORM 对象在会话提交、关闭之后，访问属性可能触发查询 (过期属性的刷新、延迟加载)，
+在模板中就是在 IOLoop 线程里访问数据库。缓存和模板只使用这里的行对象：
+在数据库线程中一次取出所有需要的列，之后就是普通的数据。
+
+行对象为 namedtuple，没有 __dict__，比 ORM 对象占用的内存小得多。
+"""
+
+from collections import namedtuple
+
+from models import ArchivedWeibo
+
+UserRow = namedtuple('UserRow', 'id nickname gender city bio')
+WeiboRow = namedtuple('WeiboRow', 'id user_id content created like_count comment_count archived')
+CommentRow = namedtuple('CommentRow', 'id user_id wb_id cmt_id content created')
+
+
+def user_row(user):
+    return UserRow(user.id, user.nickname, user.gender, user.city, user.bio)
+
+
+def weibo_row(weibo):
+    return WeiboRow(weibo.id, weibo.user_id, weibo.content, weibo.created,
+                    weibo.like_count, weibo.comment_count,
+                    isinstance(weibo, ArchivedWeibo))  # 已归档的微博，评论也在归档表中
+
+
+def comment_row(comment):
+    return CommentRow(comment.id, comment.user_id, comment.wb_id, comment.cmt_id,
+                      comment.content, comment.created)
@@ -0,0 +1,323 @@
+"""微博全文搜索
+
+进程内的倒排索引：
+    * 中文按单个字 (unigram) 和相邻两个字 (bigram) 切分，英文、数字按单词切分；
+      查询时连续的中文只使用 bigram，单独的一个字使用 unigram
+    * 每个词的倒排表按微博 ID 升序保存为 varint 编码的字节串，存储相邻 ID 的差值和词频
+    * 按 BM25 打分，再结合点赞数、发布时间排序，查询的词必须全部出现
+
+启动时从磁盘加载索引，再补上之后新增的微博；没有索引文件时从 weibo 表全量构建。
+新微博发布后立即加入索引，其他进程发布的微博由定时任务补上。
+
+    python search.py --db sqlite:///weibo.db   # 离线构建索引文件
+"""
+
+import os
+import math
+import time
+import pickle
+import argparse
+import threading
+from array import array
+
+from tornado.options import define, options
+
+import models
+from models import Session, Weibo
+from cache import weibo_cache
+
+define('search_index_path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                 'search_index.bin'),
+       help='搜索索引文件的路径')
+define('search_refresh_interval', default=5, type=int, help='将新微博补充到搜索索引的间隔 (秒)')
+define('search_save_interval', default=600, type=int, help='搜索索引保存到磁盘的间隔 (秒)')
+
+INDEX_VERSION = 2  # 2: 中文同时索引单个字
+
+K1 = 1.2                 # BM25 的词频饱和参数
+B = 0.75                 # BM25 的长度归一化参数
+LIKE_WEIGHT = 0.1        # 点赞数对得分的加成: (1 + LIKE_WEIGHT * ln(1 + 点赞数))
+RECENCY_HALF_LIFE = 30   # 时间衰减的半衰期 (天)，最旧的微博得分减半
+N_CANDIDATES = 200       # 按 BM25 和时间初选的数量，再读取点赞数精排
+
+
+def is_cjk(char):
+    return '一' <= char <= '鿿' or '㐀' <= char <= '䶿'
+
+
+def tokenize(text, query=False):
+    '''切分文本，返回词的列表 (可能重复)，query 为 True 时按查询切分'''
+    tokens = []
+    cjk, word = [], []
+
+    def end_cjk():
+        if len(cjk) == 1 or not query:
+            tokens.extend(cjk)
+        tokens.extend(cjk[i] + cjk[i + 1] for i in range(len(cjk) - 1))
+        cjk.clear()
+
+    def end_word():
+        tokens.append(''.join(word))
+        word.clear()
+
+    for char in text.lower():
+        if is_cjk(char):
+            if word:
+                end_word()
+            cjk.append(char)
+        elif char.isalnum():
+            if cjk:
+                end_cjk()
+            word.append(char)
+        else:
+            if cjk:
+                end_cjk()
+            if word:
+                end_word()
+    if cjk:
+        end_cjk()
+    if word:
+        end_word()
+    return tokens
+
+
+def encode_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def decode_postings(buf):
+    '''解码倒排表，依次返回 (微博 ID, 词频)'''
+    doc_id = 0
+    values = []
+    n = shift = 0
+    for byte in buf:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(n)
+        n = shift = 0
+        if len(values) == 2:
+            doc_id += values[0]
+            yield doc_id, values[1]
+            values.clear()
+
+
+class Postings:
+    '''一个词的倒排表'''
+    __slots__ = ('data', 'last', 'df')
+
+    def __init__(self):
+        self.data = bytearray()  # [ID 差值, 词频, ID 差值, 词频, ...]
+        self.last = 0            # 最后一个微博 ID
+        self.df = 0              # 包含该词的微博数量
+
+    def add(self, doc_id, tf):
+        if doc_id > self.last:
+            encode_varint(self.data, doc_id - self.last)
+            encode_varint(self.data, tf)
+            self.last = doc_id
+        else:
+            # ID 比已有的小 (很少发生)，重新编码整个倒排表
+            items = dict(decode_postings(self.data))
+            items[doc_id] = tf
+            self.data = bytearray()
+            self.last = 0
+            for _id in sorted(items):
+                encode_varint(self.data, _id - self.last)
+                encode_varint(self.data, items[_id])
+                self.last = _id
+        self.df += 1
+
+
+class SearchIndex:
+    '''微博内容的倒排索引'''
+
+    def __init__(self):
+        self.postings = {}               # {词: Postings}
+        self.doc_len = array('H')        # 以微博 ID 为下标的文档长度，0 代表未索引
+        self.created = array('I')        # 以微博 ID 为下标的发布时间 (时间戳)
+        self.n_docs = 0
+        self.total_len = 0
+        self.synced_id = 0               # 此 ID 之前的微博都已由 catch_up 索引
+        self.ready = False               # 加载或构建完成之前，只能搜到部分结果
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # open 和 catch_up 同一时间只有一个在执行
+
+    def add(self, wb_id, content, created):
+        '''将一条微博加入索引，已索引过的直接忽略'''
+        tokens = tokenize(content or '')
+        tf = {}
+        for token in tokens:
+            tf[token] = tf.get(token, 0) + 1
+
+        with self._lock:
+            if wb_id < len(self.doc_len) and self.doc_len[wb_id]:
+                return
+            if wb_id >= len(self.doc_len):
+                grow = wb_id + 1 - len(self.doc_len) + 1024
+                self.doc_len.extend(array('H', [0]) * grow)
+                self.created.extend(array('I', [0]) * grow)
+
+            length = max(1, min(len(tokens), 0xffff))
+            self.doc_len[wb_id] = length
+            self.created[wb_id] = int(created.timestamp()) if created else 0
+            self.n_docs += 1
+            self.total_len += length
+            for token, n in tf.items():
+                postings = self.postings.get(token)
+                if postings is None:
+                    postings = self.postings[token] = Postings()
+                postings.add(wb_id, n)
+
+    def search(self, session, query, page, per_page):
+        '''搜索微博，返回 (当前页的微博 ID 列表, 匹配的总数)'''
+        terms = set(tokenize(query, query=True))
+        if not terms:
+            return [], 0
+
+        # 只在锁内复制倒排表，解码和打分在锁外进行，不阻塞 add / catch_up
+        with self._lock:
+            postings = [self.postings.get(term) for term in terms]
+            if not all(postings) or not self.n_docs:
+                return [], 0
+            postings = sorted(((bytes(p.data), p.df) for p in postings),
+                              key=lambda p: p[1])  # 从最少的倒排表开始求交集
+            n_docs, avg_len = self.n_docs, self.total_len / self.n_docs
+            doc_len, created = self.doc_len, self.created
+
+        scores = None
+        for data, df in postings:
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            matched = {}
+            for doc_id, tf in decode_postings(data):
+                if scores is not None and doc_id not in scores:
+                    continue
+                norm = K1 * (1 - B + B * doc_len[doc_id] / avg_len)
+                matched[doc_id] = (scores[doc_id] if scores else 0) + \
+                    idf * tf * (K1 + 1) / (tf + norm)
+            scores = matched
+            if not scores:
+                return [], 0
+
+        # 初选：BM25 结合时间衰减
+        now = time.time()
+        for doc_id in scores:
+            age_days = max(0, now - created[doc_id]) / 86400
+            scores[doc_id] *= 0.5 + 0.5 * 0.5 ** (age_days / RECENCY_HALF_LIFE)
+
+        n_candidates = max(N_CANDIDATES, page * per_page)
+        candidates = sorted(scores, key=scores.get, reverse=True)[:n_candidates]
+
+        # 精排：结合点赞数
+        weibos = weibo_cache.get_many(session, candidates)
+        ranked = sorted((wb_id for wb_id in candidates if wb_id in weibos),
+                        key=lambda wb_id: scores[wb_id] *
+                        (1 + LIKE_WEIGHT * math.log1p(max(0, weibos[wb_id].like_count))),
+                        reverse=True)
+        return ranked[(page - 1) * per_page:page * per_page], len(scores)
+
+    def catch_up(self, batch_size=10000):
+        '''把数据库中尚未索引的微博加入索引
+
+        open 完成之前直接跳过，open 加载索引文件之后会自己补上
+        '''
+        if not self.ready:
+            return
+        with self._sync_lock:
+            self._catch_up(batch_size)
+
+    def _catch_up(self, batch_size=10000):
+        session = Session()
+        try:
+            while True:
+                rows = session.query(Weibo.id, Weibo.content, Weibo.created) \
+                              .filter(Weibo.id > self.synced_id) \
+                              .order_by(Weibo.id) \
+                              .limit(batch_size) \
+                              .all()
+                for wb_id, content, created in rows:
+                    self.add(wb_id, content, created)
+                if rows:
+                    self.synced_id = rows[-1][0]
+                if len(rows) < batch_size:
+                    break
+        finally:
+            session.close()
+
+    def save(self, path=None):
+        '''保存到磁盘，先写临时文件再替换'''
+        path = path or options.search_index_path
+        if not self.ready:
+            return  # 还没有加载完，不能覆盖已有的索引文件
+        with self._lock:
+            state = {
+                'version': INDEX_VERSION,
+                'postings': {token: (bytes(p.data), p.last, p.df)
+                             for token, p in self.postings.items()},
+                'doc_len': self.doc_len.tobytes(),
+                'created': self.created.tobytes(),
+                'n_docs': self.n_docs,
+                'total_len': self.total_len,
+                'synced_id': self.synced_id,
+            }
+        tmp = '%s.%d.tmp' % (path, os.getpid())  # 多个进程可能同时保存
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def load(self, path=None):
+        '''从磁盘加载，文件不存在或版本不符时返回 False'''
+        path = path or options.search_index_path
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != INDEX_VERSION:
+            return False
+
+        postings = {}
+        for token, (data, last, df) in state['postings'].items():
+            p = postings[token] = Postings()
+            p.data, p.last, p.df = bytearray(data), last, df
+        doc_len, created = array('H'), array('I')
+        doc_len.frombytes(state['doc_len'])
+        created.frombytes(state['created'])
+        with self._lock:
+            self.postings, self.doc_len, self.created = postings, doc_len, created
+            self.n_docs, self.total_len = state['n_docs'], state['total_len']
+            self.synced_id = state['synced_id']
+        return True
+
+    def open(self, path=None):
+        '''启动时加载索引文件，并补上之后新增的微博'''
+        with self._sync_lock:
+            loaded = self.load(path)
+            self._catch_up()
+            self.ready = True
+        if not loaded:
+            self.save(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='构建搜索索引')
+    parser.add_argument('--db', default=models.DB_URL, help='数据库地址')
+    parser.add_argument('--output', default=None, help='索引文件的路径')
+    args = parser.parse_args(argv)
+
+    models.init_engine(args.db)
+    started = time.time()
+    search_index.open(args.output)
+    search_index.save(args.output)
+    print('indexed %d weibos, %d terms in %.1fs' % (search_index.n_docs,
+                                                   len(search_index.postings),
+                                                   time.time() - started))
+
+
+search_index = SearchIndex()
+
+if __name__ == '__main__':
+    main()
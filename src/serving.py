@@ -0,0 +1,120 @@
+"""多进程服务
+
+主进程预先绑定端口，然后 fork 出多个工作进程共享同一个 socket。
+主进程只负责监控工作进程：
+    SIGTERM / SIGINT  通知所有工作进程处理完手上的请求后退出
+    SIGHUP            逐个重启工作进程 (先启动新进程，再让旧进程退出)
+工作进程异常退出时会被自动重启。
+所有的等待都在主循环中用 WNOHANG 轮询，逐个重启期间仍然能重启异常退出的进程、响应 SIGTERM。
+"""
+
+import os
+import time
+import signal
+import logging
+
+logger = logging.getLogger('tornado.general')
+
+
+class Supervisor:
+    '''监控工作进程的主进程'''
+
+    def __init__(self, n_workers, worker):
+        self.n_workers = n_workers
+        self.worker = worker    # 在子进程中执行的函数，参数为进程的编号
+        self.children = {}      # {pid: 进程编号}
+        self._stopping = False
+        self._reloading = False
+        self._restart_queue = []  # 等待替换的旧进程
+        self._replacing = None    # 正在等待退出的旧进程
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for idx in range(self.n_workers):
+            self.spawn(idx)
+
+        stop_sent = False
+        while self.children:
+            if self._stopping and not stop_sent:
+                self.kill_all()
+                self._restart_queue = []
+                stop_sent = True
+            if self._reloading and not self._stopping:
+                self._reloading = False
+                self.rolling_restart()
+            if not self._stopping:
+                self._restart_next()
+
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            self._reap(pid, status)
+
+    def spawn(self, idx):
+        '''启动一个工作进程'''
+        pid = os.fork()
+        if pid == 0:
+            # 子进程：恢复默认的信号处理，由工作进程自己负责优雅退出
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            try:
+                self.worker(idx)
+            except Exception:
+                logger.exception('worker %d crashed', idx)
+                os._exit(1)
+            os._exit(0)
+
+        logger.info('worker %d started, pid %d', idx, pid)
+        self.children[pid] = idx
+        return pid
+
+    def kill_all(self, sig=signal.SIGTERM):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def rolling_restart(self):
+        '''逐个替换工作进程，整个过程中始终有进程在处理请求，替换在主循环中逐步进行'''
+        self._restart_queue = [pid for pid in self.children if pid != self._replacing]
+
+    def _restart_next(self):
+        '''上一个旧进程退出之后，启动下一个新进程，并通知对应的旧进程退出'''
+        while self._replacing is None and self._restart_queue:
+            old_pid = self._restart_queue.pop(0)
+            idx = self.children.get(old_pid)
+            if idx is None:
+                continue  # 已经异常退出，_reap 中重启过了
+            self.spawn(idx)
+            try:
+                os.kill(old_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self._replacing = old_pid
+
+    def _reap(self, pid, status):
+        '''处理退出的工作进程'''
+        idx = self.children.pop(pid, None)
+        if idx is None:
+            return
+        if pid == self._replacing:
+            self._replacing = None
+            logger.info('worker %d (pid %d) replaced', idx, pid)
+        elif self._stopping:
+            logger.info('worker %d (pid %d) exited', idx, pid)
+        else:
+            logger.warning('worker %d (pid %d) exited unexpectedly with status %d, restarting',
+                           idx, pid, status)
+            time.sleep(1)  # 避免进程启动即崩溃时反复重启
+            self.spawn(idx)
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
@@ -0,0 +1,116 @@
+"""登陆会话
+
+cookie 中只保存会话 ID，使用 Tornado 的 secure cookie 签名，客户端无法伪造。
+会话数据保存在后端存储中 (默认为数据库的 session 表，多个工作进程共享)，
+每个进程在前面加一层 LRU 缓存，大部分请求不需要访问后端存储。
+
+其他进程中注销的会话，最多在 --session_cache_ttl 秒后从本进程的缓存中失效。
+"""
+
+import os
+import secrets
+import datetime
+
+from tornado.options import define, options
+
+from models import Session, UserSession
+from cache import LRUCache
+
+define('cookie_secret', default=os.environ.get('WEIBO_COOKIE_SECRET') or secrets.token_hex(32),
+       help='签名 cookie 的密钥，多台服务器部署时必须设置为相同的值')
+define('session_days', default=30, type=int, help='登陆会话的有效期 (天)')
+define('session_cache_size', default=100000, type=int, help='每个进程缓存的会话数量上限')
+define('session_cache_ttl', default=60, type=int, help='会话在进程内缓存的有效期 (秒)')
+
+
+class SessionBackend:
+    '''会话的后端存储接口，可以替换为 Redis 等外部存储'''
+
+    def get(self, db, sid):
+        '''取出会话，返回 (user_id, 过期时间)，不存在时返回 None'''
+        raise NotImplementedError
+
+    def put(self, db, sid, user_id, expires):
+        raise NotImplementedError
+
+    def delete(self, db, sid):
+        raise NotImplementedError
+
+    def purge(self, db, now):
+        '''删除已过期的会话'''
+        raise NotImplementedError
+
+
+class DatabaseSessionBackend(SessionBackend):
+    '''保存在数据库的 session 表中，db 为数据库会话'''
+
+    def get(self, db, sid):
+        row = db.query(UserSession.user_id, UserSession.expires).filter_by(id=sid).first()
+        return tuple(row) if row is not None else None
+
+    def put(self, db, sid, user_id, expires):
+        db.add(UserSession(id=sid, user_id=user_id, expires=expires))
+        db.commit()
+
+    def delete(self, db, sid):
+        db.query(UserSession).filter_by(id=sid).delete()
+        db.commit()
+
+    def purge(self, db, now):
+        db.query(UserSession).filter(UserSession.expires < now).delete()
+        db.commit()
+
+
+class SessionStore:
+    '''会话存储：进程内的 LRU 缓存 + 后端存储'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lru = LRUCache()  # {sid: (user_id, 过期时间)}
+
+    def configure(self, max_size, ttl):
+        self.lru.configure(max_size, ttl)
+
+    def create(self, db, user_id):
+        '''创建新的会话，返回会话 ID'''
+        sid = secrets.token_urlsafe(32)
+        expires = datetime.datetime.now() + datetime.timedelta(days=options.session_days)
+        self.backend.put(db, sid, user_id, expires)
+        self.lru.set_many({sid: (user_id, expires)})
+        return sid
+
+    def peek(self, sid):
+        '''只从缓存中取出会话对应的用户 ID，未缓存或已过期时返回 None'''
+        item = self.lru.get_many([sid]).get(sid)
+        if item is None or item[1] < datetime.datetime.now():
+            return None
+        return item[0]
+
+    def get(self, db, sid):
+        '''取出会话对应的用户 ID，会话不存在或已过期时返回 None'''
+        item = self.lru.get_many([sid]).get(sid)
+        if item is None:
+            item = self.backend.get(db, sid)
+            if item is None:
+                return None
+            self.lru.set_many({sid: item})
+        user_id, expires = item
+        return user_id if expires >= datetime.datetime.now() else None
+
+    def delete(self, db, sid):
+        self.lru.delete(sid)
+        self.backend.delete(db, sid)
+
+    def purge(self):
+        '''清理过期的会话，由后台任务定期执行'''
+        db = Session()
+        try:
+            self.backend.purge(db, datetime.datetime.now())
+        finally:
+            db.close()
+
+    def stats(self):
+        return self.lru.stats()
+
+
+session_store = SessionStore(DatabaseSessionBackend())
@@ -0,0 +1,142 @@
+"""静态文件
+
+启动时把 statics 目录下的文件全部读入内存，同时准备好压缩后的版本：
+目录中已有 xxx.gz / xxx.br 时直接使用，否则在启动时压缩 (brotli 为可选依赖，没有安装时只提供 gzip)。
+多进程部署时在 fork 之前加载，所有工作进程共享同一份内存。
+
+模板中使用 static_url() 生成带内容哈希的地址 (/static/css/x.css?v=<hash>)，
+带哈希的请求返回很长的缓存时间，文件内容变化后地址随之变化。
+"""
+
+import os
+import gzip
+import datetime
+import hashlib
+import mimetypes
+
+import tornado.web
+from tornado.options import define, options
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+define('static_max_file_size', default=4 * 1024 * 1024, type=int,
+       help='读入内存的静态文件大小上限 (字节)，更大的文件从磁盘读取')
+
+mimetypes.add_type('application/json', '.map')  # source map
+
+# 压缩效果明显的文件类型
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class StaticFile:
+    '''内存中的一个静态文件'''
+    __slots__ = ('data', 'gzip', 'br', 'version', 'mtime', 'content_type')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.version = hashlib.md5(self.data).hexdigest()  # 与 StaticFileHandler 的哈希相同
+        self.mtime = os.path.getmtime(path)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.gzip = self.br = None
+        if self.content_type.startswith(COMPRESSIBLE):
+            self.gzip = self._variant(path + '.gz', lambda data: gzip.compress(data, 9, mtime=0))
+            # 没有安装 brotli 时，只使用预先压缩好的 .br 文件
+            self.br = self._variant(path + '.br', brotli and brotli.compress)
+
+    def _variant(self, path, compress):
+        '''压缩后的版本，优先使用预先压缩好的文件
+
+        预先压缩的文件不存在或已过期、又没有压缩函数 (compress 为 None) 时，以及压缩没有效果时返回 None
+        '''
+        if os.path.exists(path) and os.path.getmtime(path) >= self.mtime:
+            with open(path, 'rb') as f:
+                data = f.read()
+        elif compress is not None:
+            data = compress(self.data)
+        else:
+            return None
+        return data if len(data) < len(self.data) else None
+
+    def select(self, accept_encoding):
+        '''根据 Accept-Encoding 选择返回的版本，返回 (编码, 内容)'''
+        if self.br is not None and 'br' in accept_encoding:
+            return 'br', self.br
+        if self.gzip is not None and 'gzip' in accept_encoding:
+            return 'gzip', self.gzip
+        return None, self.data
+
+
+class StaticFiles:
+    '''内存中的所有静态文件 {绝对路径: StaticFile}'''
+
+    def __init__(self):
+        self.files = {}
+
+    def load(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.startswith('.') or name.endswith(('.gz', '.br')):
+                    continue
+                if os.path.getsize(path) <= options.static_max_file_size:
+                    self.files[os.path.abspath(path)] = StaticFile(path)
+
+    def get(self, abspath):
+        return self.files.get(abspath)
+
+    def stats(self):
+        return {
+            'files': len(self.files),
+            'bytes': sum(len(f.data) for f in self.files.values()),
+            'gzip_bytes': sum(len(f.gzip or f.data) for f in self.files.values()),
+            'br_bytes': sum(len(f.br or f.data) for f in self.files.values()),
+        }
+
+
+static_files = StaticFiles()
+
+
+class MemoryStaticFileHandler(tornado.web.StaticFileHandler):
+    '''从内存中返回静态文件，不在内存中的文件和 Range 请求交给 StaticFileHandler 处理'''
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        item = static_files.get(abspath)
+        return item.version if item is not None else super().get_content_version(abspath)
+
+    def get(self, path, include_body=True):
+        abspath = os.path.abspath(os.path.join(self.root, self.parse_url_path(path)))
+        item = static_files.get(abspath)
+        if item is None or 'Range' in self.request.headers:
+            return super().get(path, include_body)
+
+        self.path, self.absolute_path = path, abspath
+        self.set_header('Etag', '"%s"' % item.version)
+        self.set_header('Content-Type', item.content_type)
+        self.set_header('Vary', 'Accept-Encoding')
+        self.modified = self.get_modified_time()
+        self.set_header('Last-Modified', self.modified)
+        cache_time = self.get_cache_time(path, self.modified, item.content_type)
+        if cache_time > 0:
+            self.set_header('Cache-Control', 'max-age=%d, public, immutable' % cache_time)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        encoding, data = item.select(self.request.headers.get('Accept-Encoding', ''))
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        self.set_header('Content-Length', len(data))
+        if include_body:
+            self.write(data)
+
+    def get_modified_time(self):
+        item = static_files.get(self.absolute_path)
+        if item is None:
+            return super().get_modified_time()
+        return datetime.datetime.utcfromtimestamp(int(item.mtime))
@@ -0,0 +1,110 @@
+"""事件总线的订阅者：写操作提交后的副作用
+
+每个订阅者各自一个队列，一批事件在线程池中处理，互相之间不影响。
+事件可能被重放，副作用不幂等的订阅者 (计数、通知) 用 once=True 订阅，并标记处理过的事件。
+"""
+
+from models import Session, Comment, ArchivedComment
+from events import event_bus, WeiboPosted, CommentPosted, LikeChanged, FollowChanged
+from cache import weibo_cache
+from counters import counter_buffer
+from leaderboard import leaderboard
+from pagecache import page_cache
+from timeline import timeline
+from graph import graph
+from search import search_index
+from notifications import notifications
+
+
+def load_weibos(session, events):
+    '''批量取出新发布的微博，按发布顺序返回'''
+    wb_ids = [evt.wb_id for evt in events if isinstance(evt, WeiboPosted)]
+    weibos = weibo_cache.get_many(session, wb_ids)
+    return [weibos[wb_id] for wb_id in wb_ids if wb_id in weibos]
+
+
+def update_social(events):
+    '''更新关系图和时间线：关注关系变化后重建时间线，新微博推送到粉丝的收件箱'''
+    session = Session()
+    try:
+        for evt in events:
+            if isinstance(evt, FollowChanged):
+                if evt.status:
+                    graph.follow(evt.user_id, evt.follow_id)
+                else:
+                    graph.unfollow(evt.user_id, evt.follow_id)
+                timeline.invalidate(evt.user_id)
+        for weibo in load_weibos(session, events):
+            timeline.fanout(session, weibo)
+    finally:
+        session.close()
+
+
+def update_search(events):
+    '''新微博加入搜索索引'''
+    session = Session()
+    try:
+        for weibo in load_weibos(session, events):
+            search_index.add(weibo.id, weibo.content, weibo.created)
+    finally:
+        session.close()
+
+
+def update_counters(events):
+    '''更新点赞数、评论数和热门榜单，事件随计数一起写回时标记'''
+    for evt in events:
+        if isinstance(evt, LikeChanged):
+            delta = 1 if evt.status else -1
+            counter_buffer.add(evt.wb_id, like=delta)
+            leaderboard.incr(evt.wb_id, delta)
+        else:
+            counter_buffer.add(evt.wb_id, comment=1)
+    counter_buffer.applied(*event_bus.current_batch())
+
+
+def invalidate_pages(events):
+    '''使受影响的页面缓存失效'''
+    tags = set()
+    for evt in events:
+        if isinstance(evt, WeiboPosted):
+            tags.add('home')
+        else:
+            tags.add('weibo:%s' % evt.wb_id)
+    page_cache.invalidate(*tags)
+
+
+def send_notifications(events):
+    '''通知被回复的评论的作者、被点赞的微博的作者、被关注的用户'''
+    session = Session()
+    try:
+        liked = {evt.wb_id for evt in events if isinstance(evt, LikeChanged) and evt.status}
+        weibos = weibo_cache.get_many(session, liked)
+        replied = {evt.cmt_id for evt in events if isinstance(evt, CommentPosted) and evt.cmt_id}
+        authors = {}  # {评论 ID: 评论的作者}
+        for model in (Comment, ArchivedComment):  # 被回复的评论可能在已归档的微博下
+            missing = replied - authors.keys()
+            if missing:
+                authors.update(session.query(model.id, model.user_id).filter(model.id.in_(missing)))
+
+        items = []  # [(接收的用户, 类型, 目标, 操作的用户), ...]
+        for evt in events:
+            if isinstance(evt, CommentPosted) and evt.cmt_id:
+                items.append((authors.get(evt.cmt_id), 'reply', evt.wb_id, evt.user_id))
+            elif isinstance(evt, LikeChanged) and evt.status and evt.wb_id in weibos:
+                items.append((weibos[evt.wb_id].user_id, 'like', evt.wb_id, evt.user_id))
+            elif isinstance(evt, FollowChanged) and evt.status:
+                items.append((evt.follow_id, 'follow', 0, evt.user_id))
+        event_bus.mark_applied(session, *event_bus.current_batch())  # 与通知一起提交
+        notifications.notify(session, items)
+        session.commit()  # 没有需要写入的通知时，notify 不会提交
+    finally:
+        session.close()
+
+
+event_bus.subscribe('social', (WeiboPosted, FollowChanged), update_social)
+event_bus.subscribe('search', (WeiboPosted, ), update_search)
+event_bus.subscribe('counters', (LikeChanged, CommentPosted), update_counters,
+                    once=True, buffered=True)
+event_bus.subscribe('cache', (WeiboPosted, LikeChanged, CommentPosted), invalidate_pages)
+event_bus.subscribe('notify', (CommentPosted, LikeChanged, FollowChanged), send_notifications,
+                    once=True)
@@ -0,0 +1,179 @@
+"""关注的人的微博时间线 (写扩散)
+
+用户发微博时，把微博 ID 推送到每个粉丝的收件箱中，读取时间线时只需要读自己的收件箱。
+粉丝数超过阈值的大 V 不做推送，在读取时间线时再合并他们的最新微博。
+推送只发生在发布微博的进程中，其他进程的收件箱在 --inbox_ttl 秒后过期，读取时重建。
+"""
+
+import time
+import threading
+from collections import OrderedDict, deque
+from heapq import merge
+from itertools import islice
+
+from sqlalchemy import func
+from tornado.options import define, options
+
+from models import Weibo, Follow
+from graph import graph
+
+define('inbox_size', default=800, type=int, help='每个用户收件箱中最多保留的微博数量')
+define('inbox_users', default=100000, type=int, help='内存中最多保留的收件箱数量')
+define('inbox_ttl', default=60, type=int, help='收件箱的有效期 (秒)，多进程时其他进程推送的微博在过期后可见')
+define('celebrity_threshold', default=10000, type=int, help='粉丝数超过该值的用户不做写扩散')
+
+
+class Inbox:
+    '''单个用户的收件箱'''
+
+    def __init__(self, items, celebrities, size):
+        self.items = deque(items, maxlen=size)  # [(created, wb_id), ...]，按时间降序
+        self.celebrities = set(celebrities)     # 关注的大 V，读取时合并
+
+
+class InboxStore:
+    '''收件箱存储的接口，可以替换为 Redis 等外部存储'''
+
+    def get(self, user_id):
+        '''取出收件箱，不存在时返回 None'''
+        raise NotImplementedError
+
+    def put(self, user_id, inbox):
+        '''保存整个收件箱'''
+        raise NotImplementedError
+
+    def push(self, user_id, item, celebrity=None):
+        '''向已存在的收件箱中推送一条微博，celebrity 不为空时将其记为大 V'''
+        raise NotImplementedError
+
+    def drop(self, user_id):
+        '''删除收件箱，下次读取时重建'''
+        raise NotImplementedError
+
+
+class MemoryInboxStore(InboxStore):
+    '''进程内的收件箱存储，超过数量上限时淘汰最久未使用的收件箱，过期的收件箱视为不存在'''
+
+    def __init__(self, max_users=None):
+        self.max_users = max_users  # 为 None 时使用 --inbox_users 的配置
+        self._inboxes = OrderedDict()  # {user_id: (Inbox, 过期时间)}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            inbox, expires = self._inboxes.get(user_id, (None, 0))
+            if inbox is None:
+                return None
+            if expires <= time.time():
+                del self._inboxes[user_id]
+                return None
+            self._inboxes.move_to_end(user_id)
+            return inbox
+
+    def put(self, user_id, inbox):
+        with self._lock:
+            self._inboxes[user_id] = (inbox, time.time() + options.inbox_ttl)
+            self._inboxes.move_to_end(user_id)
+            max_users = self.max_users or options.inbox_users
+            while len(self._inboxes) > max_users:
+                self._inboxes.popitem(last=False)
+
+    def push(self, user_id, item, celebrity=None):
+        with self._lock:
+            inbox, _ = self._inboxes.get(user_id, (None, 0))
+            if inbox is not None:
+                inbox.items.appendleft(item)
+                if celebrity is not None:
+                    inbox.celebrities.add(celebrity)
+
+    def drop(self, user_id):
+        with self._lock:
+            self._inboxes.pop(user_id, None)
+
+
+class Timeline:
+    '''关注的人的微博时间线'''
+
+    def __init__(self, store):
+        self.store = store
+        self._celebrities = set()  # 已知的大 V
+        self._lock = threading.Lock()
+
+    def fanout(self, session, weibo):
+        '''新微博发布后，推送到粉丝的收件箱中'''
+        author_id = weibo.user_id
+        if author_id in self._celebrities:
+            return  # 大 V 的微博在读取时合并
+
+        fans_ids = graph.followers(session, author_id)
+        is_celebrity = len(fans_ids) >= options.celebrity_threshold
+        if is_celebrity:
+            # 刚成为大 V：最后推送一次，并通知已有的收件箱以后改为读取时合并
+            with self._lock:
+                self._celebrities.add(author_id)
+
+        item = (weibo.created, weibo.id)
+        for fans_id in fans_ids:
+            self.store.push(fans_id, item, author_id if is_celebrity else None)
+
+    def invalidate(self, user_id):
+        '''关注关系变化后，丢弃收件箱，下次读取时回填'''
+        self.store.drop(user_id)
+
+    def page(self, session, user_id, page, per_page):
+        '''取出时间线中指定页的微博 ID'''
+        inbox = self.store.get(user_id)
+        if inbox is None:
+            inbox = self.backfill(session, user_id)
+
+        need = page * per_page
+        items = list(islice(inbox.items, need))
+        if inbox.celebrities:
+            # 合并大 V 的最新微博
+            celebrity_items = session.query(Weibo.created, Weibo.id) \
+                                     .filter(Weibo.user_id.in_(inbox.celebrities)) \
+                                     .order_by(Weibo.created.desc(), Weibo.id.desc()) \
+                                     .limit(need) \
+                                     .all()
+            items = merge(items, celebrity_items, reverse=True)
+
+        wb_ids = unique(wb_id for _, wb_id in items)  # 刚成为大 V 时推送过的微博可能重复
+        return list(islice(wb_ids, need - per_page, need))
+
+    def backfill(self, session, user_id):
+        '''从数据库中重建收件箱'''
+        follow_ids = list(graph.following(session, user_id))
+
+        # 找出关注的人中的大 V
+        celebrities = set()
+        if follow_ids:
+            counts = session.query(Follow.follow_id) \
+                            .filter(Follow.follow_id.in_(follow_ids), Follow.status.is_(True)) \
+                            .group_by(Follow.follow_id) \
+                            .having(func.count(1) >= options.celebrity_threshold)
+            celebrities = {fid for (fid, ) in counts}
+        normal_ids = [fid for fid in follow_ids if fid not in celebrities]
+
+        items = []
+        if normal_ids:
+            items = session.query(Weibo.created, Weibo.id) \
+                           .filter(Weibo.user_id.in_(normal_ids)) \
+                           .order_by(Weibo.created.desc(), Weibo.id.desc()) \
+                           .limit(options.inbox_size) \
+                           .all()
+
+        inbox = Inbox(items, celebrities, options.inbox_size)
+        self.store.put(user_id, inbox)
+        return inbox
+
+
+def unique(iterable):
+    '''去重，保持原有顺序'''
+    seen = set()
+    for item in iterable:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+timeline = Timeline(MemoryInboxStore())
@@ -1,42 +1,185 @@
+import time
 import datetime
+from functools import wraps
 from math import ceil
-from hashlib import sha256
 
 import tornado.web
-from pymysql import err
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
+from tornado.options import define, options
+from sqlalchemy import and_, or_
 from sqlalchemy.orm.exc import NoResultFound
-from models import User, Weibo, Comment, Session, Like, Follow
+from models import User, Weibo, Comment, ArchivedComment, Session, Like, run_in_db, replica_pool
+from rows import comment_row
+from leaderboard import leaderboard
+from counters import counter_buffer
+from pagination import ApproxRowCount, encode_cursor, decode_cursor, page_window
+from timeline import timeline
+from graph import graph, contains
+from writequeue import write_queue
+from search import search_index
+from credentials import hash_password, check_password, login_throttle
+from comments import load_comment_tree
+from cache import user_cache, weibo_cache
+from profiler import profiler
+from pagecache import page_cache, top10_fragment, cache_page
+from sessions import session_store
+from staticfiles import static_files
+from ratelimit import rate_limiter
+from events import event_bus, emit, WeiboPosted, CommentPosted
+from notifications import notifications, KINDS
+
+define('read_your_writes', default=5, type=int,
+       help='用户写入数据后，在多少秒内的请求读取主库而不是从库')
+
+weibo_count = ApproxRowCount(Weibo)  # 微博总数的近似值
 
 
 def login_required(view_func):
     '''检查用户是否登陆'''
 
+    @wraps(view_func)
     def wrapper(self, *args, **kwargs):
-        user_id = self.get_cookie('user_id')  # 取出用户 ID
-        if user_id is None:
-            # user_id 是 None 值，说明用户没有登陆
+        if self.current_user is None:
+            # 没有有效的会话，说明用户没有登陆
             return self.redirect('/user/login')
         else:
             return view_func(self, *args, **kwargs)
     return wrapper
 
 
-class RegisterHandler(tornado.web.RequestHandler):
+class BaseHandler(tornado.web.RequestHandler):
+    '''视图类的基类
+
+    每个请求使用一个独立的数据库会话，在 initialize 中创建，在 on_finish 中关闭；
+    不支持的请求方法在 prepare 之前就返回 405，同样会调用 on_finish。
+    数据库操作通过 run_in_db 放到线程池中执行，不会阻塞 IOLoop。
+    每次 run_in_db 执行完后关闭会话、归还连接，请求在两次数据库操作之间 (渲染、等待) 不占用连接；
+    否则线程池排满时，归还连接的操作排在等待连接的操作后面，会互相卡住。
+    登陆的用户在 prepare 中取出，保存在 current_user 中，视图和模板直接使用。
+    未读通知数同样在 prepare 中取出，保存在 n_unread 中，显示在导航栏。
+
+    路由表中可以为视图指定限流规则 (rate_limit)，在取出登陆的用户之后检查。
+
+    GET 请求的查询读取从库。用户写入数据之后，在 --read_your_writes 秒内带有 rw cookie，
+    这期间的请求读取主库，保证用户能看到自己刚写入的数据。
+    '''
+
+    in_flight = 0       # 处理中的请求数，优雅退出时使用
+    retry_after = None  # 被限流时，客户端需要等待的秒数
+
+    def initialize(self, rate_limit=None):
+        self.rate_limit = rate_limit  # 限流规则 (ratelimit.RateLimit)
+        BaseHandler.in_flight += 1
+        self.stats = profiler.begin(type(self).__name__)
+        use_replica = self.request.method in ('GET', 'HEAD') and not self.get_cookie('rw')
+        self.session = Session(use_replica=use_replica)
+
+    def set_default_headers(self):
+        if self.retry_after:
+            self.set_header('Retry-After', self.retry_after)  # 错误页面也保留这个头
+
+    async def prepare(self):
+        self.sid = self.get_secure_cookie('sid', max_age_days=options.session_days)
+        if self.sid is not None:
+            self.sid = self.sid.decode()
+        self.current_user = await self.load_current_user()
+        self.check_rate_limit()
+        self.n_unread = await self.load_unread()
+
+    async def load_current_user(self):
+        '''取出当前登陆的用户，会话和用户都已缓存时不访问数据库'''
+        if self.sid is None:
+            return None
+        user_id = session_store.peek(self.sid)
+        user = user_cache.peek(user_id) if user_id is not None else None
+        if user is None:
+            user = await self.run_in_db(self.load_user, self.sid)
+        return user
+
+    def load_user(self, sid):
+        user_id = session_store.get(self.session, sid)
+        return user_cache.get(self.session, user_id) if user_id is not None else None
+
+    def check_rate_limit(self):
+        '''超出限流规则时返回 429'''
+        if self.rate_limit is None or not self.rate_limit.applies(self.request.method):
+            return
+        user_id = self.current_user.id if self.current_user else None
+        wait = rate_limiter.check(self.rate_limit, user_id, self.request.remote_ip)
+        if wait:
+            self.retry_after = ceil(wait)
+            raise tornado.web.HTTPError(429)
+
+    async def load_unread(self):
+        '''当前用户的未读通知数，已缓存时不访问数据库'''
+        if self.current_user is None:
+            return 0
+        n_unread = notifications.peek_unread(self.current_user.id)
+        if n_unread is None:
+            n_unread = await self.run_in_db(notifications.unread_count,
+                                            self.session, self.current_user.id)
+        return n_unread
+
+    def get_template_namespace(self):
+        namespace = super().get_template_namespace()
+        namespace['top10_html'] = self.top10_html
+        namespace['n_unread'] = getattr(self, 'n_unread', 0)
+        return namespace
+
+    def top10_html(self):
+        '''热门微博侧边栏，渲染结果在所有页面间共享'''
+        return top10_fragment.get(lambda: self.render_string('top10.html', top10=top10()))
+
+    def render_string(self, template_name, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render_string(template_name, **kwargs)
+        finally:
+            self.stats.render_time += time.perf_counter() - started
+
+    def mark_written(self):
+        '''记录当前用户刚刚写入了数据，之后一段时间内的请求读取主库'''
+        self.set_cookie('rw', '1', max_age=options.read_your_writes)
+
+    def finish(self, chunk=None):
+        if not self._headers_written:
+            self.set_header('Server-Timing', self.stats.server_timing())
+            if self.request.method not in ('GET', 'HEAD') or self.session.wrote:
+                self.mark_written()
+        key = getattr(self, 'page_cache_key', None)
+        if key is not None and chunk is not None and self.get_status() == 200:
+            # 保存匿名用户的页面，本次请求也使用同样的 ETag
+            self.set_header('Etag', page_cache.set(key, chunk))
+            if self.check_etag_header():
+                self.set_status(304)
+                chunk = None
+        return super().finish(chunk)
+
+    def on_finish(self):
+        BaseHandler.in_flight -= 1
+        profiler.end(self.stats, self.request, self.get_status())
+        # 连接在每次 run_in_db 之后已经归还，这里只清空会话，不访问数据库
+        self.session.close()
+
+    def run_in_db(self, func, *args):
+        '''在线程池中执行数据库操作，执行完后归还连接'''
+        return run_in_db(self._unit_of_work, func, *args)
+
+    def _unit_of_work(self, func, *args):
+        try:
+            return func(*args)
+        finally:
+            # 未提交的修改随之回滚；已加载的属性在关闭后仍然可以读取
+            self.session.close()
+
+
+class RegisterHandler(BaseHandler):
     '''用户注册视图类'''
-    @staticmethod
-    def gen_password(password):
-        '''产生一个安全的密码'''
-        bytes_code = password.encode('utf8')  # 将密码转成 bytes 类型
-        hash_code = sha256(bytes_code)        # 对上一步结果进行 sha256 的 hash 运算
-        return hash_code.hexdigest()          # 返回 16 进制的 hash 值
 
     def get(self):
         '''显示注册页面'''
-        return self.render('register.html', top10=top10())
+        return self.render('register.html')
 
-    def post(self):
+    async def post(self):
         '''接收用户提交的信息，写入到数据库'''
         # 获取参数
         nickname = self.get_argument('nickname')
@@ -45,399 +188,554 @@ class RegisterHandler(tornado.web.RequestHandler):
         city = self.get_argument('city')
         bio = self.get_argument('bio')
 
-        safe_password = self.gen_password(password)  # 产生安全密码
+        safe_password = await hash_password(password)  # 产生安全密码
 
         # 将用户数据写入数据库
-        session = Session()
         user = User(nickname=nickname, password=safe_password,
                     gender=gender, city=city, bio=bio)
-        session.add(user)
-        session.commit()
+        await self.run_in_db(self.save, user)
 
         # 注册完成后，跳转到登陆页面
         return self.redirect('/user/login')
 
+    def save(self, user):
+        self.session.add(user)
+        self.session.commit()
+        user_cache.invalidate(user.id)
 
-class LoginHandler(tornado.web.RequestHandler):
+
+class LoginHandler(BaseHandler):
     '''用户登陆视图类'''
 
     def get(self):
         '''显示登陆页面'''
-        return self.render('login.html', warning='', top10=top10())
+        return self.render('login.html', warning='')
 
-    def post(self):
+    async def post(self):
         '''登陆过程'''
         # 获取参数
         nickname = self.get_argument('nickname')
         password = self.get_argument('password')
 
-        safe_password = RegisterHandler.gen_password(password)  # 产生安全密码
+        # 连续失败次数过多时，不再检查密码
+        if login_throttle.is_locked(nickname):
+            return self.render('login.html', warning='登陆失败次数过多，请稍后再试！')
 
         # 获取用户
-        session = Session()
-        q_user = session.query(User)
         try:
-            user = q_user.filter_by(nickname=nickname).one()
+            user = await self.run_in_db(self.load, nickname)
         except NoResultFound:
-            return self.render('login.html', warning='您的用户名错误！', top10=top10())
+            login_throttle.fail(nickname)
+            return self.render('login.html', warning='您的用户名错误！')
 
         # 检查密码
-        if user.password == safe_password:
-            self.set_cookie('user_id', str(user.id))  # 服务器通知客户端设置一个叫 'uid' 的 cookie 值
+        ok, new_password = await check_password(password, user.password)
+        if ok:
+            login_throttle.reset(nickname)
+            if new_password is not None:
+                # 旧格式的密码，换成新的格式
+                await self.run_in_db(self.update_password, user.id, new_password)
+            # 创建会话，会话 ID 保存在签名的 cookie 中
+            sid = await self.run_in_db(session_store.create, self.session, user.id)
+            self.set_secure_cookie('sid', sid, expires_days=options.session_days)
             # 跳转到用户信息页
             return self.redirect('/user/info')
         else:
-            return self.render('login.html', warning='您的密码错误！', top10=top10())
+            login_throttle.fail(nickname)
+            return self.render('login.html', warning='您的密码错误！')
+
+    def load(self, nickname):
+        return self.session.query(User).filter_by(nickname=nickname).one()
+
+    def update_password(self, user_id, password):
+        self.session.query(User).filter_by(id=user_id).update({'password': password})
+        self.session.commit()
+        user_cache.invalidate(user_id)
+
+
+class LogoutHandler(BaseHandler):
+    '''注销'''
 
+    async def get(self):
+        if self.sid is not None:
+            await self.run_in_db(session_store.delete, self.session, self.sid)
+        self.clear_cookie('sid')
+        return self.redirect('/')
 
-class UserinfoHandler(tornado.web.RequestHandler):
+
+class UserinfoHandler(BaseHandler):
     '''用户个人信息视图类'''
 
-    def get(self):
-        user_id = self.get_cookie('user_id')           # 取出自己的 ID
+    async def get(self):
+        me = self.current_user                         # 当前登陆的用户
         other_id = self.get_argument('user_id', None)  # 取出要查看的其他人的 ID
 
-        session = Session()
-        q_user = session.query(User)
-
-        if user_id is None and other_id is None:
+        if me is None and other_id is None:
             # 如果用户未登陆，查看自己页面时，直接跳到登陆页面
             return self.redirect('/user/login')
-        elif user_id is None and other_id is not None:
+
+        data = await self.run_in_db(self.load, me, other_id)
+        if data['user'] is None:
+            raise tornado.web.HTTPError(404)
+        return self.render('info.html', **data)
+
+    def load(self, me, other_id):
+        session = self.session
+        n_mutual = None       # 互相关注的人数，只在查看自己的页面时显示
+        common_follows = []   # 自己关注的人中，也关注了对方的用户
+
+        if me is None and other_id is not None:
             # 未登陆时查看别人的主页
-            user = q_user.get(other_id)
+            user = user_cache.get(session, other_id)
             is_followed = False
-        elif user_id is not None and other_id is None:
+        elif me is not None and other_id is None:
             # 登陆的情况下查看自己的页面
-            user = q_user.get(user_id)
+            user = me
             is_followed = None
-        elif user_id is not None and other_id is not None:
+            n_mutual = len(graph.mutual(session, me.id))
+        else:
             # 登陆时查看别人的主页
-            user = q_user.get(other_id)
-            # 检查自己是否关注过该用户
-            exists = session.query(Follow) \
-                            .filter_by(user_id=user_id, follow_id=other_id, status=True) \
-                            .exists()
-            is_followed = session.query(exists).scalar()
-
-        return self.render('info.html', user=user, is_followed=is_followed, top10=top10())
-
-
-class PostWeiboHandler(tornado.web.RequestHandler):
+            user = user_cache.get(session, other_id)
+            # 检查自己是否关注过该用户，优先使用尚未写入数据库的状态
+            is_followed = write_queue.pending('follow', me.id, int(other_id))
+            if is_followed is None:
+                is_followed = graph.is_following(session, me.id, other_id)
+            common_ids = graph.followed_by_following(session, me.id, other_id)[:5]
+            users = user_cache.get_many(session, common_ids)
+            common_follows = [users[uid] for uid in common_ids if uid in users]
+
+        if user is None:
+            return dict(user=None)
+        return dict(user=user, is_followed=is_followed,
+                    n_followers=len(graph.followers(session, user.id)),
+                    n_following=len(graph.following(session, user.id)),
+                    n_mutual=n_mutual, common_follows=common_follows)
+
+
+class PostWeiboHandler(BaseHandler):
     '''发送微博页面'''
 
     def get(self):
-        return self.render('post_wb.html', top10=top10())
+        return self.render('post_wb.html')
 
     @login_required
-    def post(self):
-        user_id = int(self.get_cookie('user_id'))
+    async def post(self):
+        user_id = self.current_user.id
         content = self.get_argument('content')
 
         # 保存微博数据
-        session = Session()
         weibo = Weibo(user_id=user_id, content=content, created=datetime.datetime.now())
-        session.add(weibo)
-        session.commit()
+        await event_bus.backpressure()
+        wb_id = await self.run_in_db(self.save, weibo)
 
         # 创建完成后，跳到显示页面
-        return self.redirect('/weibo/show?weibo_id=%s' % weibo.id)
+        return self.redirect('/weibo/show?weibo_id=%s' % wb_id)
+
+    def save(self, weibo):
+        self.session.add(weibo)
+        self.session.flush()
+        # 推送到粉丝的收件箱、加入搜索索引等由事件的订阅者完成
+        emit(self.session, WeiboPosted(weibo.id, weibo.user_id))
+        self.session.commit()
+        weibo_cache.invalidate(weibo.id)
+        return weibo.id
 
 
-class ShowWeiboHandler(tornado.web.RequestHandler):
+class ShowWeiboHandler(BaseHandler):
     '''查看单条微博页面'''
 
-    def get(self):
+    @cache_page(lambda self: 'weibo:%s' % self.get_argument('weibo_id'))
+    async def get(self):
         weibo_id = int(self.get_argument('weibo_id'))  # 提取参数
+        page = int(self.get_argument('page', 1))       # 评论的页码
+        per_page_size = 20                             # 每页显示的楼层数
+        user_id = self.current_user.id if self.current_user else None
 
-        session = Session()
-        weibo = session.query(Weibo).get(weibo_id)       # 从数据库获取微博数据
-        author = session.query(User).get(weibo.user_id)  # 根据微博记录的作者 id 获取用户数据
+        data = await self.run_in_db(self.load, weibo_id, user_id, page, per_page_size)
+        return self.render('show_wb.html', cur_page=page, **data)
 
-        # 取出当前微博所有的评论
-        all_comments = session.query(Comment)\
-                              .filter_by(wb_id=weibo.id)\
-                              .order_by(Comment.created.desc())
+    def load(self, weibo_id, user_id, page, per_page_size):
+        session = self.session
+        weibo = weibo_cache.get(session, weibo_id)       # 获取微博数据 (包括已归档的微博)
+        if weibo is None:
+            raise tornado.web.HTTPError(404)
+        author = user_cache.get(session, weibo.user_id)  # 根据微博记录的作者 id 获取用户数据
 
-        # 取出所有评论的作者的 user_id
-        comment_author_id_list = {cmt.user_id for cmt in all_comments}
+        # 取出当前微博的评论树，按楼层分页
+        tree = load_comment_tree(session, weibo.id, weibo.archived)
+        comments = tree.page(page, per_page_size)
 
-        # 根据评论作者的 ID 取出所有评论的作者
-        comment_authors_list = session.query(User).filter(User.id.in_(comment_author_id_list))
-        comment_authors = {u.id: u for u in comment_authors_list}  # 将数据转成字典形式
+        n_like = weibo.like_count + counter_buffer.pending(weibo_id)[0]
 
         # 取出用户点赞状态
-        user_id = self.get_cookie('user_id')
         if user_id is None:
             is_liked = False  # 用户未登陆时，按未点赞看待
         else:
             # 从数据库取出点赞记录
-            like_record = session.query(Like).get((weibo_id, int(user_id)))
+            like_record = session.query(Like).get((weibo_id, user_id))
             # is_liked = False if like_record is None else like_record.status  # 三元表达式的写法
             if like_record is None:
                 is_liked = False
             else:
                 is_liked = like_record.status
-        n_like = session.query(Like).filter_by(wb_id=weibo_id, status=True).count()
 
-        return self.render('show_wb.html',
-                           weibo=weibo, user=author,
-                           all_comments=all_comments,
-                           comment_authors=comment_authors,
-                           is_liked=is_liked,
-                           n_like=n_like,
-                           top10=top10())
+            # 写队列中尚未写入的点赞操作
+            pending = write_queue.pending('like', user_id, weibo_id)
+            if pending is not None and pending != is_liked:
+                n_like += 1 if pending else -1
+                is_liked = pending
+
+        return dict(weibo=weibo, user=author,
+                    comments=comments,
+                    cmt_pages=tree.n_pages(per_page_size),
+                    is_liked=is_liked,
+                    n_like=n_like)
 
 
-class HomePageHandler(tornado.web.RequestHandler):
+class HomePageHandler(BaseHandler):
     '''首页'''
 
-    def get(self):
+    @cache_page(lambda self: 'home')
+    async def get(self):
         page = int(self.get_argument('page', 1))  # 获取页码
+        cursor = self.get_argument('cursor', None)  # 翻页游标
         per_page_size = 10                        # 每页显示的数量
 
-        # 取出所有的微博
-        session = Session()
-        q_weibo = session.query(Weibo)
-        all_pages = ceil(q_weibo.count() / per_page_size)  # 总页数
+        if cursor is not None:
+            # 游标分页：从上一页最后一条微博的位置继续向后读
+            try:
+                cursor = decode_cursor(cursor)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+
+        data = await self.run_in_db(self.load, page, cursor, per_page_size)
+        return self.render('home.html', cur_page=page, **data)
+
+    def load(self, page, cursor, per_page_size):
+        # 总页数，使用缓存的近似行数
+        all_pages = max(1, ceil(weibo_count.value / per_page_size))
+
         # 按时间降序取出指定页数的微博
-        wb_list = q_weibo.filter()\
-                         .order_by(Weibo.created.desc())\
-                         .limit(per_page_size)\
-                         .offset((page - 1) * per_page_size)
+        session = self.session
+        # 只在索引上取出 ID，微博数据从缓存中读取
+        q_weibo = session.query(Weibo.id).order_by(Weibo.created.desc(), Weibo.id.desc())
+        if cursor is not None:
+            created, wb_id = cursor
+            q_weibo = q_weibo.filter(or_(Weibo.created < created,
+                                         and_(Weibo.created == created, Weibo.id < wb_id)))
+        else:
+            # 兼容 ?page=N 的旧链接
+            q_weibo = q_weibo.offset((page - 1) * per_page_size)
+        wb_id_list = [wb_id for (wb_id, ) in q_weibo.limit(per_page_size)]
+        weibos = weibo_cache.get_many(session, wb_id_list)
+        wb_list = [weibos[wb_id] for wb_id in wb_id_list if wb_id in weibos]
+
+        # 下一页的游标
+        if len(wb_list) == per_page_size:
+            next_cursor = encode_cursor(wb_list[-1].created, wb_list[-1].id)
+        else:
+            next_cursor = None
 
         # 取出对应的用户
-        q_user = session.query(User)
         user_id_list = {wb.user_id for wb in wb_list}  # 取出所有的作者的 ID
-        # 取出用户，并将数据整理成字典形式, key 为 user_id, value 为 user 对象
-        users = {u.id: u for u in q_user.filter(User.id.in_(user_id_list))}
+        # 取出用户，数据为字典形式, key 为 user_id, value 为 user 对象
+        users = user_cache.get_many(session, user_id_list)
+
+        # 获取每条微博的点赞数量、评论数量
+        like_dict, comment_dict = weibo_counts(wb_list)
+
+        return dict(wb_list=wb_list, users=users,
+                    pages=page_window(page, all_pages),
+                    next_cursor=next_cursor,
+                    like_dict=like_dict, comment_dict=comment_dict)
+
+
+class SearchHandler(BaseHandler):
+    '''搜索微博'''
+
+    async def get(self):
+        query = self.get_argument('q', '').strip()  # 搜索的内容
+        page = int(self.get_argument('page', 1))   # 获取页码
+        per_page_size = 10                         # 每页显示的数量
+
+        data = await self.run_in_db(self.load, query, page, per_page_size)
+        return self.render('search.html', query=query, cur_page=page,
+                           ready=search_index.ready, **data)
+
+    def load(self, query, page, per_page_size):
+        session = self.session
+        wb_id_list, n_results = search_index.search(session, query, page, per_page_size)
+        weibos = weibo_cache.get_many(session, wb_id_list)
+        wb_list = [weibos[wb_id] for wb_id in wb_id_list if wb_id in weibos]
+
+        # 取出对应的用户
+        users = user_cache.get_many(session, {wb.user_id for wb in wb_list})
 
-        # 获取每条微博的点赞数量
-        wb_id_list = [wb.id for wb in wb_list]
-        like_dict = dict(session.query(Like.wb_id, func.count(1))
-                                .filter(Like.status.is_(True), Like.wb_id.in_(wb_id_list))
-                                .group_by(Like.wb_id).all())
+        # 获取每条微博的点赞数量、评论数量
+        like_dict, comment_dict = weibo_counts(wb_list)
 
-        return self.render('home.html',
-                           wb_list=wb_list, users=users,
-                           all_pages=all_pages, cur_page=page,
-                           like_dict=like_dict, top10=top10())
+        all_pages = max(1, ceil(n_results / per_page_size))
+        return dict(wb_list=wb_list, users=users, n_results=n_results,
+                    pages=page_window(page, all_pages),
+                    like_dict=like_dict, comment_dict=comment_dict)
 
 
-class CommentCommitHandler(tornado.web.RequestHandler):
+class CommentCommitHandler(BaseHandler):
     '''发表评论'''
 
     @login_required
-    def post(self):
+    async def post(self):
         # 取出参数
         content = self.get_argument('content')
         wb_id = int(self.get_argument('wb_id'))
-        user_id = int(self.get_cookie('user_id'))
+        user_id = self.current_user.id
 
         # 插入评论内容
-        session = Session()
         comment = Comment(user_id=user_id, wb_id=wb_id, content=content,
                           created=datetime.datetime.now())  # 创建 comment 对象
-        session.add(comment)  # 插入单条数据
-        session.commit()
+        await event_bus.backpressure()
+        await self.run_in_db(self.save, comment)
 
         # 跳回原来的页面
         return self.redirect('/weibo/show?weibo_id=%s' % wb_id)
 
+    def save(self, comment):
+        self.session.add(comment)  # 插入单条数据
+        self.session.flush()
+        emit(self.session, CommentPosted(comment.id, comment.wb_id, comment.user_id, comment.cmt_id))
+        self.session.commit()
+
 
-class ReplyCommentHandler(tornado.web.RequestHandler):
+class ReplyCommentHandler(BaseHandler):
     '''回复其他评论'''
 
-    def get(self):
+    async def get(self):
         cmt_id = int(self.get_argument('cmt_id'))  # 要回复的评论的 ID
 
-        session = Session()
-        comment = session.query(Comment).get(cmt_id)     # 要回复的 Comment 对象
-        user = session.query(User).get(comment.user_id)  # 原评论的作者
+        comment, user = await self.run_in_db(self.load, cmt_id)
+        return self.render('reply_comment.html', comment=comment, user=user)
 
-        return self.render('reply_comment.html', comment=comment, user=user, top10=top10())
+    def load(self, cmt_id):
+        comment = self.session.query(Comment).get(cmt_id)      # 要回复的 Comment 对象
+        if comment is None:  # 所在的微博已经归档
+            comment = self.session.query(ArchivedComment).get(cmt_id)
+        if comment is None:
+            raise tornado.web.HTTPError(404)
+        user = user_cache.get(self.session, comment.user_id)  # 原评论的作者
+        return comment_row(comment), user
 
     @login_required
-    def post(self):
+    async def post(self):
         # 获取参数
         content = self.get_argument('content')     # 回复内容
         cmt_id = int(self.get_argument('cmt_id'))  # 所回复的原评论的 ID
         wb_id = int(self.get_argument('wb_id'))    # 对应的微博 ID
-        user_id = int(self.get_cookie('user_id'))       # 当前用户的 ID
+        user_id = self.current_user.id             # 当前用户的 ID
 
         # 添加数据
-        session = Session()
         comment = Comment(user_id=user_id, wb_id=wb_id, cmt_id=cmt_id,
                           content=content, created=datetime.datetime.now())
-        session.add(comment)
-        session.commit()
+        await event_bus.backpressure()
+        await self.run_in_db(self.save, comment)
 
         # 发表完回复以后，页面回到原微博下
         return self.redirect('/weibo/show?weibo_id=%s' % wb_id)
 
+    def save(self, comment):
+        self.session.add(comment)
+        self.session.flush()
+        emit(self.session, CommentPosted(comment.id, comment.wb_id, comment.user_id, comment.cmt_id))
+        self.session.commit()
 
-class LikeHandler(tornado.web.RequestHandler):
+
+class LikeHandler(BaseHandler):
     '''点赞接口'''
     @login_required
-    def get(self):
-        user_id = self.get_cookie('user_id')
-        wb_id = self.get_argument('wb_id')
-
-        # 第一次点赞的操作
-        like = Like(wb_id=wb_id, user_id=user_id, created=datetime.datetime.now())
-        session = Session()
-        session.add(like)
-        try:
-            session.commit()
-        except (IntegrityError, err.IntegrityError):
-            session.rollback()  # 回滚之前的操作
+    async def get(self):
+        user_id = self.current_user.id
+        wb_id = int(self.get_argument('wb_id'))
 
-            # 产生冲突，说明用户重复点赞，或者想将取消的赞改回来
-            # 如果冲突，需要将状态修改为 True
-            session.query(Like).get((wb_id, user_id)).status = True
-            session.commit()
+        # 微博不存在时不写入，微博已缓存时不访问数据库
+        if weibo_cache.peek(wb_id) is None and \
+                await self.run_in_db(weibo_cache.get, self.session, wb_id) is None:
+            raise tornado.web.HTTPError(404)
+        write_queue.put('like', user_id, wb_id, True)  # 由写队列批量写入数据库
+        self.mark_written()
 
         return self.redirect('/weibo/show?weibo_id=%s' % wb_id)
 
 
-class DislikeHandler(tornado.web.RequestHandler):
+class DislikeHandler(BaseHandler):
     '''取消点赞接口'''
     @login_required
     def get(self):
-        user_id = self.get_cookie('user_id')
-        wb_id = self.get_argument('wb_id')
+        user_id = self.current_user.id
+        wb_id = int(self.get_argument('wb_id'))
 
-        session = Session()
-        try:
-            session.query(Like).get((wb_id, user_id)).status = False
-            session.commit()
-        except AttributeError:
-            pass
+        write_queue.put('like', user_id, wb_id, False)
+        self.mark_written()
 
         return self.redirect('/weibo/show?weibo_id=%s' % wb_id)
 
 
-class FollowHandler(tornado.web.RequestHandler):
+class FollowHandler(BaseHandler):
     '''关注'''
 
     @login_required
     def get(self):
         # 获取参数
-        user_id = int(self.get_cookie('user_id'))
+        user_id = self.current_user.id
         follow_id = int(self.get_argument('follow_id'))
 
-        # 定义数据模型
-        follow = Follow(user_id=user_id, follow_id=follow_id,
-                        created=datetime.datetime.now())
-        # 插入数据
-        session = Session()
-        session.add(follow)
-        try:
-            session.commit()  # 提交修改
-        except (IntegrityError, err.IntegrityError):
-            session.rollback()  # 回滚之前的操作
-
-            # 数据有冲突，说明用户重复提交关注，或者用户想将“取消关注”的状态重新修改为“关注”
-            session.query(Follow).get((user_id, follow_id)).status = True
-            session.commit()
+        write_queue.put('follow', user_id, follow_id, True)
+        self.mark_written()
 
         # 跳回用户信息页
         return self.redirect('/user/info?user_id=%s' % follow_id)
 
 
-class UnfollowHandler(tornado.web.RequestHandler):
+class UnfollowHandler(BaseHandler):
     '''取消关注'''
 
     @login_required
     def get(self):
         # 获取参数
-        user_id = int(self.get_cookie('user_id'))
+        user_id = self.current_user.id
         follow_id = int(self.get_argument('follow_id'))
 
-        # 找到关注的数据
-        session = Session()
-        try:
-            session.query(Follow).get((user_id, follow_id)).status = False
-            session.commit()
-        except AttributeError:
-            pass
+        write_queue.put('follow', user_id, follow_id, False)
+        self.mark_written()
 
         # 跳回用户信息页
         return self.redirect('/user/info?user_id=%s' % follow_id)
 
 
-class FollowWeiboHandler(tornado.web.RequestHandler):
+class FollowWeiboHandler(BaseHandler):
     @login_required
-    def get(self):
-        user_id = int(self.get_cookie('user_id'))
+    async def get(self):
+        user_id = self.current_user.id
+        page = int(self.get_argument('page', 1))  # 获取页码
+        per_page_size = 10                        # 每页显示的数量
 
-        # 取出关注的人的 ID
-        session = Session()
-        follow_ids = session.query(Follow)\
-                            .filter_by(user_id=user_id, status=True)\
-                            .values('follow_id')
-        follow_id_list = [fid for (fid, ) in follow_ids]
+        data = await self.run_in_db(self.load, user_id, page, per_page_size)
+        return self.render('follow_weibo.html', cur_page=page, **data)
 
-        # 取出对应的用户对象
-        users = session.query(User).filter(User.id.in_(follow_id_list))
-        users = {u.id: u for u in users}  # 将结果整理成字典格式
+    def load(self, user_id, page, per_page_size):
+        # 从时间线中取出当前页的微博
+        session = self.session
+        wb_id_list = timeline.page(session, user_id, page, per_page_size)
+        weibos = weibo_cache.get_many(session, wb_id_list)
+        wb_list = [weibos[wb_id] for wb_id in wb_id_list if wb_id in weibos]
 
-        # 根据用户 ID 取出微博
-        wb_list = session.query(Weibo)\
-                            .filter(Weibo.user_id.in_(follow_id_list))\
-                            .order_by(Weibo.created.desc())
+        # 取出对应的用户对象
+        user_id_list = {wb.user_id for wb in wb_list}
+        users = user_cache.get_many(session, user_id_list)
 
-        # 获取每条微博的点赞数量
-        wb_id_list = [wb.id for wb in wb_list]
-        like_dict = dict(session.query(Like.wb_id, func.count(1))
-                                .filter(Like.status.is_(True), Like.wb_id.in_(wb_id_list))
-                                .group_by(Like.wb_id).all())
+        # 获取每条微博的点赞数量、评论数量
+        like_dict, comment_dict = weibo_counts(wb_list)
 
-        return self.render('follow_weibo.html',
-                           wb_list=wb_list, users=users, like_dict=like_dict, top10=top10())
+        return dict(wb_list=wb_list, users=users,
+                    has_next=len(wb_id_list) == per_page_size,
+                    like_dict=like_dict, comment_dict=comment_dict)
 
 
-class FansHandler(tornado.web.RequestHandler):
+class FansHandler(BaseHandler):
     '''粉丝接口'''
     @login_required
-    def get(self):
-        user_id = self.get_cookie('user_id')
+    async def get(self):
+        user_id = self.current_user.id
+        page = int(self.get_argument('page', 1))  # 获取页码
+        per_page_size = 20                        # 每页显示的数量
+
+        data = await self.run_in_db(self.load, user_id, page, per_page_size)
+        return self.render('fans.html', cur_page=page, **data)
 
+    def load(self, user_id, page, per_page_size):
         # 取出自己粉丝的 ID
-        session = Session()
-        fans_ids = session.query(Follow)\
-                            .filter_by(follow_id=user_id, status=True)\
-                            .values('user_id')
-        fans_id_list = [fid for (fid, ) in fans_ids]
+        session = self.session
+        fans_ids = graph.followers(session, user_id)
+        all_pages = max(1, ceil(len(fans_ids) / per_page_size))
+        fans_id_list = fans_ids[(page - 1) * per_page_size:page * per_page_size]
 
-        # 取出对应的用户对象
-        fans_list = session.query(User).filter(User.id.in_(fans_id_list))
+        # 取出对应的用户对象，并标记互相关注的粉丝
+        fans = user_cache.get_many(session, fans_id_list)
+        following = graph.following(session, user_id)
+        fans_list = [(fans[fid], contains(following, fid)) for fid in fans_id_list if fid in fans]
+        return dict(fans_list=fans_list, n_fans=len(fans_ids),
+                    pages=page_window(page, all_pages))
+
+
+class NoticeListHandler(BaseHandler):
+    '''通知列表，打开后全部标记为已读'''
+
+    @login_required
+    async def get(self):
+        user_id = self.current_user.id
+        page = int(self.get_argument('page', 1))  # 获取页码
+        per_page_size = 20                        # 每页显示的数量
+
+        data = await self.run_in_db(self.load, user_id, page, per_page_size)
+        self.n_unread = 0
+        return self.render('notices.html', cur_page=page, kinds=KINDS, **data)
+
+    def load(self, user_id, page, per_page_size):
+        session = self.session
+        notice_list = notifications.page(session, user_id, page, per_page_size)
+        all_pages = max(1, ceil(notifications.count(session, user_id) / per_page_size))
 
-        return self.render('fans.html', fans_list=fans_list, top10=top10())
+        # 取出最近一次操作的用户，以及相关的微博
+        actors = user_cache.get_many(session, {n.actor_id for n in notice_list})
+        weibos = weibo_cache.get_many(session, {n.target for n in notice_list if n.target})
+
+        notifications.mark_read(session, user_id)
+        return dict(notice_list=notice_list, actors=actors, weibos=weibos,
+                    pages=page_window(page, all_pages))
+
+
+class NoticePollHandler(BaseHandler):
+    '''长轮询：未读通知数与客户端已知的不同时立即返回，否则等待新的通知'''
+
+    async def get(self):
+        if self.current_user is None:
+            raise tornado.web.HTTPError(403)
+        user_id = self.current_user.id
+        known = self.get_argument('unread', None)
+
+        if known is not None and int(known) == self.n_unread:
+            # 会话在每次 run_in_db 之后已经关闭，等待期间不占用数据库连接
+            if not await notifications.wait(user_id, options.notice_poll_timeout):
+                notifications.unread.delete(user_id)  # 超时后重新查询，取得其他进程产生的通知
+        n_unread = await self.run_in_db(notifications.unread_count, self.session, user_id)
+        self.write({'unread': n_unread})
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    '''各个视图的耗时分布，以及缓存的统计数据'''
+
+    def get(self):
+        self.write({
+            'handlers': profiler.to_dict(),
+            'caches': {'user': user_cache.stats(), 'weibo': weibo_cache.stats(),
+                       'page': page_cache.stats(), 'session': session_store.stats(),
+                       'notice': notifications.unread.stats()},
+            'events': event_bus.stats(),
+            'static': static_files.stats(),
+            'rate_limit': rate_limiter.stats(),
+            'replicas': replica_pool.stats(),
+            'in_flight': BaseHandler.in_flight,
+        })
+
+
+def weibo_counts(wb_list):
+    '''取出微博的点赞数量、评论数量 (数据库中的计数 + 尚未写回的增量)'''
+    like_dict, comment_dict = {}, {}
+    for wb in wb_list:
+        like, comment = counter_buffer.pending(wb.id)
+        like_dict[wb.id] = wb.like_count + like
+        comment_dict[wb.id] = wb.comment_count + comment
+    return like_dict, comment_dict
 
 
 def top10():
     '''获取热度前 10 的微博'''
-    session = Session()
-
-    # 取出热度前10的微博的 ID 及其点赞数量
-    top10_weibo = session.query(Like.wb_id, func.count(1)) \
-                         .filter(Like.status.is_(True)) \
-                         .group_by(Like.wb_id) \
-                         .order_by(func.count(1).desc()) \
-                         .limit(10)
-
-    # 根据微博的 id 取出相应的微博
-    wb_id_list = [wb_id for (wb_id, _) in top10_weibo]
-    weibo_dict = dict(session.query(Weibo)\
-                             .filter(Weibo.id.in_(wb_id_list))\
-                             .values('id', 'content'))
-
-    # 组装结果数据
-    result = []
-    for wb_id, n_like in top10_weibo:
-        content = weibo_dict[wb_id]  # 取出微博的内容
-        item = (wb_id, content, n_like)
-        result.append(item)
-
-    return result
+    return leaderboard.top()
@@ -0,0 +1,165 @@
+"""点赞、关注的写队列
+
+点赞 / 取消点赞、关注 / 取消关注只记录在内存中，由后台任务定期批量写入数据库。
+同一用户对同一目标的多次操作会被合并，只写入最后的状态。
+
+写入时先用一条 SELECT ... FOR UPDATE 取出并锁住这批记录原来的状态，计算出真正发生变化的记录，
+多个进程同时写入同一条记录时，后写入的进程等待先写入的提交后再比较，不会重复发出事件
+(MySQL 对尚不存在的记录加间隙锁，冲突时其中一个事务死锁回滚，这批操作放回队列下次重试)。
+再用单条语句的 upsert 批量写入 (MySQL 的 INSERT ... ON DUPLICATE KEY UPDATE，
+SQLite 的 INSERT ... ON CONFLICT DO UPDATE)，取消操作只 UPDATE 已存在的记录。
+真正发生变化的记录作为事件 (LikeChanged / FollowChanged) 与数据在同一个事务中提交，
+由事件总线的订阅者更新计数器、热门榜单等。
+"""
+
+import datetime
+import threading
+
+from sqlalchemy import and_, or_, bindparam, text
+from sqlalchemy.dialects import mysql
+from tornado.options import define
+
+from models import Session, Like, Follow
+from events import emit, LikeChanged, FollowChanged
+
+define('write_flush_interval', default=200, type=int,
+       help='点赞、关注批量写入数据库的间隔 (毫秒)，间隔内的重复操作会被合并')
+
+
+class ToggleTable:
+    '''记录开关状态的表，主键为 (用户, 目标)'''
+
+    def __init__(self, model, user_column, target_column, event):
+        self.model = model
+        self.table = model.__table__
+        self.user_column = user_column
+        self.target_column = target_column
+        self.event = event  # 状态变化时发出的事件类型
+
+    def load_status(self, session, keys):
+        '''取出并锁住已有记录的状态 {(user_id, target): status}，锁在事务提交时释放'''
+        user_col = getattr(self.model, self.user_column)
+        target_col = getattr(self.model, self.target_column)
+        query = session.query(user_col, target_col, self.model.status) \
+                       .filter(or_(*[and_(user_col == user_id, target_col == target)
+                                     for user_id, target in keys])) \
+                       .order_by(user_col, target_col) \
+                       .with_for_update()  # SQLite 没有行锁，写事务本身就是串行的
+        return {(user_id, target): status for user_id, target, status in query}
+
+    def upsert(self, session, keys):
+        '''插入状态为 True 的记录，已存在时只修改状态'''
+        now = datetime.datetime.now()
+        rows = [{self.user_column: user_id, self.target_column: target,
+                 'status': True, 'created': now} for user_id, target in keys]
+        dialect = session.get_bind().dialect
+        if dialect.name == 'mysql':
+            stmt = mysql.insert(self.table)
+            stmt = stmt.on_duplicate_key_update(status=stmt.inserted.status)
+        else:
+            # SQLAlchemy 1.3 的 SQLite 方言不支持 on_conflict，直接拼写语句
+            preparer = dialect.identifier_preparer
+            columns = [self.user_column, self.target_column, 'status', 'created']
+            stmt = text('INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s, %s) '
+                        'DO UPDATE SET status = excluded.status' % (
+                            preparer.format_table(self.table),
+                            ', '.join(preparer.quote(col) for col in columns),
+                            ', '.join(':%s' % col for col in columns),
+                            preparer.quote(self.user_column),
+                            preparer.quote(self.target_column)))
+        session.execute(stmt, rows)  # executemany
+
+    def disable(self, session, keys):
+        '''将已存在的记录的状态改为 False'''
+        table = self.table
+        stmt = table.update() \
+                    .where(and_(table.c[self.user_column] == bindparam('_user'),
+                                table.c[self.target_column] == bindparam('_target'))) \
+                    .values(status=False)
+        session.execute(stmt, [{'_user': user_id, '_target': target}
+                               for user_id, target in keys])
+
+
+class WriteQueue:
+    '''合并开关操作，批量写入数据库'''
+
+    def __init__(self, tables, batch_size=200):
+        self.tables = tables          # {类型: ToggleTable}
+        self.batch_size = batch_size  # 每条 SQL 处理的记录数
+        self._pending = {}            # 等待写入的状态 {(类型, user_id, 目标): status}
+        self._flushing = {}           # 正在写入的状态
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时间只有一次写入，保证各批按顺序提交
+
+    def put(self, kind, user_id, target, status):
+        '''记录一次操作，覆盖之前尚未写入的操作'''
+        with self._lock:
+            self._pending[(kind, user_id, target)] = status
+
+    def pending(self, kind, user_id, target):
+        '''尚未写入数据库的状态，没有时返回 None'''
+        key = (kind, user_id, target)
+        with self._lock:
+            status = self._pending.get(key)
+            return self._flushing.get(key) if status is None else status
+
+    def flush(self, wait=False):
+        '''将等待中的操作批量写入数据库
+
+        上一次写入还没有结束时，定时任务直接跳过 (操作留到下次)；wait 为 True 时等待上一次结束
+        '''
+        if not self._flush_lock.acquire(blocking=wait):
+            return
+        try:
+            self._flush()
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            items = list(self._flushing.items())
+
+        session = Session()
+        try:
+            for i in range(0, len(items), self.batch_size):
+                self._write(session, items[i:i + self.batch_size])
+            session.commit()
+        except Exception:
+            session.rollback()
+            # 写入失败时放回队列，已有更新的操作时以新的为准
+            with self._lock:
+                for key, status in items:
+                    self._pending.setdefault(key, status)
+            raise
+        finally:
+            session.close()
+            with self._lock:
+                self._flushing = {}
+
+    def _write(self, session, items):
+        '''写入一批操作，状态发生变化的记录发出事件'''
+        for kind, table in self.tables.items():
+            statuses = {(user_id, target): status
+                        for (k, user_id, target), status in items if k == kind}
+            if not statuses:
+                continue
+            old = table.load_status(session, statuses)
+            enable = [key for key, status in statuses.items() if status and not old.get(key)]
+            disable = [key for key, status in statuses.items() if not status and old.get(key)]
+            if enable:
+                table.upsert(session, enable)
+            if disable:
+                table.disable(session, disable)
+            for user_id, target in enable:
+                emit(session, table.event(user_id, target, True))
+            for user_id, target in disable:
+                emit(session, table.event(user_id, target, False))
+
+
+write_queue = WriteQueue({
+    'like': ToggleTable(Like, 'user_id', 'wb_id', LikeChanged),
+    'follow': ToggleTable(Follow, 'user_id', 'follow_id', FollowChanged),
+})
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 源码为 src 下的平铺模块，与 main.py 的导入方式相同
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,74 @@
+import os
+import sys
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# 子进程：crash 阶段点赞、处理完事件、删除已确认的事件之后，在计数写回之前退出；
+# recover 阶段重放遗留的事件并写回计数，输出微博的点赞数
+WORKER = '''
+import os, sys, time, asyncio, datetime
+sys.path.insert(0, %(src)r)
+import models
+models.init_engine('sqlite:///' + sys.argv[1], workers=2)
+models.Base.metadata.create_all()
+import subscribers
+from tornado.ioloop import IOLoop
+from events import event_bus
+from writequeue import write_queue
+from counters import counter_buffer
+
+async def settle(*names):
+    deadline = time.time() + 5
+    while time.time() < deadline and (event_bus.depth() or
+                                      not all(sub.processed for sub in event_bus.subscribers
+                                              if sub.name in names)):
+        await asyncio.sleep(0.02)
+
+async def crash():
+    session = models.Session()
+    session.add(models.User(id=1, nickname='a'))
+    session.add(models.User(id=2, nickname='b'))
+    session.add(models.Weibo(id=1, user_id=1, content='x', created=datetime.datetime.now()))
+    session.commit()
+    session.close()
+    event_bus.start(0)
+    write_queue.put('like', 2, 1, True)
+    await models.run_in_db(write_queue.flush)
+    await settle('counters', 'notify')
+    await models.run_in_db(event_bus.flush_acks)
+    os._exit(1)  # 计数写回之前崩溃
+
+async def recover():
+    event_bus.start(0)
+    await event_bus.replay(datetime.datetime.now() + datetime.timedelta(seconds=1))
+    await settle('counters')  # 通知在崩溃前已经提交，重放时跳过
+    await models.run_in_db(counter_buffer.flush, True)
+    await models.run_in_db(event_bus.flush_acks)
+    session = models.Session()
+    print(session.query(models.Weibo.like_count).filter_by(id=1).scalar(),
+          session.query(models.OutboxEvent).count(),
+          session.query(models.Notification).count())
+    session.close()
+    await event_bus.stop()
+
+IOLoop.current().run_sync(crash if sys.argv[2] == 'crash' else recover)
+''' % {'src': SRC}
+
+
+def run_worker(db, phase):
+    return subprocess.run([sys.executable, '-c', WORKER, db, phase], cwd=SRC,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_counts_survive_crash_between_ack_and_flush(tmp_path):
+    db = str(tmp_path / 'events.db')
+    crashed = run_worker(db, 'crash')
+    assert crashed.returncode == 1, crashed.stderr
+
+    recovered = run_worker(db, 'recover')
+    assert recovered.returncode == 0, recovered.stderr
+    like_count, n_outbox, n_notices = map(int, recovered.stdout.split())
+    assert like_count == 1  # 计数在重放时补上
+    assert n_outbox == 0
+    assert n_notices == 1   # 崩溃前已经提交的通知不重复
@@ -0,0 +1,36 @@
+import datetime
+
+import pytest
+
+from pagination import encode_cursor, decode_cursor, page_window
+
+
+def test_cursor_round_trip():
+    created = datetime.datetime(2019, 5, 17, 8, 30, 1, 123456)
+    cursor = encode_cursor(created, 42)
+    assert decode_cursor(cursor) == (created, 42)
+
+
+def test_cursor_keeps_microseconds_and_large_ids():
+    created = datetime.datetime(2010, 1, 1)
+    assert decode_cursor(encode_cursor(created, 2 ** 40)) == (created, 2 ** 40)
+
+
+def test_cursor_is_url_safe_without_padding():
+    for row_id in range(1, 20):
+        cursor = encode_cursor(datetime.datetime(2020, 2, 29, 23, 59, 59), row_id)
+        assert '=' not in cursor
+        assert set(cursor) <= set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_')
+
+
+@pytest.mark.parametrize('cursor', ['', 'not a cursor', '!!!!', 'MjAxOQ', 'YWJjfGRlZg'])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_page_window():
+    assert list(page_window(1, 3)) == [1, 2, 3]
+    assert list(page_window(1, 100)) == list(range(1, 10))
+    assert list(page_window(50, 100)) == list(range(46, 55))
+    assert list(page_window(100, 100)) == list(range(92, 101))
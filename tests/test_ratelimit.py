@@ -0,0 +1,90 @@
+import pytest
+from tornado.options import options
+
+from ratelimit import parse_rate, take, RateLimit, MemoryBackend, SharedBackend, RateLimiter
+
+
+def test_parse_rate():
+    assert parse_rate('60/m') == (1.0, 60)
+    assert parse_rate('10/s') == (10.0, 10)
+    assert parse_rate('5') == (5.0, 5)
+    assert parse_rate(None) is None
+
+
+def test_take_refills_up_to_capacity():
+    assert take(0, 0, 1.0, 5, 100) == (4, 0)      # 早已回满
+    tokens, wait = take(0.5, 10, 1.0, 5, 10)
+    assert tokens == 0.5 and wait == pytest.approx(0.5)
+
+
+def test_rate_limit_methods():
+    limit = RateLimit('post', user='1/s', methods=('POST', ))
+    assert limit.applies('POST') and not limit.applies('GET')
+    assert RateLimit('any').applies('GET')
+
+
+@pytest.fixture(params=['memory', 'shared'])
+def backend(request):
+    return MemoryBackend() if request.param == 'memory' else SharedBackend(64)
+
+
+def test_burst_then_reject(backend):
+    now = 1000.0
+    assert [backend.take('k', 1.0, 3, now) for _ in range(3)] == [0, 0, 0]
+    assert backend.take('k', 1.0, 3, now) == pytest.approx(1.0)
+    assert backend.take('k', 1.0, 3, now + 1) == 0  # 一秒后补充一个令牌
+
+
+def test_keys_are_independent(backend):
+    assert backend.take('a', 1.0, 1, 1000.0) == 0
+    assert backend.take('a', 1.0, 1, 1000.0) > 0
+    assert backend.take('b', 1.0, 1, 1000.0) == 0
+
+
+def test_memory_wheel_drops_full_buckets():
+    backend = MemoryBackend(wheel_size=60)
+    backend.take('a', 1.0, 2, 1000.0)
+    backend.take('b', 1.0, 2, 1000.0)
+    assert backend.stats() == {'buckets': 2}
+    backend.take('c', 1.0, 2, 1005.0)  # a、b 在 1001 秒时回满
+    assert set(backend.buckets) == {'c'}
+
+
+def test_memory_wheel_keeps_buckets_longer_than_one_round():
+    backend = MemoryBackend(wheel_size=10)
+    backend.take('slow', 0.01, 2, 1000.0)  # 100 秒后才回满
+    backend.take('other', 1.0, 1, 1050.0)
+    assert 'slow' in backend.buckets
+    backend.take('other', 1.0, 1, 1200.0)
+    assert 'slow' not in backend.buckets
+
+
+def test_limiter_checks_user_and_ip(monkeypatch):
+    monkeypatch.setattr(options, 'rate_limit', True)
+    limiter = RateLimiter(MemoryBackend())
+    limit = RateLimit('like', user='1/m', ip='3/m')
+    assert limiter.check(limit, 1, '10.0.0.1') == 0
+    assert limiter.check(limit, 1, '10.0.0.1') > 0       # 用户的令牌用完
+    assert limiter.check(limit, 2, '10.0.0.1') == 0
+    assert limiter.check(limit, None, '10.0.0.1') == 0
+    assert limiter.check(limit, None, '10.0.0.1') > 0    # IP 的令牌用完
+    assert limiter.check(limit, None, '10.0.0.2') == 0
+    assert limiter.stats()['rejected'] == {'like': 2}
+
+
+def test_rejected_user_keeps_ip_tokens(monkeypatch):
+    monkeypatch.setattr(options, 'rate_limit', True)
+    limiter = RateLimiter(MemoryBackend())
+    limit = RateLimit('like', user='1/m', ip='2/m')
+    assert limiter.check(limit, 1, '10.0.0.1') == 0
+    for _ in range(10):
+        assert limiter.check(limit, 1, '10.0.0.1') > 0   # 只消耗用户自己的令牌
+    assert limiter.check(limit, 2, '10.0.0.1') == 0      # 同一 IP 下的其他用户仍然放行
+    assert limiter.check(limit, 3, '10.0.0.1') > 0       # IP 的令牌只用掉两个
+
+
+def test_limiter_disabled(monkeypatch):
+    monkeypatch.setattr(options, 'rate_limit', False)
+    limiter = RateLimiter(MemoryBackend())
+    limit = RateLimit('like', ip='1/m')
+    assert [limiter.check(limit, None, '10.0.0.1') for _ in range(5)] == [0] * 5
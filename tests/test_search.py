@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+import models
+from cache import weibo_cache
+from search import tokenize, encode_varint, decode_postings, Postings, SearchIndex
+
+NOW = datetime.datetime(2020, 1, 1)
+
+
+def test_tokenize_document_indexes_unigrams_and_bigrams():
+    assert tokenize('我喜欢猫') == ['我', '喜', '欢', '猫', '我喜', '喜欢', '欢猫']
+
+
+def test_tokenize_query_uses_bigrams_for_runs():
+    assert tokenize('喜欢猫', query=True) == ['喜欢', '欢猫']
+
+
+def test_tokenize_query_single_character():
+    assert tokenize('猫', query=True) == ['猫']
+
+
+def test_tokenize_mixed_text():
+    assert tokenize('Hello, 世界 abc123!', query=True) == ['hello', '世界', 'abc123']
+    assert tokenize('') == []
+
+
+def test_postings_round_trip():
+    p = Postings()
+    for doc_id, tf in [(3, 1), (10, 2), (300, 1), (7, 5)]:  # 7 比已有的 ID 小，重新编码
+        p.add(doc_id, tf)
+    assert list(decode_postings(p.data)) == [(3, 1), (7, 5), (10, 2), (300, 1)]
+    assert p.df == 4 and p.last == 300
+
+
+def test_varint_multi_byte():
+    buf = bytearray()
+    for n in (0, 127, 128, 2 ** 21):
+        encode_varint(buf, n)
+        encode_varint(buf, 1)
+    assert [doc_id for doc_id, _ in decode_postings(buf)] == [0, 127, 255, 255 + 2 ** 21]
+
+
+@pytest.fixture
+def session(tmp_path):
+    models.init_engine('sqlite:///%s' % (tmp_path / 'search.db'), workers=1)
+    models.Base.metadata.create_all()
+    session = models.Session()
+    yield session
+    session.close()
+    weibo_cache.lru.clear()
+    models.engine.dispose()
+
+
+def make_index(session, docs):
+    index = SearchIndex()
+    for wb_id, content in docs.items():
+        session.add(models.Weibo(id=wb_id, user_id=1, content=content, created=NOW))
+        index.add(wb_id, content, NOW)
+    session.commit()
+    return index
+
+
+def test_search_single_character(session):
+    index = make_index(session, {1: '我喜欢猫和狗', 2: '今天天气不错'})
+    assert index.search(session, '猫', 1, 10) == ([1], 1)
+    assert index.search(session, '喜欢猫', 1, 10) == ([1], 1)
+    assert index.search(session, '天气', 1, 10) == ([2], 1)
+
+
+def test_search_requires_all_terms(session):
+    index = make_index(session, {1: '猫和狗', 2: '猫和鱼'})
+    assert index.search(session, '猫', 1, 10)[1] == 2
+    assert index.search(session, '猫 狗', 1, 10) == ([1], 1)
+    assert index.search(session, '老虎', 1, 10) == ([], 0)
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# 子进程中运行 Supervisor：工作进程 0 收到 SIGTERM 后 2 秒才退出，模拟处理手上的请求
+SUPERVISOR = '''
+import os, sys, time, signal, logging
+sys.path.insert(0, %(src)r)
+from serving import Supervisor
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%%(message)s')
+
+def worker(idx):
+    if idx == 0:
+        signal.signal(signal.SIGTERM, lambda *args: (time.sleep(2), os._exit(0)))
+    while True:
+        time.sleep(0.05)
+
+Supervisor(2, worker).run()
+''' % {'src': SRC}
+
+
+def wait_for(proc, lines, pattern, timeout=10):
+    '''读取输出直到出现包含 pattern 的一行，返回这一行'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        line = proc.stdout.readline()
+        lines.append(line)
+        if pattern in line:
+            return line
+    raise AssertionError('%r not found in %r' % (pattern, lines))
+
+
+def test_rolling_restart_keeps_supervising():
+    proc = subprocess.Popen([sys.executable, '-c', SUPERVISOR], stdout=subprocess.PIPE, text=True)
+    lines = []
+    try:
+        old_pid = int(wait_for(proc, lines, 'worker 0 started').split()[-1])
+        crash_pid = int(wait_for(proc, lines, 'worker 1 started').split()[-1])
+
+        proc.send_signal(signal.SIGHUP)
+        wait_for(proc, lines, 'worker 0 started')  # 新进程启动，旧进程开始退出
+        os.kill(crash_pid, signal.SIGKILL)
+
+        # 等待旧进程退出期间，异常退出的进程仍然会被重启
+        wait_for(proc, lines, 'worker 1 started')
+        assert not any('replaced' in line for line in lines)
+        assert 'worker 0 (pid %d) replaced' % old_pid in wait_for(proc, lines, 'replaced')
+
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
@@ -0,0 +1,34 @@
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+import models
+import main
+from views import BaseHandler
+
+
+def fetch(app, path, **kwargs):
+    '''在临时端口上启动 app，发送一个请求'''
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        try:
+            return await AsyncHTTPClient().fetch('http://127.0.0.1:%d%s' % (port, path),
+                                                 raise_error=False, **kwargs)
+        finally:
+            server.stop()
+    return IOLoop.current().run_sync(run)
+
+
+def test_unsupported_method():
+    models.init_engine('sqlite://', workers=1)
+    models.Base.metadata.create_all()
+    app = main.make_app(cookie_secret='test')
+
+    in_flight = BaseHandler.in_flight
+    response = fetch(app, '/', method='PROPFIND', allow_nonstandard_methods=True)
+    assert response.code == 405  # 在 prepare 之前返回
+    assert 'Server-Timing' in response.headers
+    assert BaseHandler.in_flight == in_flight  # 优雅退出时不会一直等待
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import models
+from models import Session, Like, OutboxEvent
+from writequeue import WriteQueue, ToggleTable
+from events import LikeChanged
+
+
+@pytest.fixture
+def queue():
+    models.init_engine('sqlite://', workers=1)
+    models.Base.metadata.create_all()
+    return WriteQueue({'like': ToggleTable(Like, 'user_id', 'wb_id', LikeChanged)}, batch_size=2)
+
+
+def changes():
+    '''写入的 LikeChanged 事件 [(user_id, wb_id, status), ...]，取出后清空'''
+    session = Session()
+    try:
+        rows = session.query(OutboxEvent).order_by(OutboxEvent.id).all()
+        result = [tuple(json.loads(row.payload).values()) for row in rows]
+        session.query(OutboxEvent).delete()
+        session.commit()
+        return result
+    finally:
+        session.close()
+
+
+def statuses():
+    session = Session()
+    try:
+        return {(like.user_id, like.wb_id): like.status for like in session.query(Like)}
+    finally:
+        session.close()
+
+
+def test_coalesces_until_flush(queue):
+    queue.put('like', 1, 10, True)
+    queue.put('like', 1, 10, False)
+    queue.put('like', 1, 10, True)
+    queue.put('like', 2, 10, False)  # 没有点过赞，取消不产生记录
+    assert queue.pending('like', 1, 10) is True
+    assert statuses() == {}
+
+    queue.flush()
+    assert queue.pending('like', 1, 10) is None
+    assert statuses() == {(1, 10): True}
+    assert changes() == [(1, 10, True)]  # 合并后只写入最后的状态
+
+
+def test_flush_emits_only_real_changes(queue):
+    for wb_id in (10, 11, 12):  # 超过 batch_size，分多条语句写入
+        queue.put('like', 1, wb_id, True)
+    queue.flush()
+    assert sorted(changes()) == [(1, 10, True), (1, 11, True), (1, 12, True)]
+
+    queue.put('like', 1, 10, True)   # 已经点过赞
+    queue.put('like', 1, 11, False)
+    queue.flush()
+    assert statuses() == {(1, 10): True, (1, 11): False, (1, 12): True}
+    assert changes() == [(1, 11, False)]
+
+    queue.put('like', 1, 11, True)   # 重新点赞，修改已有的记录
+    queue.flush()
+    assert statuses()[1, 11] is True
+    assert changes() == [(1, 11, True)]
+
+
+def test_failed_flush_requeues(queue, monkeypatch):
+    def fail(session, items):
+        raise RuntimeError('db down')
+    monkeypatch.setattr(queue, '_write', fail)
+    queue.put('like', 1, 10, True)
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    queue.put('like', 1, 11, True)
+    assert queue.pending('like', 1, 10) is True  # 放回队列，下次重试
+    monkeypatch.undo()
+
+    queue.flush()
+    assert statuses() == {(1, 10): True, (1, 11): True}